@@ -1,11 +1,22 @@
+import secrets
 from typing import Annotated
 from uuid import UUID
 
-from fastapi import Depends
+from fastapi import Depends, Form, Header, Query, Request
+from pydantic import EmailStr
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.core.exceptions import ClientNotAuthorized, InvalidToken
-from app.core.security import oauth2_scheme_partner, oauth2_scheme_seller
+from app.core.exceptions import ClientNotAuthorized, InvalidToken, TooManyRequests
+from app.core.security import (
+    oauth2_scheme_client,
+    oauth2_scheme_partner,
+    oauth2_scheme_seller,
+)
+from app.core.timing import timed
+from app.api.schemas.shipment import ShipmentView
+from app.config import security_settings
+from app.database.loaders import get_loaders
+from app.database import ratelimit
 from app.database.models import DeliveryPartner, Seller
 from app.database.redis import is_jti_blacklisted
 from app.database.session import get_session
@@ -13,6 +24,7 @@ from app.services.delivery_partner import DeliveryPartnerService
 from app.services.seller import SellerService
 from app.services.shipment import ShipmentService
 from app.services.shipment_event import ShipmentEventService
+from app.services.webhook import WebhookService
 from app.utils import decode_access_token
 
 # Asynchronous database session dep annotation
@@ -21,11 +33,12 @@ SessionDep = Annotated[AsyncSession, Depends(get_session)]
 
 # Access token data dep
 async def _get_access_token(token: str) -> dict:
-    data = decode_access_token(token)
+    with timed("auth"):
+        data = decode_access_token(token)
 
-    # Validate the token
-    if data is None or await is_jti_blacklisted(data["jti"]):
-        raise InvalidToken()
+        # Validate the token
+        if data is None or await is_jti_blacklisted(data["jti"]):
+            raise InvalidToken()
 
     return data
 
@@ -44,13 +57,19 @@ async def get_partner_access_token(
     return await _get_access_token(token)
 
 
+# Seller or delivery partner access token data
+async def get_client_access_token(
+    token: Annotated[str, Depends(oauth2_scheme_client)],
+) -> dict:
+    return await _get_access_token(token)
+
+
 # Logged In Seller
 async def get_current_seller(
     token_data: Annotated[dict, Depends(get_seller_access_token)],
     session: SessionDep,
 ):
-    seller = await session.get(
-        Seller,
+    seller = await get_loaders(session).sellers.load(
         UUID(token_data["user"]["id"]),
     )
 
@@ -65,8 +84,7 @@ async def get_current_partner(
     token_data: Annotated[dict, Depends(get_partner_access_token)],
     session: SessionDep,
 ):
-    partner = await session.get(
-        DeliveryPartner,
+    partner = await get_loaders(session).partners.load(
         UUID(token_data["user"]["id"]),
     )
 
@@ -76,6 +94,90 @@ async def get_current_partner(
     return partner
 
 
+# Admin endpoints are disabled unless an admin token is configured
+def verify_admin_token(
+    x_admin_token: Annotated[str | None, Header()] = None,
+):
+    if (
+        security_settings.ADMIN_TOKEN is None
+        or x_admin_token is None
+        or not secrets.compare_digest(x_admin_token, security_settings.ADMIN_TOKEN)
+    ):
+        raise ClientNotAuthorized()
+
+
+# Takes a token of each bucket, the client ip's first
+async def _rate_limit(
+    request: Request,
+    account: str,
+    by_ip: ratelimit.TokenBucket,
+    by_account: ratelimit.TokenBucket,
+):
+    ip = request.client.host if request.client else "unknown"
+    retry_after = await by_ip.take(ip) or await by_account.take(account.lower())
+    if retry_after:
+        raise TooManyRequests(retry_after)
+
+
+# Login attempts, limited by client ip and account
+async def limit_login(request: Request, username: Annotated[str, Form()]):
+    await _rate_limit(
+        request, username, ratelimit.login_by_ip, ratelimit.login_by_account
+    )
+
+
+# Password reset links, limited by client ip and account
+async def limit_password_reset(request: Request, email: EmailStr):
+    await _rate_limit(
+        request,
+        email,
+        ratelimit.password_reset_by_ip,
+        ratelimit.password_reset_by_account,
+    )
+
+
+_SHIPMENT_FIELD = f"({'|'.join(ShipmentView.FIELDS)})"
+
+
+# Sparse fieldset and timeline depth of shipment responses
+def get_shipment_view(
+    fields: Annotated[
+        str | None,
+        Query(
+            pattern=f"^{_SHIPMENT_FIELD}(,{_SHIPMENT_FIELD})*$",
+            description="Comma separated fields to return, all by default",
+            examples=["id,status,estimated_delivery"],
+        ),
+    ] = None,
+    timeline: Annotated[
+        str,
+        Query(
+            pattern=r"^(full|latest|none|\d+)$",
+            description="Events of the timeline to return, "
+            "full, latest, none or a number of latest events",
+        ),
+    ] = "full",
+) -> ShipmentView:
+    view = ShipmentView()
+
+    if fields:
+        view.fields = frozenset(fields.split(",")) | {"id"}
+
+    match timeline:
+        case "full":
+            pass
+        case "latest":
+            view.timeline_depth = 1
+        case "none":
+            view.fields -= {"timeline"}
+        case depth:
+            view.timeline_depth = int(depth)
+            if view.timeline_depth == 0:
+                view.fields -= {"timeline"}
+
+    return view
+
+
 # Shipment service dep
 def get_shipment_service(
     session: SessionDep
@@ -97,6 +199,11 @@ def get_delivery_partner_service(session: SessionDep):
     return DeliveryPartnerService(session)
 
 
+# Webhook service dep
+def get_webhook_service(session: SessionDep):
+    return WebhookService(session)
+
+
 # Seller dep annotation
 SellerDep = Annotated[
     Seller,
@@ -115,6 +222,12 @@ ShipmentServiceDep = Annotated[
     Depends(get_shipment_service),
 ]
 
+# Shipment view dep annotation
+ShipmentViewDep = Annotated[
+    ShipmentView,
+    Depends(get_shipment_view),
+]
+
 # Seller service dep annotation
 SellerServiceDep = Annotated[
     SellerService,
@@ -126,3 +239,9 @@ DeliveryPartnerServiceDep = Annotated[
     DeliveryPartnerService,
     Depends(get_delivery_partner_service),
 ]
+
+# Webhook service dep annotation
+WebhookServiceDep = Annotated[
+    WebhookService,
+    Depends(get_webhook_service),
+]
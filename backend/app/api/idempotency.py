@@ -0,0 +1,223 @@
+"""Idempotency keys for requests clients retry on timeout
+
+A request with an `Idempotency-Key` header claims the key in redis,
+runs, and its response is stored under the key for a day. A retry
+with the same key (from the same client) gets the stored response
+back, marked with `Idempotent-Replayed: true`, instead of running
+again. A retry arriving while the first request still runs waits for
+its response, woken through redis pub/sub.
+
+Keys are scoped to the client's Authorization header, and a key
+reused for a different request (method, path, query or body) is
+refused. Server errors are not stored, the key is released so a
+retry runs the request again.
+"""
+
+import asyncio
+import hashlib
+from typing import Iterable
+
+import orjson
+from fastapi import status
+from fastapi.responses import JSONResponse, Response
+from starlette.datastructures import Headers
+from redis.exceptions import RedisError
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import app_settings
+from app.core.logging import logger
+from app.core.metrics import IDEMPOTENT_REQUESTS
+from app.database.pubsub import Broadcaster
+from app.database.redis import redis_client
+
+HEADER = "idempotency-key"
+MAX_KEY_LENGTH = 255
+
+# Seconds a request holds its key, waiting retries give up after it
+# and a key whose request never finished (worker killed) is freed
+LOCK_TTL = 60
+
+_records = redis_client(5)
+_finished = Broadcaster(redis_client(5, decode_responses=True), prefix="idempotency")
+
+
+def _error(status_code: int, detail: str) -> Response:
+    return JSONResponse({"detail": detail}, status_code=status_code)
+
+
+class IdempotencyMiddleware:
+    """Stores the responses of `routes`, (method, path) pairs,
+    for requests with an idempotency key"""
+
+    def __init__(self, app: ASGIApp, routes: Iterable[tuple[str, str]]):
+        self.app = app
+        self.routes = set(routes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] != "http"
+            or (scope["method"], scope["path"]) not in self.routes
+        ):
+            return await self.app(scope, receive, send)
+
+        headers = Headers(scope=scope)
+        key = headers.get(HEADER)
+        authorization = headers.get("authorization")
+        # Requests without a client are refused by the route anyway
+        if key is None or authorization is None:
+            return await self.app(scope, receive, send)
+        if not 0 < len(key) <= MAX_KEY_LENGTH:
+            return await _error(
+                status.HTTP_400_BAD_REQUEST,
+                f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters",
+            )(scope, receive, send)
+
+        body = await _read_body(receive)
+        id = hashlib.sha256(f"{authorization}\n{key}".encode()).hexdigest()
+        fingerprint = hashlib.sha256(
+            b"\n".join(
+                (
+                    scope["method"].encode(),
+                    scope["path"].encode(),
+                    scope["query_string"],
+                    body,
+                )
+            )
+        ).hexdigest()
+
+        while True:
+            try:
+                claimed = await _records.set(
+                    f"idempotency:{id}",
+                    orjson.dumps({"fingerprint": fingerprint}),
+                    nx=True,
+                    ex=LOCK_TTL,
+                )
+                response = None if claimed else await self._wait(id, fingerprint)
+            except RedisError:
+                # Run as if there was no key, retries may run again
+                logger.warning("Idempotency key not checked", exc_info=True)
+                return await self.app(scope, _replay(body, receive), send)
+            if claimed:
+                return await self._run(id, fingerprint, body, scope, receive, send)
+
+            # Otherwise the first request failed, claim the key again
+            if response is not None:
+                return await response(scope, receive, send)
+
+    async def _run(
+        self,
+        id: str,
+        fingerprint: str,
+        body: bytes,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+    ):
+        start: Message = {}
+        chunks = []
+
+        async def send_and_keep(message: Message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        stored = False
+        try:
+            await self.app(scope, _replay(body, receive), send_and_keep)
+
+            status_code = start.get("status", 500)
+            # Refused for too many requests, a retry may go through
+            if status_code < 500 and status_code != status.HTTP_429_TOO_MANY_REQUESTS:
+                try:
+                    await _records.set(
+                        f"idempotency:{id}",
+                        orjson.dumps(
+                            {
+                                "fingerprint": fingerprint,
+                                "status": status_code,
+                                "content_type": Headers(raw=start["headers"]).get(
+                                    "content-type"
+                                ),
+                                "body": b"".join(chunks).decode(),
+                            }
+                        ),
+                        ex=app_settings.IDEMPOTENCY_KEY_TTL,
+                    )
+                    stored = True
+                except RedisError:
+                    # Sent already, a retry runs the request again
+                    logger.warning("Idempotent response not stored", exc_info=True)
+        finally:
+            IDEMPOTENT_REQUESTS.inc("stored" if stored else "released")
+            try:
+                if not stored:
+                    await _records.delete(f"idempotency:{id}")
+                await _finished.publish(id, "")
+            except RedisError:
+                # Retries wait for the key to expire
+                logger.warning("Idempotency key not released", exc_info=True)
+
+    async def _wait(self, id: str, fingerprint: str) -> Response | None:
+        """Response of the request holding the key, None once the key
+        is free again"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + LOCK_TTL
+
+        # Subscribed before reading the record, not to miss its end
+        async with _finished.subscribe(id) as finished:
+            while True:
+                record = await _records.get(f"idempotency:{id}")
+                if record is None:
+                    return None
+
+                record = orjson.loads(record)
+                if record["fingerprint"] != fingerprint:
+                    IDEMPOTENT_REQUESTS.inc("mismatch")
+                    return _error(
+                        status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        "Idempotency-Key was used for a different request",
+                    )
+                if "status" in record:
+                    IDEMPOTENT_REQUESTS.inc("replayed")
+                    return Response(
+                        record["body"],
+                        status_code=record["status"],
+                        headers={"Idempotent-Replayed": "true"},
+                        media_type=record["content_type"],
+                    )
+
+                try:
+                    await asyncio.wait_for(finished.get(), deadline - loop.time())
+                except TimeoutError:
+                    IDEMPOTENT_REQUESTS.inc("timeout")
+                    return _error(
+                        status.HTTP_409_CONFLICT,
+                        "A request with this Idempotency-Key is still in progress",
+                    )
+
+
+async def _read_body(receive: Receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def _replay(body: bytes, receive: Receive) -> Receive:
+    """Receive of the body read already, then of the client's disconnect"""
+    sent = False
+
+    async def replay() -> Message:
+        nonlocal sent
+        if sent:
+            return await receive()
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return replay
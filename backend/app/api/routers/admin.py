@@ -0,0 +1,72 @@
+import os
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Query, Response
+
+from app.api.serialization import json_response
+from app.api.tag import APITag
+from app.core.profiler import MAX_SECONDS, MIN_INTERVAL, ProfileFormat, profiler
+from app.core.timing import slow_requests
+
+from ..dependencies import verify_admin_token
+
+router = APIRouter(
+    prefix="/admin",
+    tags=[APITag.ADMIN],
+    dependencies=[Depends(verify_admin_token)],
+)
+
+
+### Latest requests over the slow request threshold
+@router.get("/slow_requests")
+async def get_slow_requests():
+    # Newest first
+    return json_response(list(reversed(slow_requests)))
+
+
+### Clear the slow request log
+@router.delete("/slow_requests")
+async def clear_slow_requests():
+    slow_requests.clear()
+
+
+def _profile_response(profile, format: ProfileFormat) -> Response:
+    filename = f"profile-{os.getpid()}." + (
+        "txt" if format == "collapsed" else "speedscope.json"
+    )
+    return Response(
+        profile.render(format),
+        media_type="text/plain" if format == "collapsed" else "application/json",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Profile-Samples": str(profile.samples),
+        },
+    )
+
+
+### Profile the worker handling this request
+@router.post("/profile")
+async def profile_worker(
+    seconds: Annotated[float, Query(gt=0, le=MAX_SECONDS)] = 10,
+    interval: Annotated[float, Query(ge=MIN_INTERVAL, le=1)] = 0.005,
+    format: ProfileFormat = "collapsed",
+):
+    """Samples the stacks of every thread of the worker for some
+    seconds, as collapsed stacks or a speedscope file"""
+    profile = await profiler.profile(seconds, interval)
+    return _profile_response(profile, format)
+
+
+### Profile the next requests to a route of this worker
+@router.post("/profile/requests")
+async def profile_requests(
+    route: str,
+    count: Annotated[int, Query(gt=0, le=1000)] = 10,
+    seconds: Annotated[float, Query(gt=0, le=MAX_SECONDS)] = 30,
+    interval: Annotated[float, Query(ge=MIN_INTERVAL, le=1)] = 0.001,
+    format: ProfileFormat = "collapsed",
+):
+    """Samples the next `count` requests to a route template, like
+    /shipment/{id}/events, returns once they are done or after `seconds`"""
+    profile = await profiler.profile_requests(route, count, seconds, interval)
+    return _profile_response(profile, format)
@@ -2,26 +2,30 @@ from math import ceil
 from typing import Annotated, Literal
 
 
-from fastapi import APIRouter, Depends, Form, Request
+from fastapi import APIRouter, Depends, Form, Query, Request
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, EmailStr
 from sqlmodel import asc, desc, select
 
+from app.api.serialization import json_response
 from app.api.tag import APITag
+from app.api.templates import templates
 from app.core.exceptions import NothingToUpdate
 from app.core.security import TokenData
 from app.database.models import Shipment
 from app.database.redis import add_jti_to_blacklist
-from app.utils import TEMPLATE_DIR
 from app.config import app_settings
-from app.api.schemas.shipment import ShipmentRead
+from app.api.schemas.shipment import ShipmentChanges, ShipmentRead
 
 from ..dependencies import (
     DeliveryPartnerDep,
     DeliveryPartnerServiceDep,
     SessionDep,
+    ShipmentServiceDep,
+    ShipmentViewDep,
     get_partner_access_token,
+    limit_login,
+    limit_password_reset,
 )
 from ..schemas.delivery_partner import (
     DeliveryPartnerCreate,
@@ -43,7 +47,11 @@ async def register_delivery_partner(
 
 
 ### Login a delivery partner
-@router.post("/token", response_model=TokenData)
+@router.post(
+    "/token",
+    response_model=TokenData,
+    dependencies=[Depends(limit_login)],
+)
 async def login_delivery_partner(
     request_form: Annotated[OAuth2PasswordRequestForm, Depends()],
     service: DeliveryPartnerServiceDep,
@@ -77,8 +85,23 @@ def get_pagination_params(
 
 ## Get all shipments assigned to the delivery partner
 @router.get("/shipments", response_model=list[ShipmentRead])
-async def get_shipments(partner: DeliveryPartnerDep):
-    return partner.shipments
+async def get_shipments(
+    partner: DeliveryPartnerDep,
+    service: ShipmentServiceDep,
+    view: ShipmentViewDep,
+):
+    return json_response(await service.read_all(partner=partner, view=view))
+
+### Get shipments changed since the cursor
+@router.get("/shipments/changes", response_model=ShipmentChanges)
+async def get_shipment_changes(
+    partner: DeliveryPartnerDep,
+    service: ShipmentServiceDep,
+    since: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(ge=1, le=10_000)] = 1000,
+):
+    return await service.get_changes(since, limit, partner=partner)
+
 
 ### Get all shipments assigned to the delivery partner
 # @router.get("/shipments", response_model=DeliveryPartnerShipments)
@@ -126,7 +149,7 @@ async def update_delivery_partner(
     )
 
 ### Email Password Reset Link
-@router.get("/forgot_password")
+@router.get("/forgot_password", dependencies=[Depends(limit_password_reset)])
 async def forgot_password(email: EmailStr, service: DeliveryPartnerServiceDep):
     await service.send_password_reset_link(email, router.prefix)
     return {"detail": "Check email for password reset link"}
@@ -135,8 +158,6 @@ async def forgot_password(email: EmailStr, service: DeliveryPartnerServiceDep):
 ### Password Reset Form
 @router.get("/reset_password_form")
 async def get_reset_password_form(request: Request, token: str):
-    templates = Jinja2Templates(TEMPLATE_DIR)
-
     return templates.TemplateResponse(
         request=request,
         name="password/reset.html",
@@ -156,7 +177,6 @@ async def reset_password(
 ):
     is_success = await service.reset_password(token, password)
 
-    templates = Jinja2Templates(TEMPLATE_DIR)
     return templates.TemplateResponse(
         request=request,
         name="password/reset_success.html"
@@ -1,19 +1,33 @@
-from typing import Annotated
+from typing import Annotated, Literal
+from uuid import UUID
 
-from fastapi import APIRouter, Depends, Form, Request
+from fastapi import APIRouter, Depends, Form, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.templating import Jinja2Templates
 from pydantic import EmailStr
 
-from app.api.schemas.shipment import ShipmentRead
+from app.api.schemas.shipment import ShipmentChanges, ShipmentRead, ShipmentView
+from app.api.serialization import csv_lines, gzip_stream, json_response, ndjson_lines
 from app.api.tag import APITag
+from app.api.templates import templates
 from app.core.security import TokenData
 from app.database.redis import add_jti_to_blacklist
-from app.utils import TEMPLATE_DIR
+from app.database.session import async_session
 from app.config import app_settings
 
-from ..dependencies import SellerDep, SellerServiceDep, get_seller_access_token
+from ..dependencies import (
+    SellerDep,
+    SellerServiceDep,
+    ShipmentServiceDep,
+    ShipmentViewDep,
+    WebhookServiceDep,
+    get_seller_access_token,
+    get_shipment_service,
+    limit_login,
+    limit_password_reset,
+)
 from ..schemas.seller import SellerCreate, SellerRead
+from ..schemas.webhook import WebhookCreate, WebhookCreated, WebhookRead
 
 router = APIRouter(prefix="/seller", tags=[APITag.SELLER])
 
@@ -25,7 +39,11 @@ async def register_seller(seller: SellerCreate, service: SellerServiceDep):
 
 
 ### Login a seller
-@router.post("/token", response_model=TokenData)
+@router.post(
+    "/token",
+    response_model=TokenData,
+    dependencies=[Depends(limit_login)],
+)
 async def login_seller(
     request_form: Annotated[OAuth2PasswordRequestForm, Depends()],
     service: SellerServiceDep,
@@ -45,8 +63,88 @@ async def get_seller_profile(seller: SellerDep):
 
 ### Get all shipments created by the seller
 @router.get("/shipments", response_model=list[ShipmentRead])
-async def get_shipments(seller: SellerDep):
-    return seller.shipments
+async def get_shipments(
+    seller: SellerDep,
+    service: ShipmentServiceDep,
+    view: ShipmentViewDep,
+):
+    return json_response(await service.read_all(seller=seller, view=view))
+
+
+### Register a webhook for shipment status changes
+@router.post("/webhooks", response_model=WebhookCreated)
+async def register_webhook(
+    webhook: WebhookCreate,
+    seller: SellerDep,
+    service: WebhookServiceDep,
+):
+    webhook = await service.add(webhook, seller)
+    return {**webhook.model_dump(), "secret": webhook.secret}
+
+
+### Get all webhooks of the seller
+@router.get("/webhooks", response_model=list[WebhookRead])
+async def get_webhooks(seller: SellerDep, service: WebhookServiceDep):
+    return await service.get_all(seller)
+
+
+### Deactivate a webhook
+@router.delete("/webhooks")
+async def delete_webhook(id: UUID, seller: SellerDep, service: WebhookServiceDep):
+    await service.delete(id, seller)
+    return {"detail": "Webhook deactivated"}
+
+
+### Get shipments changed since the cursor
+@router.get("/shipments/changes", response_model=ShipmentChanges)
+async def get_shipment_changes(
+    seller: SellerDep,
+    service: ShipmentServiceDep,
+    since: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(ge=1, le=10_000)] = 1000,
+):
+    return await service.get_changes(since, limit, seller=seller)
+
+
+### Export all shipments of the seller
+@router.get("/shipments/export", response_class=StreamingResponse)
+async def export_shipments(
+    seller: SellerDep,
+    view: ShipmentViewDep,
+    format: Literal["csv", "ndjson"] = "csv",
+    gzip: bool = False,
+):
+    """Streams shipments as csv or newline delimited json. Csv has no
+    timeline column, the latest status is exported instead"""
+
+    if format == "csv" and "timeline" in view.fields:
+        view.fields = view.fields - {"timeline"} | {"status"}
+    columns = [field for field in ShipmentView.FIELDS if field in view.fields]
+
+    async def export():
+        if format == "csv":
+            yield csv_lines([], columns, header=True)
+
+        # Own session as the request's one is closed
+        # before the response is streamed
+        async with async_session() as session:
+            async for shipments in get_shipment_service(session).stream(seller, view):
+                yield (
+                    csv_lines(shipments, columns)
+                    if format == "csv"
+                    else ndjson_lines(shipments)
+                )
+
+    filename = f"shipments.{format}" + (".gz" if gzip else "")
+    return StreamingResponse(
+        gzip_stream(export()) if gzip else export(),
+        media_type="application/gzip"
+        if gzip
+        else "text/csv"
+        if format == "csv"
+        else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 ### Verify Seller Email
@@ -57,7 +155,7 @@ async def verify_seller_email(token: str, service: SellerServiceDep):
 
 
 ### Email Password Reset Link
-@router.get("/forgot_password")
+@router.get("/forgot_password", dependencies=[Depends(limit_password_reset)])
 async def forgot_password(email: EmailStr, service: SellerServiceDep):
     await service.send_password_reset_link(email, router.prefix)
     return {"detail": "Check email for password reset link"}
@@ -66,8 +164,6 @@ async def forgot_password(email: EmailStr, service: SellerServiceDep):
 ### Password Reset Form
 @router.get("/reset_password_form")
 async def get_reset_password_form(request: Request, token: str):
-    templates = Jinja2Templates(TEMPLATE_DIR)
-
     return templates.TemplateResponse(
         request=request,
         name="password/reset.html",
@@ -87,7 +183,6 @@ async def reset_password(
 ):
     is_success = await service.reset_password(token, password)
 
-    templates = Jinja2Templates(TEMPLATE_DIR)
     return templates.TemplateResponse(
         request=request,
         name="password/reset_success.html"
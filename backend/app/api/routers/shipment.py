@@ -1,55 +1,223 @@
 import asyncio
+import json
 import random
-from typing import Annotated
+from contextlib import AsyncExitStack
+from typing import Annotated, AsyncIterator
 from uuid import UUID
 
-from fastapi import APIRouter, Form, Request
-from fastapi.templating import Jinja2Templates
+from fastapi import (
+    APIRouter,
+    Depends,
+    Form,
+    Header,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 
+from app.api.serialization import json_response
 from app.api.tag import APITag
+from app.api.templates import templates
 from app.config import app_settings
-from app.core.exceptions import NothingToUpdate
-from app.database.models import TagName
-from app.utils import TEMPLATE_DIR
+from app.core.exceptions import EntityNotFound, NothingToUpdate
+from app.core.singleflight import SingleFlight
+from app.core.timing import timed
+from app.database.models import ShipmentStatus, TagName
+from app.database.pubsub import shipment_events
+from app.services.shipment import ShipmentService
 
-from ..dependencies import DeliveryPartnerDep, SellerDep, ShipmentServiceDep
+from ..dependencies import (
+    DeliveryPartnerDep,
+    SellerDep,
+    ShipmentServiceDep,
+    ShipmentViewDep,
+    get_client_access_token,
+)
 from ..schemas.shipment import (
     ShipmentCreate,
+    ShipmentLookup,
+    ShipmentLookupResult,
     ShipmentRead,
     ShipmentUpdate,
 )
 
 router = APIRouter(prefix="/shipment", tags=[APITag.SHIPMENT])
 
+# Pages and bodies being made, by shipment id (and view)
+_tracking_pages = SingleFlight("shipment.track")
+_shipment_bodies = SingleFlight("shipment.body")
 
-templates = Jinja2Templates(TEMPLATE_DIR)
 
 ### Tracking details of shipment
 @router.get("/track", include_in_schema=False)
 async def get_tracking(request: Request, id: UUID, service: ShipmentServiceDep):
-    # Check for shipment with given id
-    shipment = await service.get(id)
+    async def render() -> bytes:
+        # Check for shipment with given id
+        shipment = await service.get(id)
 
-    context = shipment.model_dump()
-    context["status"] = shipment.status
-    context["partner"] = shipment.delivery_partner.name
-    context["timeline"] = shipment.timeline
-    context["timeline"].reverse()
+        context = shipment.model_dump()
+        context["status"] = shipment.status
+        context["partner"] = shipment.delivery_partner.name
+        context["timeline"] = list(reversed(shipment.timeline))
 
-    return templates.TemplateResponse(
-        request=request,
-        name="track.html",
-        context=context,
-    )
+        return templates.TemplateResponse(
+            request=request,
+            name="track.html",
+            context=context,
+        ).body
+
+    # Tracking links are opened by many at once, they share the page
+    return HTMLResponse(await _tracking_pages.do(id, render))
 
 
 ### Read a shipment by id
 @router.get("/", response_model=ShipmentRead)
-async def get_shipment(id: UUID, service: ShipmentServiceDep):
+async def get_shipment(
+    id: UUID,
+    service: ShipmentServiceDep,
+    view: ShipmentViewDep,
+):
     # Simluate delay
-    await asyncio.sleep(random.randint(1, 3))
-    # Check for shipment with given id
-    return await service.get(id)
+    if app_settings.SIMULATE_DELAY:
+        with timed("sleep"):
+            await asyncio.sleep(random.randint(1, 3))
+
+    async def read() -> bytes:
+        # Check for shipment with given id
+        return json_response(await service.read(id, view)).body
+
+    # Concurrent reads of a shipment share the serialized body
+    return Response(
+        await _shipment_bodies.do((id, view.fields, view.timeline_depth), read),
+        media_type="application/json",
+    )
+
+
+### Read many shipments by ids
+@router.post("/lookup", response_model=ShipmentLookupResult)
+async def lookup_shipments(
+    lookup: ShipmentLookup,
+    token_data: Annotated[dict, Depends(get_client_access_token)],
+    service: ShipmentServiceDep,
+):
+    return json_response(
+        {
+            "shipments": await service.read_many(
+                lookup.ids,
+                UUID(token_data["user"]["id"]),
+            ),
+        }
+    )
+
+
+# Interval to keep idle streams alive through proxies
+KEEP_ALIVE_INTERVAL = 15
+
+# No more events after these
+FINAL_STATUSES = (ShipmentStatus.delivered, ShipmentStatus.cancelled)
+
+
+async def _shipment_event_stream(
+    id: UUID,
+    service: ShipmentService,
+    stack: AsyncExitStack,
+    last_event_id: UUID | None = None,
+) -> AsyncIterator[str]:
+    # Subscribe before reading the timeline so events
+    # added in between are not missed
+    queue = await stack.enter_async_context(shipment_events.subscribe(str(id)))
+    try:
+        shipment = await service.get(id)
+    except Exception:
+        await stack.aclose()
+        raise
+    # Release the db connection, streaming only needs redis
+    await service.session.close()
+
+    timeline = sorted(shipment.timeline, key=lambda event: event.created_at)
+    seen = {event.id for event in timeline}
+
+    # Resume after the last event the client received
+    if last_event_id in seen:
+        ids = [event.id for event in timeline]
+        timeline = timeline[ids.index(last_event_id) + 1 :]
+
+    async def stream():
+        for event in timeline:
+            yield event.model_dump_json()
+        if shipment.status in FINAL_STATUSES:
+            return
+
+        while True:
+            try:
+                data = await asyncio.wait_for(queue.get(), KEEP_ALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+
+            event = json.loads(data)
+            if UUID(event["id"]) in seen:
+                continue
+
+            yield data
+            if event["status"] in FINAL_STATUSES:
+                return
+
+    return stream()
+
+
+### Stream timeline events of a shipment (Server-Sent Events)
+@router.get("/{id}/events")
+async def stream_shipment_events(
+    id: UUID,
+    service: ShipmentServiceDep,
+    last_event_id: Annotated[UUID | None, Header()] = None,
+):
+    stack = AsyncExitStack()
+    events = await _shipment_event_stream(id, service, stack, last_event_id)
+
+    async def sse():
+        async for data in events:
+            if data is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"id: {json.loads(data)['id']}\nevent: shipment_event\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        sse(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Release the subscription even if the
+        # client disconnects before streaming starts
+        background=BackgroundTask(stack.aclose),
+    )
+
+
+### Stream timeline events of a shipment (WebSocket)
+@router.websocket("/{id}/ws")
+async def websocket_shipment_events(
+    websocket: WebSocket,
+    id: UUID,
+    service: ShipmentServiceDep,
+):
+    async with AsyncExitStack() as stack:
+        try:
+            events = await _shipment_event_stream(id, service, stack)
+        except EntityNotFound:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+
+        await websocket.accept()
+        try:
+            async for data in events:
+                if data is not None:
+                    await websocket.send_text(data)
+        except WebSocketDisconnect:
+            return
+        await websocket.close()
 
 
 ### Create a new shipment
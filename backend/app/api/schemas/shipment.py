@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import ClassVar
 from uuid import UUID
 
 from pydantic import BaseModel, EmailStr, Field
@@ -27,6 +28,38 @@ class ShipmentRead(BaseShipment):
     tags: list[TagRead]
 
 
+class ShipmentView(BaseModel):
+    """Parts of ShipmentRead to load and return"""
+
+    # Selectable fields, status is the latest event's status
+    # and is returned only when asked for
+    FIELDS: ClassVar[tuple[str, ...]] = (
+        *ShipmentRead.model_fields,
+        "status",
+    )
+
+    fields: frozenset[str] = frozenset(ShipmentRead.model_fields)
+    # Latest events of the timeline to include, all if None
+    timeline_depth: int | None = None
+
+    @property
+    def is_full(self) -> bool:
+        return (
+            self.fields == frozenset(ShipmentRead.model_fields)
+            and self.timeline_depth is None
+        )
+
+
+class ShipmentLookup(BaseModel):
+    ids: list[UUID] = Field(min_length=1, max_length=500)
+
+
+class ShipmentLookupResult(BaseModel):
+    # null for shipments not found or not
+    # accessible to the client
+    shipments: dict[UUID, ShipmentRead | None]
+
+
 class ShipmentCreate(BaseShipment):
     """Shipment details to create a new shipment"""
 
@@ -43,4 +76,20 @@ class ShipmentUpdate(BaseModel):
 
 class ShipmentReview(BaseModel):
     rating: int = Field(ge=1, le=5)
-    comment: str | None = Field(default=None)
\ No newline at end of file
+    comment: str | None = Field(default=None)
+
+
+class ShipmentChange(BaseModel):
+    """Latest status of a changed shipment"""
+
+    id: UUID
+    status: ShipmentStatus
+    location: int
+    timestamp: datetime
+
+
+class ShipmentChanges(BaseModel):
+    changes: list[ShipmentChange]
+    # Pass as `since` to get the following changes
+    cursor: int
+    has_more: bool
@@ -0,0 +1,34 @@
+from datetime import datetime
+from uuid import UUID
+
+from pydantic import BaseModel, Field, HttpUrl, field_validator
+
+from app.config import app_settings
+
+
+class WebhookCreate(BaseModel):
+    url: HttpUrl
+    max_concurrency: int = Field(default=2, ge=1, le=10)
+
+    @field_validator("url")
+    @classmethod
+    def https_only(cls, url: HttpUrl) -> HttpUrl:
+        # Local receivers (app.fakes.webhook_receiver) are plain http
+        if url.scheme != "https" and not app_settings.LOCAL_MODE:
+            raise ValueError("Webhook url must be https")
+        return url
+
+
+class WebhookRead(BaseModel):
+    id: UUID
+    url: str
+    active: bool
+    max_concurrency: int
+    created_at: datetime
+
+
+class WebhookCreated(WebhookRead):
+    """Webhook with the secret to verify deliveries,
+    returned only once on registration"""
+
+    secret: str
@@ -0,0 +1,167 @@
+"""Fast path for responses built from database rows
+
+Rows read from our own database are trusted, so they are shaped
+into light read models matching the response schemas and dumped
+with orjson, skipping the response model validation of FastAPI.
+Routes keep `response_model` for the api docs.
+"""
+
+import csv
+import io
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, AsyncIterator, Iterable
+from uuid import UUID
+
+import orjson
+from fastapi import Response
+from sqlalchemy import Row
+
+from app.core.timing import timed
+
+# Uuid keys are used for results keyed by id
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def json_response(content: Any, status_code: int = 200) -> Response:
+    with timed("serialize"):
+        body = orjson.dumps(content, option=ORJSON_OPTIONS)
+    return Response(
+        body,
+        status_code=status_code,
+        media_type="application/json",
+    )
+
+
+# Read models matching app.api.schemas.shipment, slotted
+# dataclasses are small and dumped natively by orjson
+
+
+@dataclass(slots=True)
+class ShipmentEventRecord:
+    id: UUID
+    created_at: datetime
+    seq: int | None
+    location: int
+    status: str
+    description: str | None
+    shipment_id: UUID
+
+
+@dataclass(slots=True)
+class TagRecord:
+    name: str
+    instruction: str
+
+
+@dataclass(slots=True)
+class ShipmentRecord:
+    id: UUID
+    content: str
+    weight: float
+    destination: int
+    estimated_delivery: datetime
+    timeline: list[ShipmentEventRecord]
+    tags: list[TagRecord]
+
+
+# Full shipment or the fields of a sparse view
+ShipmentData = ShipmentRecord | dict
+
+
+def shipment_event_read(row: Row, prefix: str = "") -> ShipmentEventRecord:
+    if prefix:
+        # Event columns joined to another row
+        return ShipmentEventRecord(
+            *(getattr(row, prefix + name) for name in ShipmentEventRecord.__slots__)
+        )
+    return ShipmentEventRecord(
+        row.id,
+        row.created_at,
+        row.seq,
+        row.location,
+        row.status,
+        row.description,
+        row.shipment_id,
+    )
+
+
+def tag_read(row: Row) -> TagRecord:
+    return TagRecord(row.name, row.instruction)
+
+
+def shipment_read(
+    row: Row,
+    timeline: list[ShipmentEventRecord],
+    tags: list[TagRecord],
+) -> ShipmentRecord:
+    return ShipmentRecord(
+        row.id,
+        row.content,
+        row.weight,
+        row.destination,
+        row.estimated_delivery,
+        timeline,
+        tags,
+    )
+
+
+def sparse_shipment_read(
+    row: Row,
+    fields: frozenset[str],
+    timeline: list[ShipmentEventRecord],
+    tags: list[TagRecord],
+) -> dict:
+    # Views leaving out fields are plain dicts
+    shipment = {
+        name: getattr(row, name)
+        for name in ("id", "content", "weight", "destination", "estimated_delivery")
+        if name in fields
+    }
+    if "status" in fields:
+        shipment["status"] = (
+            timeline[-1].status if timeline else getattr(row, "event_status", None)
+        )
+    if "timeline" in fields:
+        shipment["timeline"] = timeline
+    if "tags" in fields:
+        shipment["tags"] = tags
+    return shipment
+
+
+# Streamed exports
+
+
+def ndjson_lines(shipments: Iterable[ShipmentData]) -> bytes:
+    return b"".join(
+        orjson.dumps(shipment, option=orjson.OPT_APPEND_NEWLINE)
+        for shipment in shipments
+    )
+
+
+def csv_lines(
+    shipments: Iterable[dict],
+    columns: list[str],
+    header: bool = False,
+) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(columns)
+    for shipment in shipments:
+        writer.writerow(
+            ";".join(tag.name for tag in shipment["tags"])
+            if column == "tags"
+            else shipment[column]
+            for column in columns
+        )
+    return buffer.getvalue().encode()
+
+
+async def gzip_stream(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    async for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
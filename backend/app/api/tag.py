@@ -4,4 +4,5 @@ from enum import Enum
 class APITag(str, Enum):
     SHIPMENT = "Shipment"
     SELLER = "Seller"
-    PARTNER = "Delivery Partner"
\ No newline at end of file
+    PARTNER = "Delivery Partner"
+    ADMIN = "Admin"
\ No newline at end of file
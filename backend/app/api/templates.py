@@ -0,0 +1,19 @@
+from app.core.timing import TimedTemplates
+from app.utils import TEMPLATE_DIR
+
+# Shared by the routers, each template is compiled once
+templates = TimedTemplates(TEMPLATE_DIR)
+
+# Pages rendered by the api, mails are rendered by the worker
+PAGES = (
+    "track.html",
+    "review.html",
+    "password/reset.html",
+    "password/reset_success.html",
+    "password/reset_failed.html",
+)
+
+
+def compile_pages():
+    for name in PAGES:
+        templates.get_template(name)
@@ -0,0 +1,58 @@
+"""Work done once before the api takes requests, so the first ones
+don't pay for it: pools are filled, pages compiled, and the statements
+of hot paths compiled by sqlalchemy (and prepared by asyncpg)"""
+
+import asyncio
+from time import perf_counter
+from uuid import uuid4
+
+from sqlalchemy import text
+
+from app.api.dependencies import get_shipment_service
+from app.api.templates import compile_pages
+from app.core.exceptions import EntityNotFound
+from app.core.logging import logger
+from app.database import redis
+from app.database.models import TagName
+from app.database.session import async_session, engine
+
+# Database connections opened ahead, the default pool size
+DB_CONNECTIONS = 5
+
+
+async def _open_db_connections():
+    async def open_connection():
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+
+    # Held at the same time, so the pool keeps them all
+    await asyncio.gather(*(open_connection() for _ in range(DB_CONNECTIONS)))
+
+
+async def _run_first_queries():
+    async with async_session() as session:
+        service = get_shipment_service(session)
+
+        # Tag and zip code lookups of new shipments
+        await TagName.FRAGILE.tag(session)
+        await service.partner_service.get_partner_by_zipcode(0)
+        # Shipment reads
+        try:
+            await service.read(uuid4())
+        except EntityNotFound:
+            pass
+
+
+async def warm_up():
+    start = perf_counter()
+    compile_pages()
+
+    for step in (_open_db_connections, redis.connect_clients, _run_first_queries):
+        try:
+            await step()
+        except Exception:
+            # Requests get their own errors, it's no reason not to start
+            logger.warning("Warm up step %s failed", step.__name__, exc_info=True)
+
+    seconds = perf_counter() - start
+    logger.info("Warmed up in %.2fs", seconds, extra={"seconds": seconds})
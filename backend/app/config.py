@@ -1,4 +1,6 @@
 from pathlib import Path
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -16,6 +18,39 @@ class AppSettings(BaseSettings):
     APP_NAME: str = "FastShip"
     APP_DOMAIN: str = "localhost:8000"
 
+    # Requests taking longer (seconds) are kept with their
+    # phase timings and sql statements, see /admin/slow_requests
+    SLOW_REQUEST_THRESHOLD: float = 1
+    SLOW_REQUEST_LOG_SIZE: int = 100
+
+    # Seconds the responses of requests with an
+    # Idempotency-Key are kept for their retries
+    IDEMPOTENCY_KEY_TTL: int = 24 * 60 * 60
+
+    # Random delay added to shipment reads, to try out slow responses
+    SIMULATE_DELAY: bool = True
+
+    # Logs are written as json lines, in dev mode as readable
+    # text, with handled errors printed as rich panels
+    DEV_MODE: bool = False
+    LOG_LEVEL: str = "INFO"
+
+    # Traces of requests and tasks, exported as json lines to
+    # TRACE_FILE or to an otlp/http collector at TRACE_OTLP_ENDPOINT
+    TRACE_EXPORTER: Literal["none", "file", "otlp"] = "none"
+    TRACE_FILE: Path = Path("traces.jsonl")
+    TRACE_OTLP_ENDPOINT: str = "http://localhost:4318"
+    # Share of new traces recorded, traces continued
+    # from a `traceparent` keep the caller's choice
+    TRACE_SAMPLE_RATE: float = 0.1
+
+    # Local profile, runs on one box without outside services: an
+    # sqlite database, redis in the process, celery tasks run eagerly
+    # on threads and mails and sms are recorded (see /local/*/messages)
+    LOCAL_MODE: bool = False
+
+    model_config = _base_config
+
 
 class DatabaseSettings(BaseSettings):
     POSTGRES_SERVER: str
@@ -33,15 +68,49 @@ class DatabaseSettings(BaseSettings):
     def POSTGRES_URL(self):
         return f"postgresql+asyncpg://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_SERVER}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
 
+    @property
+    def DATABASE_URL(self):
+        return self.POSTGRES_URL
+
     def REDIS_URL(self, db):
         return f"redis://{self.REDIS_HOST}:{self.REDIS_PORT}/{db}"
 
 
+class LocalDatabaseSettings(DatabaseSettings):
+    """Nothing to connect to in the local profile"""
+
+    POSTGRES_SERVER: str = ""
+    POSTGRES_PORT: int = 0
+    POSTGRES_USER: str = ""
+    POSTGRES_PASSWORD: str = ""
+    POSTGRES_DB: str = ""
+
+    REDIS_HOST: str = ""
+    REDIS_PORT: str = ""
+
+    # Created on startup, delete it to start over
+    SQLITE_FILE: Path = PROJECT_DIR / "local.db"
+
+    @property
+    def DATABASE_URL(self):
+        return f"sqlite+aiosqlite:///{self.SQLITE_FILE}"
+
+
 class SecuritySettings(BaseSettings):
 
     JWT_SECRET: str
     JWT_ALGORITHM: str
 
+    # Token for the /admin endpoints, disabled if not set
+    ADMIN_TOKEN: str | None = None
+
+    # Requests per minute to log in and to email password reset
+    # links, by client ip and by account, a burst of as many is allowed
+    LOGIN_LIMIT_IP: int = 20
+    LOGIN_LIMIT_ACCOUNT: int = 5
+    PASSWORD_RESET_LIMIT_IP: int = 5
+    PASSWORD_RESET_LIMIT_ACCOUNT: int = 2
+
     model_config = _base_config
 
 
@@ -61,11 +130,36 @@ class NotificationSettings(BaseSettings):
     TWILIO_SID: str
     TWILIO_AUTH_TOKEN: str
     TWILIO_NUMBER: str
+    # Base url of the twilio api, point to a local
+    # stand-in (app.fakes.twilio) to send sms offline
+    TWILIO_API_URL: str | None = None
+
+    # Timeout (seconds) for smtp and twilio requests
+    NOTIFICATION_TIMEOUT: float = 10
 
     model_config = _base_config
 
 
+class LocalNotificationSettings(NotificationSettings):
+    """Mails and sms are only recorded in the local profile"""
+
+    MAIL_USERNAME: str = "local"
+    MAIL_PASSWORD: str = "local"
+    MAIL_FROM: str = "noreply@example.com"
+    MAIL_PORT: int = 1025
+    MAIL_SERVER: str = "localhost"
+    MAIL_FROM_NAME: str = "FastShip"
+
+    TWILIO_SID: str = "AClocal"
+    TWILIO_AUTH_TOKEN: str = "local"
+    TWILIO_NUMBER: str = "+15005550006"
+
+
 app_settings = AppSettings()
-db_settings = DatabaseSettings()
 security_settings = SecuritySettings()
-notification_settings = NotificationSettings()
\ No newline at end of file
+if app_settings.LOCAL_MODE:
+    db_settings = LocalDatabaseSettings()
+    notification_settings = LocalNotificationSettings()
+else:
+    db_settings = DatabaseSettings()
+    notification_settings = NotificationSettings()
@@ -0,0 +1,249 @@
+"""Admission control, requests wait their turn instead of piling up
+
+Routes are put in classes (writes, reads, logins, page renders and
+exports), each with its own number of requests running at once in a
+worker.
+Past it, requests wait in a bounded queue. A request is shed with a
+503 and `Retry-After` when the queue is full, when it waited longer
+than the class allows, or right away when the expected wait (from the
+time requests of the class took lately) is already past it. Priority
+requests (partner status updates) are queued ahead of the others and
+take the place of the newest one when the queue is full.
+
+Streams, health, metrics, docs and admin routes are not limited.
+"""
+
+import asyncio
+import math
+from collections import deque
+from dataclasses import dataclass
+from time import perf_counter
+
+from fastapi import status
+from fastapi.responses import JSONResponse
+from starlette.routing import Match, Route
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.core.metrics import (
+    ADMISSION_IN_FLIGHT,
+    ADMISSION_QUEUED,
+    ADMISSION_SHED,
+    ADMISSION_WAIT_SECONDS,
+)
+from app.core.timing import add_phase_time
+
+
+@dataclass(frozen=True)
+class Limits:
+    # Requests running at once, per worker
+    concurrency: int
+    # Requests waiting, past it new ones are shed
+    queue_size: int
+    # Seconds a request may wait before it is shed
+    timeout: float
+
+
+LIMITS = {
+    # Share the database pool (5 connections, 10 more on overflow)
+    "write": Limits(concurrency=5, queue_size=50, timeout=5),
+    "read": Limits(concurrency=10, queue_size=100, timeout=2),
+    # Bcrypt, one at a time per cpu in the password executor
+    "auth": Limits(concurrency=4, queue_size=16, timeout=3),
+    "page": Limits(concurrency=4, queue_size=32, timeout=2),
+    # Streams holding a connection of their own for as long as they last
+    "export": Limits(concurrency=2, queue_size=4, timeout=5),
+}
+
+# Route templates by class, other routes are reads or writes by method
+AUTH_ROUTES = {
+    "/seller/signup",
+    "/seller/token",
+    "/seller/reset_password",
+    "/partner/signup",
+    "/partner/token",
+    "/partner/reset_password",
+}
+PAGE_ROUTES = {
+    "/shipment/track",
+    "/shipment/review",
+    "/seller/reset_password_form",
+    "/partner/reset_password_form",
+}
+# Kept apart, their time would skew the average of reads
+EXPORT_ROUTES = {"/seller/shipments/export"}
+# Not limited, cheap or long lived
+EXEMPT_ROUTES = {"/", "/metrics", "/docs", "/openapi.json", "/shipment/{id}/events"}
+EXEMPT_PREFIXES = ("/admin/", "/local/")
+# Exceptions to classes by method
+READ_ROUTES = {("POST", "/shipment/lookup")}
+WRITE_ROUTES = {("GET", "/shipment/tag"), ("GET", "/shipment/cancel")}
+
+# Partner status updates, queued first
+PRIORITY_ROUTES = {("PATCH", "/shipment/")}
+
+# Classes of concrete paths kept, a cache the size of the api
+CACHE_SIZE = 1024
+
+# Weight of the latest request in the average time of a class
+SMOOTHING = 0.1
+
+
+def route_class(method: str, route: str) -> str | None:
+    if route in EXEMPT_ROUTES or route.startswith(EXEMPT_PREFIXES):
+        return None
+    if route in AUTH_ROUTES:
+        return "auth"
+    if route in PAGE_ROUTES:
+        return "page"
+    if route in EXPORT_ROUTES:
+        return "export"
+    if (method, route) in READ_ROUTES:
+        return "read"
+    if (method, route) in WRITE_ROUTES:
+        return "write"
+    return "read" if method in ("GET", "HEAD") else "write"
+
+
+class Shed(Exception):
+    def __init__(self, reason: str):
+        self.reason = reason
+
+
+class Gate:
+    """Slots of a class of requests, with the queue waiting for them"""
+
+    def __init__(self, name: str, limits: Limits):
+        self.name = name
+        self.limits = limits
+        self.running = 0
+        self._queue: deque[asyncio.Future] = deque()
+        self._priority: deque[asyncio.Future] = deque()
+        # Average seconds requests hold a slot
+        self.average = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._queue) + len(self._priority)
+
+    def expected_wait(self, position: int) -> float:
+        return position / self.limits.concurrency * self.average
+
+    async def acquire(self, priority: bool = False):
+        """Waits for a slot, raises Shed if not given one in time"""
+        if self.running < self.limits.concurrency and not self.waiting:
+            self.running += 1
+            ADMISSION_IN_FLIGHT.set(self.running, self.name)
+            return
+
+        full = self.waiting >= self.limits.queue_size
+        if full and (not priority or not self._queue):
+            raise Shed("queue_full")
+
+        # Checked before displacing, a request shed anyway leaves the
+        # queue as it was
+        position = len(self._priority) if priority else self.waiting
+        if self.expected_wait(position + 1) > self.limits.timeout:
+            raise Shed("deadline")
+
+        if full:
+            # Room for the priority request, the newest other one leaves
+            self._queue.pop().set_exception(Shed("displaced"))
+
+        queue = self._priority if priority else self._queue
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        ADMISSION_QUEUED.set(self.waiting, self.name)
+        try:
+            done, _ = await asyncio.wait((future,), timeout=self.limits.timeout)
+        except asyncio.CancelledError:
+            self._leave(future, queue)
+            raise
+        if not done:
+            self._leave(future, queue)
+            raise Shed("timeout")
+        # Raises Shed if displaced
+        future.result()
+
+    def _leave(self, future: asyncio.Future, queue: deque):
+        if not future.done():
+            future.cancel()
+            queue.remove(future)
+            ADMISSION_QUEUED.set(self.waiting, self.name)
+        elif future.exception() is None:
+            # Given a slot meanwhile, for the next one
+            self.release()
+
+    def release(self, seconds: float | None = None):
+        if seconds is not None:
+            self.average += SMOOTHING * (seconds - self.average)
+
+        # The slot is handed over to the first waiting request
+        for queue in (self._priority, self._queue):
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    ADMISSION_QUEUED.set(self.waiting, self.name)
+                    return
+
+        self.running -= 1
+        ADMISSION_IN_FLIGHT.set(self.running, self.name)
+
+
+class AdmissionMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.gates = {name: Gate(name, limits) for name, limits in LIMITS.items()}
+        # (method, path) to class and priority
+        self._classes: dict[tuple[str, str], tuple[str | None, bool]] = {}
+
+    def _classify(self, scope: Scope) -> tuple[str | None, bool]:
+        key = (scope["method"], scope["path"])
+        known = self._classes.get(key)
+        if known is not None:
+            return known
+
+        known = (None, False)
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                if isinstance(route, Route):
+                    known = (
+                        route_class(scope["method"], route.path),
+                        (scope["method"], route.path) in PRIORITY_ROUTES,
+                    )
+                break
+
+        if len(self._classes) < CACHE_SIZE:
+            self._classes[key] = known
+        return known
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        name, priority = self._classify(scope)
+        if name is None:
+            return await self.app(scope, receive, send)
+
+        gate = self.gates[name]
+        start = perf_counter()
+        try:
+            await gate.acquire(priority)
+        except Shed as shed:
+            ADMISSION_SHED.inc(name, shed.reason)
+            retry_after = max(1, math.ceil(gate.expected_wait(gate.waiting + 1)))
+            response = JSONResponse(
+                {"detail": "Server is busy, try again later"},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(retry_after)},
+            )
+            return await response(scope, receive, send)
+
+        admitted = perf_counter()
+        ADMISSION_WAIT_SECONDS.observe(admitted - start, name)
+        add_phase_time("queue", admitted - start)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release(perf_counter() - admitted)
@@ -1,6 +1,11 @@
+import math
+
 from fastapi import FastAPI, HTTPException, Request, Response, status
 from fastapi.responses import JSONResponse
 
+from app.config import app_settings
+from app.core.logging import log_handled_error, logger
+
 
 class FastShipError(Exception):
     """Base exception for all exceptions in fastship api"""
@@ -61,25 +66,53 @@ class DeliveryPartnerCapacityExceeded(FastShipError):
     status = status.HTTP_406_NOT_ACCEPTABLE
 
 
+class WebhookUrlNotAllowed(FastShipError):
+    """Webhook url must reach a public address"""
+
+    status = status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+class ProfileInProgress(FastShipError):
+    """A profile of the worker is already running"""
+
+    status = status.HTTP_409_CONFLICT
+
+
+class TooManyRequests(FastShipError):
+    """Too many requests, try again later"""
+
+    status = status.HTTP_429_TOO_MANY_REQUESTS
+
+    def __init__(self, retry_after: float):
+        super().__init__()
+        # Whole seconds, rounded up
+        self.headers = {"Retry-After": str(math.ceil(retry_after))}
+
+
 def _get_handler(status: int, detail: str):
     # Define
     def handler(request: Request, exception: Exception) -> Response:
-        # DEBUG PRINT STATEMENT 👇
-        from rich import print, panel
-        print(
-            panel.Panel(
-                exception.__class__.__name__,
-                title="Handled Exception",
-                border_style="red",
-            ),
-        )
-        # DEBUG PRINT STATEMENT 👆
-        
+        if app_settings.DEV_MODE:
+            # DEBUG PRINT STATEMENT 👇
+            from rich import print, panel
+            print(
+                panel.Panel(
+                    exception.__class__.__name__,
+                    title="Handled Exception",
+                    border_style="red",
+                ),
+            )
+            # DEBUG PRINT STATEMENT 👆
+        else:
+            # Sampled, error storms only log a few of each kind
+            log_handled_error(exception, request.method, request.url.path)
+
         # Raise HTTPException with given status and detail
         # can return JSONResponse as well
         raise HTTPException(
             status_code=status,
             detail=detail,
+            headers=getattr(exception, "headers", None),
         )
     # Return ExceptionHandler required with given
     # status and detail for HTTPExcetion above
@@ -104,6 +137,12 @@ def add_exception_handlers(app: FastAPI):
 
     @app.exception_handler(status.HTTP_500_INTERNAL_SERVER_ERROR)
     def internal_server_error_handler(request, exception):
+        logger.error(
+            "Unhandled %s",
+            exception.__class__.__name__,
+            exc_info=exception,
+            extra={"method": request.method, "path": request.url.path},
+        )
         return JSONResponse(
             content={"detail": "Something went wrong..."},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
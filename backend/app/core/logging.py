@@ -1,17 +1,209 @@
-# import logging
-
-# import logtail
-
-# logger = logging.getLogger("fastship")
-# logger.setLevel(logging.INFO)
-
-# logtail_handler = logtail.LogtailHandler(
-#     source_token="your-toke",
-#     host="your-host",
-# )
-# logtail_handler.setFormatter(
-#     logging.Formatter(
-#         "[%(levelname)s]: %(message)s"
-#     )
-# )
-# logger.addHandler(logtail_handler)
\ No newline at end of file
+"""Structured logs that never block the event loop
+
+Records are put on a bounded queue and written by a listener thread,
+as json lines on stdout (readable text with rich in DEV_MODE). Each
+record carries the id of the request it was logged from, taken from
+the `X-Request-ID` header or generated, and the trace id if any.
+
+Handled errors are sampled: a storm of the same error (like a wave of
+InvalidToken) logs the first few of each window and a count of the rest.
+"""
+
+import atexit
+import copy
+import logging
+import os
+import re
+import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from time import monotonic
+from uuid import uuid4
+
+import orjson
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import app_settings
+from app.core.metrics import Counter
+from app.core.tracing import current_span
+
+# Records waiting to be written, newer ones are dropped past it
+QUEUE_SIZE = 10_000
+# Handled errors of a kind logged per window (seconds)
+ERROR_SAMPLE_SIZE = 10
+ERROR_SAMPLE_WINDOW = 60
+
+# Attributes of every log record, the others come from `extra`
+_RECORD_ATTRIBUTES = {
+    *logging.makeLogRecord({}).__dict__,
+    "message",
+    "request_id",
+    "trace_id",
+}
+# Incoming request ids are echoed back, only accept sane ones
+_REQUEST_ID = re.compile(r"[\w.:-]{1,128}")
+
+# Id of the request (or task) being handled
+request_id: ContextVar[str | None] = ContextVar("request_id", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(
+                record.created, timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in ("request_id", "trace_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        entry.update(
+            (key, value)
+            for key, value in record.__dict__.items()
+            if key not in _RECORD_ATTRIBUTES
+        )
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+
+class _QueueHandler(QueueHandler):
+    """Hands records over to the listener thread, which is
+    started on the first record of each process (celery forks)"""
+
+    def __init__(self, handler: logging.Handler):
+        super().__init__(Queue(QUEUE_SIZE))
+        self.handler = handler
+        self.dropped = 0
+        self._pid: int | None = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # Context of the record is only available in the logging thread
+        record.request_id = request_id.get()
+        span = current_span.get()
+        record.trace_id = span.trace_id if span is not None else None
+
+        # Message and traceback are formatted here, arguments
+        # may not be safe to use from another thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            listener = QueueListener(self.queue, self.handler)
+            listener.start()
+            # Write out records still queued on exit
+            atexit.register(listener.stop)
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def _output_handler() -> logging.Handler:
+    if app_settings.DEV_MODE:
+        from rich.logging import RichHandler
+
+        return RichHandler(rich_tracebacks=False)
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+logger = logging.getLogger("fastship")
+logger.setLevel(app_settings.LOG_LEVEL)
+_handler = _QueueHandler(_output_handler())
+logger.addHandler(_handler)
+# Not handled again by uvicorn's or celery's root handlers
+logger.propagate = False
+
+Counter(
+    "log_records_dropped_total",
+    "Log records dropped, the queue to the logging thread was full",
+    function=lambda: _handler.dropped,
+)
+
+
+class ErrorSampler:
+    """Allows logging the first few errors of each kind per window"""
+
+    def __init__(
+        self,
+        size: int = ERROR_SAMPLE_SIZE,
+        window: float = ERROR_SAMPLE_WINDOW,
+    ):
+        self.size = size
+        self.window = window
+        # Per kind, start of the window and errors seen in it
+        self._windows: dict[str, list] = {}
+
+    def sample(self, kind: str) -> int | None:
+        """Errors of the kind skipped in the last window if this one
+        should be logged, or None if it should be skipped"""
+        now = monotonic()
+        window = self._windows.get(kind)
+        skipped = 0
+        if window is None or now - window[0] >= self.window:
+            if window is not None:
+                skipped = max(window[1] - self.size, 0)
+            window = self._windows[kind] = [now, 0]
+
+        window[1] += 1
+        return skipped if window[1] <= self.size else None
+
+
+handled_errors = ErrorSampler()
+
+
+def log_handled_error(exception: Exception, method: str, path: str):
+    kind = exception.__class__.__name__
+    skipped = handled_errors.sample(kind)
+    if skipped is None:
+        return
+
+    extra = {"error": kind, "method": method, "path": path}
+    if skipped:
+        # Errors of the kind not logged in the previous window
+        extra["skipped"] = skipped
+    logger.info("Handled %s", kind, extra=extra)
+
+
+class RequestIdMiddleware:
+    """Sets the id of each request for its logs,
+    returned in the `X-Request-ID` header"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        id = Headers(scope=scope).get("x-request-id")
+        if id is None or not _REQUEST_ID.fullmatch(id):
+            id = uuid4().hex
+
+        async def send_with_id(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["X-Request-ID"] = id
+            await send(message)
+
+        token = request_id.set(id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
@@ -0,0 +1,301 @@
+"""Always on, low overhead metrics in the prometheus text format
+
+Metrics are plain in-process counters, updated from the event loop
+thread without locks. Each worker process exposes its own values,
+scrape every worker (or use one per container) to aggregate them.
+"""
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Callable, Iterable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Latency buckets (seconds)
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Sql statements kept per request
+MAX_STATEMENTS = 100
+
+
+class Metric(ABC):
+    type: str
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def _labels(self, values: tuple, extra: str = "") -> str:
+        pairs = [
+            f'{name}="{_escape(str(value))}"'
+            for name, value in zip(self.labels, values)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @abstractmethod
+    def samples(self) -> Iterable[str]: ...
+
+    def render(self) -> str:
+        return "\n".join(
+            (
+                f"# HELP {self.name} {self.help}",
+                f"# TYPE {self.name} {self.type}",
+                *self.samples(),
+            )
+        )
+
+
+class Counter(Metric):
+    """Counter updated by the app, or read from `function` when scraped"""
+
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        function: Callable[[], float] | None = None,
+    ):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+        self.function = function
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        if self.function is not None:
+            yield f"{self.name} {self.function()}"
+            return
+        for labels, value in self.values.items():
+            yield f"{self.name}{self._labels(labels)} {value}"
+
+
+class Gauge(Counter):
+    """Gauge set by the app, or read from `function` when scraped"""
+
+    type = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # Per labels, counts of each bucket (not cumulative),
+        # the last one is +Inf, followed by the sum
+        self.values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, counts in self.values.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                bucket = self._labels(labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{bucket} {total}"
+            yield f"{self.name}_sum{self._labels(labels)} {counts[-1]}"
+            yield f"{self.name}_count{self._labels(labels)} {total}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to respond to requests, by route template",
+    labels=("method", "route", "status"),
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests being handled, including open streams",
+    labels=("method",),
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "Time to execute database queries",
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request",
+    "Database queries executed by a request, by route template",
+    labels=("route",),
+    buckets=COUNT_BUCKETS,
+)
+DB_SECONDS_PER_REQUEST = Histogram(
+    "db_duration_per_request_seconds",
+    "Time spent in database queries by a request, by route template",
+    labels=("route",),
+)
+REDIS_COMMAND_SECONDS = Histogram(
+    "redis_command_duration_seconds",
+    "Time to run redis commands, by command",
+    labels=("command",),
+)
+CELERY_PUBLISH_SECONDS = Histogram(
+    "celery_publish_duration_seconds",
+    "Time to send tasks to the broker, by task",
+    labels=("task",),
+)
+
+RATE_LIMIT_DECISIONS = Counter(
+    "rate_limit_decisions_total",
+    "Requests checked against rate limits, by limit, outcome and "
+    "source (redis, or the worker's last answer of redis)",
+    labels=("limit", "outcome", "source"),
+)
+
+IDEMPOTENT_REQUESTS = Counter(
+    "idempotent_requests_total",
+    "Requests with an Idempotency-Key, by outcome: response stored, key "
+    "released (server error), stored response replayed, key used for a "
+    "different request, or timed out waiting for the first request",
+    labels=("outcome",),
+)
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "admission_requests_running",
+    "Requests holding a slot of their class, see app.core.admission",
+    labels=("class",),
+)
+ADMISSION_QUEUED = Gauge(
+    "admission_requests_queued",
+    "Requests waiting for a slot of their class",
+    labels=("class",),
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "admission_wait_seconds",
+    "Time admitted requests waited for a slot, by class",
+    labels=("class",),
+)
+ADMISSION_SHED = Counter(
+    "admission_shed_total",
+    "Requests refused with a 503, by class and reason: queue_full, "
+    "displaced (by a priority request), deadline (expected wait too "
+    "long) or timeout (waited too long)",
+    labels=("class", "reason"),
+)
+
+SINGLE_FLIGHT_CALLS = Counter(
+    "single_flight_calls_total",
+    "Calls of coalesced reads, by read and whether the call ran or "
+    "shared the result of the same call in progress",
+    labels=("read", "outcome"),
+)
+
+
+class RequestStats:
+    __slots__ = ("queries", "query_time", "phases", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        # Seconds spent in each phase, see app.core.timing
+        self.phases: dict[str, float] = {}
+        # Sql statements with their durations
+        self.statements: list[tuple[str, float]] = []
+
+
+# Stats of the request being handled
+request_stats: ContextVar[RequestStats | None] = ContextVar(
+    "request_stats",
+    default=None,
+)
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        status = 500
+        end = None
+
+        # Background tasks run after the response is sent,
+        # they don't count towards the response time
+        async def send_and_record(message: Message):
+            nonlocal status, end
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif not message.get("more_body", False):
+                end = perf_counter()
+            await send(message)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        HTTP_REQUESTS_IN_FLIGHT.inc(method)
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            duration = (end or perf_counter()) - start
+            HTTP_REQUESTS_IN_FLIGHT.dec(method)
+            request_stats.reset(token)
+
+            # Template (/shipment/{id}/events) instead of the
+            # path, unmatched paths share a single series
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+
+            HTTP_REQUEST_SECONDS.observe(duration, method, route, status)
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, route)
+            DB_SECONDS_PER_REQUEST.observe(stats.query_time, route)
+
+
+def instrument_engine(engine: AsyncEngine):
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        context._query_start = perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        duration = perf_counter() - context._query_start
+        DB_QUERY_SECONDS.observe(duration)
+
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_time += duration
+            if len(stats.statements) < MAX_STATEMENTS:
+                stats.statements.append((statement, duration))
@@ -0,0 +1,258 @@
+"""Sampling profiler of the running worker process
+
+A thread wakes up every `interval` seconds and records the stacks of
+the other threads with `sys._current_frames()`, nothing is traced or
+hooked, so the overhead is one stack walk per thread per sample and
+none at all when no profile runs. Profiles are capped in duration and
+only one runs at a time.
+
+Profiles of requests only keep the samples where the event loop is
+running one of the requests picked, by looking for the frame of
+ProfilerMiddleware handling it in the stack. Endpoints and dependencies
+run in the thread pool (sync ones) are not part of these.
+
+Results are written as collapsed stacks (flamegraph.pl, speedscope)
+or as a speedscope file.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+from collections import Counter
+from time import perf_counter
+from types import FrameType
+from typing import Literal
+
+import orjson
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.config import PROJECT_DIR
+from app.core.exceptions import ProfileInProgress
+
+# Longest profile, seconds
+MAX_SECONDS = 60
+# Shortest time between samples, seconds
+MIN_INTERVAL = 0.001
+# Frames kept per stack, from the outermost
+MAX_DEPTH = 128
+
+ProfileFormat = Literal["collapsed", "speedscope"]
+
+_PATH_PREFIXES = sorted(
+    {str(PROJECT_DIR) + os.sep, *(path + os.sep for path in sys.path if path)},
+    key=len,
+    reverse=True,
+)
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    # Module path instead of the full file path
+    for prefix in _PATH_PREFIXES:
+        if filename.startswith(prefix):
+            filename = filename[len(prefix) :]
+            break
+    return f"{code.co_qualname} ({filename}:{code.co_firstlineno})"
+
+
+class Profile:
+    def __init__(self, interval: float, route: str | None = None):
+        self.interval = interval
+        self.route = route
+        self.samples = 0
+        self.duration = 0.0
+        # Stacks, outermost frame first, with their sample counts
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.items()
+        )
+
+    def speedscope(self) -> bytes:
+        frames: dict[str, int] = {}
+        samples = [
+            [frames.setdefault(name, len(frames)) for name in stack]
+            for stack in self.stacks
+        ]
+        # Time between samples, longer than the interval under load
+        weight = self.duration / self.samples if self.samples else self.interval
+        weights = [count * weight for count in self.stacks.values()]
+        title = f"FastShip worker {os.getpid()}" + (
+            f" {self.route}" if self.route else ""
+        )
+        return orjson.dumps(
+            {
+                "$schema": "https://www.speedscope.app/file-format-schema.json",
+                "name": title,
+                "exporter": "fastship",
+                "shared": {"frames": [{"name": name} for name in frames]},
+                "profiles": [
+                    {
+                        "type": "sampled",
+                        "name": title,
+                        "unit": "seconds",
+                        "startValue": 0,
+                        "endValue": sum(weights),
+                        "samples": samples,
+                        "weights": weights,
+                    }
+                ],
+            }
+        )
+
+    def render(self, format: ProfileFormat) -> str | bytes:
+        return self.collapsed() if format == "collapsed" else self.speedscope()
+
+
+class Profiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        # Requests being profiled, by the frame handling them
+        self.route: str | None = None
+        self._remaining = 0
+        self._frames: set[FrameType] = set()
+        self._requests_done: asyncio.Event | None = None
+
+    async def profile(self, seconds: float, interval: float) -> Profile:
+        """Samples every thread of the process for some seconds"""
+        return await self._run(Profile(interval), seconds)
+
+    async def profile_requests(
+        self,
+        route: str,
+        count: int,
+        seconds: float,
+        interval: float,
+    ) -> Profile:
+        """Samples the next `count` requests to a route template,
+        stops early if they are done before `seconds`"""
+        return await self._run(Profile(interval, route), seconds, count)
+
+    async def _run(self, profile: Profile, seconds: float, requests: int = 0):
+        if not self._lock.acquire(blocking=False):
+            raise ProfileInProgress()
+
+        self._stop.clear()
+        thread = threading.Thread(
+            target=self._sample,
+            args=(profile,),
+            name="profiler",
+            daemon=True,
+        )
+        thread.start()
+        try:
+            seconds = min(seconds, MAX_SECONDS)
+            if profile.route is None:
+                await asyncio.sleep(seconds)
+            else:
+                self._requests_done = asyncio.Event()
+                self._remaining = requests
+                self.route = profile.route
+                try:
+                    await asyncio.wait_for(self._requests_done.wait(), seconds)
+                except TimeoutError:
+                    pass
+        finally:
+            self.route = None
+            self._remaining = 0
+            self._requests_done = None
+
+            self._stop.set()
+            await asyncio.to_thread(thread.join)
+            self._lock.release()
+        return profile
+
+    def _sample(self, profile: Profile):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        interval = max(profile.interval, MIN_INTERVAL)
+        requests = profile.route is not None
+        start = perf_counter()
+
+        while not self._stop.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                picked = not requests
+                while frame is not None:
+                    if requests and frame in self._frames:
+                        picked = True
+                    stack.append(frame)
+                    frame = frame.f_back
+                if not picked:
+                    continue
+
+                if thread_id not in names:
+                    names = {
+                        thread.ident: thread.name for thread in threading.enumerate()
+                    }
+                stack.reverse()
+                profile.stacks[
+                    (
+                        names.get(thread_id, str(thread_id)),
+                        *map(_frame_name, stack[:MAX_DEPTH]),
+                    )
+                ] += 1
+            profile.samples += 1
+
+        profile.duration = perf_counter() - start
+
+    def pick(self, scope: Scope) -> bool:
+        """Whether a request is to be profiled, taking a slot if so"""
+        if self._remaining <= 0:
+            return False
+
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                if route.path != self.route:
+                    return False
+                self._remaining -= 1
+                return True
+        return False
+
+    def add_request(self, frame: FrameType):
+        self._frames.add(frame)
+
+    def remove_request(self, frame: FrameType):
+        self._frames.discard(frame)
+        if (
+            self._remaining <= 0
+            and not self._frames
+            and self._requests_done is not None
+        ):
+            self._requests_done.set()
+
+
+profiler = Profiler()
+
+
+class ProfilerMiddleware:
+    """Marks requests picked by a running request profile"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            profiler.route is None
+            or scope["type"] != "http"
+            or not profiler.pick(scope)
+        ):
+            return await self.app(scope, receive, send)
+
+        # Samples with this frame in the stack are of the request
+        frame = sys._getframe()
+        profiler.add_request(frame)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.remove_request(frame)
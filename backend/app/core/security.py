@@ -4,6 +4,8 @@ from pydantic import BaseModel
 
 oauth2_scheme_seller = OAuth2PasswordBearer(tokenUrl="/seller/token", scheme_name="Seller")
 oauth2_scheme_partner = OAuth2PasswordBearer(tokenUrl="/partner/token", scheme_name="Delivery Partner")
+# Endpoints open to both sellers and delivery partners
+oauth2_scheme_client = OAuth2PasswordBearer(tokenUrl="/seller/token", scheme_name="Seller or Delivery Partner")
 
 
 class TokenData(BaseModel):
@@ -0,0 +1,59 @@
+"""Concurrent identical calls of a worker share one call
+
+While a call for a key is in progress, later calls for the same key
+wait for its result (or exception) instead of running it again. The
+result is shared as is, callers must not change it. Nothing is kept
+once the call is done, this is not a cache.
+
+If the running call is cancelled (its client went away), the waiting
+calls don't fail with it, one of them runs the call again.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from app.core.metrics import SINGLE_FLIGHT_CALLS
+
+T = TypeVar("T")
+
+
+class _Abandoned(Exception):
+    pass
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[tuple, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> T:
+        # Futures belong to a loop, celery tasks run in their own
+        key = (asyncio.get_running_loop(), key)
+
+        while (future := self._calls.get(key)) is not None:
+            SINGLE_FLIGHT_CALLS.inc(self.name, "shared")
+            try:
+                # A waiting caller cancelled doesn't cancel the call
+                return await asyncio.shield(future)
+            except _Abandoned:
+                continue
+
+        SINGLE_FLIGHT_CALLS.inc(self.name, "run")
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function()
+        except Exception as exception:
+            future.set_exception(exception)
+            raise
+        except BaseException:
+            # Cancelled, the next waiting caller runs it
+            future.set_exception(_Abandoned())
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+            # Retrieved, not to be logged as never retrieved without waiters
+            if not future.cancelled():
+                future.exception()
@@ -0,0 +1,119 @@
+"""Phase timings of requests
+
+Time spent in auth, db, redis, serialize and render is returned in
+the `Server-Timing` header. Slow requests are kept in a ring buffer
+along with their sql statements, for /admin/slow_requests. Streamed
+responses (events, exports) are timed until they start, not for as
+long as the client keeps reading them.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+
+from fastapi.templating import Jinja2Templates
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import app_settings
+from app.core.metrics import RequestStats, request_stats
+
+# Latest slow requests, oldest are dropped first
+slow_requests: deque[dict] = deque(maxlen=app_settings.SLOW_REQUEST_LOG_SIZE)
+
+
+def add_phase_time(phase: str, seconds: float):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.phases[phase] = stats.phases.get(phase, 0) + seconds
+
+
+# Add time spent in the block to a phase of the current request
+@contextmanager
+def timed(phase: str):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, perf_counter() - start)
+
+
+class TimedTemplates(Jinja2Templates):
+    """Templates recording the time to render them as `render`"""
+
+    def TemplateResponse(self, *args, **kwargs):
+        with timed("render"):
+            return super().TemplateResponse(*args, **kwargs)
+
+
+def _server_timing(stats: RequestStats, total: float) -> str:
+    phases = [
+        f"{phase};dur={seconds * 1000:.1f}"
+        for phase, seconds in stats.phases.items()
+    ]
+    if stats.queries:
+        phases.append(
+            f'db;dur={stats.query_time * 1000:.1f};desc="{stats.queries} queries"'
+        )
+    phases.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(phases)
+
+
+class ServerTimingMiddleware:
+    """Adds the `Server-Timing` header and logs slow requests
+
+    Runs inside app.core.metrics.MetricsMiddleware
+    which collects the stats of the request
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        stats = request_stats.get()
+        if scope["type"] != "http" or stats is None:
+            return await self.app(scope, receive, send)
+
+        status = 500
+        started = end = None
+        start = perf_counter()
+
+        async def send_with_timing(message: Message):
+            nonlocal status, started, end
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                started = perf_counter()
+                MutableHeaders(scope=message).append(
+                    "Server-Timing",
+                    _server_timing(stats, started - start),
+                )
+            elif end is None:
+                # More to come after the first part, a stream
+                end = started if message.get("more_body", False) else perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            duration = (end or perf_counter()) - start
+            if duration >= app_settings.SLOW_REQUEST_THRESHOLD:
+                route = scope.get("route")
+                slow_requests.append(
+                    {
+                        "timestamp": datetime.now(),
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "route": route.path if route is not None else None,
+                        "status": status,
+                        "duration": duration,
+                        "phases": {
+                            **stats.phases,
+                            "db": stats.query_time,
+                        },
+                        "statements": [
+                            {"sql": statement, "duration": seconds}
+                            for statement, seconds in stats.statements
+                        ],
+                    }
+                )
@@ -0,0 +1,357 @@
+"""Distributed traces of requests and celery tasks
+
+Trace context follows the W3C `traceparent` format, it is read from
+incoming requests and sent along with published tasks, so the spans
+of a request and of the tasks it queued end up in the same trace.
+
+Whether a trace is recorded is decided once, at its root. Requests
+not sampled only carry their trace id around, no spans are created
+for their queries, redis commands and outbound calls.
+
+Finished spans are buffered and written by a background thread,
+as json lines to a file or to an otlp/http collector.
+"""
+
+import atexit
+import json
+import logging
+import os
+import random
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import time_ns
+from typing import Any, Iterator
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import app_settings
+
+logger = logging.getLogger(__name__)
+
+# Span kinds, as numbered by otlp
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+PRODUCER = 4
+CONSUMER = 5
+
+# Spans sent to the exporter in one go
+BATCH_SIZE = 512
+# Seconds between exports of a partial batch
+EXPORT_INTERVAL = 5
+# Spans dropped past this many waiting for export
+MAX_QUEUE_SIZE = 20_000
+
+enabled = app_settings.TRACE_EXPORTER != "none"
+
+
+class Span:
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "sampled",
+        "name",
+        "kind",
+        "start",
+        "end",
+        "attributes",
+        "error",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: str | None = None,
+        sampled: bool = True,
+        kind: int = INTERNAL,
+        attributes: dict[str, Any] | None = None,
+    ):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.name = name
+        self.kind = kind
+        self.start = time_ns()
+        self.end = 0
+        self.attributes = attributes or {}
+        self.error: str | None = None
+
+    def child(self, name: str, kind: int = INTERNAL, **attributes) -> "Span":
+        return Span(name, self.trace_id, self.span_id, True, kind, attributes)
+
+    def finish(self):
+        self.end = time_ns()
+        exporter.add(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            # Unset or error
+            "status": {"code": 0}
+            if self.error is None
+            else {"code": 2, "message": self.error},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+# Innermost span of the request or task being handled
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+def parse_traceparent(value: str | None) -> tuple[str, str, bool] | None:
+    """Trace id, parent span id and sampled flag of a `traceparent`"""
+    if not value:
+        return None
+    try:
+        version, trace_id, parent_id, flags = value.strip().split("-")
+        int(trace_id, 16), int(parent_id, 16)
+        sampled = bool(int(flags, 16) & 1)
+    except ValueError:
+        return None
+    if (
+        version == "ff"
+        or len(trace_id) != 32
+        or len(parent_id) != 16
+        or trace_id == "0" * 32
+        or parent_id == "0" * 16
+    ):
+        return None
+    return trace_id.lower(), parent_id.lower(), sampled
+
+
+def start_trace(
+    name: str,
+    traceparent: str | None = None,
+    kind: int = SERVER,
+    **attributes,
+) -> Span:
+    """Root span of a request or task, continuing the
+    trace of `traceparent` if there is a valid one"""
+    context = parse_traceparent(traceparent)
+    if context is not None:
+        trace_id, parent_id, sampled = context
+        sampled = sampled and enabled
+    else:
+        trace_id = f"{random.getrandbits(128):032x}"
+        parent_id = None
+        sampled = enabled and random.random() < app_settings.TRACE_SAMPLE_RATE
+
+    return Span(name, trace_id, parent_id, sampled, kind, attributes)
+
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, **attributes) -> Iterator[Span | None]:
+    """Child span of the current one, if it is being recorded"""
+    parent = current_span.get()
+    if parent is None or not parent.sampled:
+        yield None
+        return
+
+    child = parent.child(name, kind, **attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as error:
+        child.error = repr(error)
+        raise
+    finally:
+        current_span.reset(token)
+        child.finish()
+
+
+def inject(headers: dict):
+    """Add the trace context to headers of an outgoing call or task"""
+    current = current_span.get()
+    if current is not None:
+        headers["traceparent"] = current.traceparent
+
+
+class SpanExporter:
+    """Buffers finished spans, exported by a background thread
+    started on the first span of each process (celery forks)"""
+
+    def __init__(self):
+        self.service = f"{app_settings.APP_NAME.lower()}-api"
+        self._spans: list[Span] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid: int | None = None
+
+    def add(self, span: Span):
+        if not span.sampled:
+            return
+        if self._pid != os.getpid():
+            self._start()
+
+        with self._lock:
+            if len(self._spans) < MAX_QUEUE_SIZE:
+                self._spans.append(span)
+            if len(self._spans) >= BATCH_SIZE:
+                self._wake.set()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._spans = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name="trace-exporter", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(EXPORT_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if not spans:
+            return
+        try:
+            if app_settings.TRACE_EXPORTER == "file":
+                self._write(spans)
+            elif app_settings.TRACE_EXPORTER == "otlp":
+                self._send(spans)
+        except Exception:
+            logger.exception("Failed to export %d spans", len(spans))
+
+    def _write(self, spans: list[Span]):
+        with open(app_settings.TRACE_FILE, "a") as file:
+            file.writelines(
+                json.dumps({"service": self.service, **span.to_otlp()}) + "\n"
+                for span in spans
+            )
+
+    def _send(self, spans: list[Span]):
+        # Only needed by the otlp exporter, slow to import
+        import httpx
+
+        response = httpx.post(
+            app_settings.TRACE_OTLP_ENDPOINT.rstrip("/") + "/v1/traces",
+            json={
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": [
+                                {
+                                    "key": "service.name",
+                                    "value": {"stringValue": self.service},
+                                }
+                            ]
+                        },
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": __name__},
+                                "spans": [span.to_otlp() for span in spans],
+                            }
+                        ],
+                    }
+                ]
+            },
+            timeout=10,
+        )
+        response.raise_for_status()
+
+
+exporter = SpanExporter()
+# Spans still buffered when the process exits
+atexit.register(exporter.flush)
+
+
+class TracingMiddleware:
+    """Root span of each request, continuing the caller's trace"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not enabled:
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        root = start_trace(
+            method,
+            Headers(scope=scope).get("traceparent"),
+            **{"http.request.method": method, "url.path": scope["path"]},
+        )
+
+        async def send_with_status(message: Message):
+            if message["type"] == "http.response.start":
+                root.attributes["http.response.status_code"] = message["status"]
+                if message["status"] >= 500:
+                    root.error = f"HTTP {message['status']}"
+            await send(message)
+
+        token = current_span.set(root)
+        try:
+            await self.app(scope, receive, send_with_status)
+        except BaseException as error:
+            root.error = repr(error)
+            raise
+        finally:
+            current_span.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                root.name = f"{method} {route.path}"
+                root.attributes["http.route"] = route.path
+            root.finish()
+
+
+def trace_engine(engine: AsyncEngine):
+    """Span for each query run by the engine"""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        parent = current_span.get()
+        if parent is not None and parent.sampled:
+            context._span = parent.child(
+                statement.split(None, 1)[0].upper(),
+                CLIENT,
+                **{"db.system": conn.dialect.name, "db.statement": statement},
+            )
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        span = getattr(context, "_span", None)
+        if span is not None:
+            span.finish()
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def handle_error(exception_context):
+        context = exception_context.execution_context
+        span = getattr(context, "_span", None)
+        if span is not None:
+            span.error = repr(exception_context.original_exception)
+            span.finish()
@@ -0,0 +1,137 @@
+import asyncio
+from typing import Generic, Iterable, Sequence, TypeVar
+from uuid import UUID
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import lazyload, raiseload, selectinload
+from sqlalchemy.orm.util import identity_key
+from sqlmodel import SQLModel, select
+
+from app.database.models import DeliveryPartner, Location, Seller, Shipment, Tag
+
+Model = TypeVar("Model", bound=SQLModel)
+
+
+class Loader(Generic[Model]):
+    """Load entities of a model by id, in batches
+
+    Ids asked for within the same event loop tick are resolved with
+    a single `IN (...)` query. Entities already in the session's
+    identity map are returned as is, without a query. Loaded ones
+    are held on to, the identity map only keeps weak references
+    """
+
+    def __init__(self, loaders: "Loaders", model: type[Model], *options):
+        self.loaders = loaders
+        self.model = model
+        self.options = options
+
+        self._loaded: dict[UUID, Model] = {}
+        self._pending: dict[UUID, asyncio.Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def load(self, id: UUID) -> Model | None:
+        entity = self._loaded.get(id) or self.loaders.session.identity_map.get(
+            identity_key(self.model, id)
+        )
+        if entity is not None:
+            return entity
+
+        future = self._pending.get(id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self._pending:
+                # Dispatch once the other ready tasks had their turn
+                loop.call_soon(self._dispatch)
+            future = self._pending[id] = loop.create_future()
+
+        return await future
+
+    async def load_many(self, ids: Iterable[UUID]) -> list[Model | None]:
+        return await asyncio.gather(*(self.load(id) for id in ids))
+
+    def _dispatch(self):
+        batch, self._pending = self._pending, {}
+
+        task = asyncio.create_task(self._resolve(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, batch: dict[UUID, asyncio.Future]):
+        try:
+            # A session can't run queries concurrently
+            async with self.loaders.lock:
+                entities = await self._fetch(list(batch))
+            self._loaded.update(entities)
+            await self._load_related(entities.values())
+        except Exception as error:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for id, future in batch.items():
+            if not future.done():
+                future.set_result(entities.get(id))
+
+    async def _fetch(self, ids: Sequence[UUID]) -> dict[UUID, Model]:
+        entities = await self.loaders.session.scalars(
+            select(self.model).where(self.model.id.in_(ids)).options(*self.options)
+        )
+        return {entity.id: entity for entity in entities}
+
+    async def _load_related(self, entities: Iterable[Model]):
+        pass
+
+
+class ShipmentLoader(Loader[Shipment]):
+    # Seller and partner of shipments come from their own loaders,
+    # many to one lazy loads are then served by the identity map
+    async def _load_related(self, entities: Iterable[Shipment]):
+        shipments = list(entities)
+        await asyncio.gather(
+            self.loaders.sellers.load_many(
+                {shipment.seller_id for shipment in shipments}
+            ),
+            self.loaders.partners.load_many(
+                {shipment.delivery_partner_id for shipment in shipments}
+            ),
+        )
+
+
+class Loaders:
+    """Loaders of a request, sharing its session and identity map
+
+    Collections of sellers and partners are not loaded, they
+    would pull in every shipment of the client
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self.lock = asyncio.Lock()
+
+        self.sellers = Loader(self, Seller, raiseload(Seller.shipments))
+        self.partners = Loader(
+            self,
+            DeliveryPartner,
+            selectinload(DeliveryPartner.servicable_locations).lazyload(
+                Location.delivery_partners
+            ),
+            raiseload(DeliveryPartner.shipments),
+        )
+        # Events and tags of a batch take a query each
+        self.shipments = ShipmentLoader(
+            self,
+            Shipment,
+            selectinload(Shipment.timeline),
+            selectinload(Shipment.tags).lazyload(Tag.shipments),
+            lazyload(Shipment.seller),
+            lazyload(Shipment.delivery_partner),
+        )
+
+
+def get_loaders(session: AsyncSession) -> Loaders:
+    loaders = session.info.get("loaders")
+    if loaders is None:
+        loaders = session.info["loaders"] = Loaders(session)
+    return loaders
@@ -5,6 +5,8 @@ from uuid import UUID, uuid4
 from pydantic import EmailStr
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import BigInteger, Sequence, bindparam, event, func, null, update
+from sqlalchemy.orm import Session, lazyload, object_session
 from sqlmodel import Column, Field, Relationship, SQLModel, select
 
 
@@ -21,7 +23,15 @@ class TagName(str, Enum):
     DOCUMENTS = "documents"
 
     async def tag(self, session: AsyncSession) -> "Tag":
-        return await session.scalar(select(Tag).where(Tag.name == self.value))
+        # Looked up in the session tagging the shipment, like partners by
+        # zip code: a lookup shared with concurrent requests runs in the
+        # first caller's session, its errors would reach the others
+        return await session.scalar(
+            select(Tag)
+            .where(Tag.name == self.value)
+            # Shipments of the tag are not needed to tag a shipment
+            .options(lazyload(Tag.shipments))
+        )
 
 
 class ShipmentStatus(str, Enum):
@@ -95,13 +105,13 @@ class Shipment(SQLModel, table=True):
         sa_relationship_kwargs={"lazy": "selectin"},
     )
 
-    seller_id: UUID = Field(foreign_key="seller.id")
+    seller_id: UUID = Field(foreign_key="seller.id", index=True)
     seller: "Seller" = Relationship(
         back_populates="shipments",
         sa_relationship_kwargs={"lazy": "selectin"},
     )
 
-    delivery_partner_id: UUID = Field(foreign_key="delivery_partner.id")
+    delivery_partner_id: UUID = Field(foreign_key="delivery_partner.id", index=True)
     delivery_partner: "DeliveryPartner" = Relationship(
         back_populates="shipments",
         sa_relationship_kwargs={"lazy": "selectin"},
@@ -123,6 +133,10 @@ class Shipment(SQLModel, table=True):
         return self.timeline[-1].status if len(self.timeline) > 0 else None
 
 
+# Numbers of shipment events, see _number_events_on_commit
+EVENT_SEQ = Sequence("shipment_event_seq")
+
+
 class ShipmentEvent(SQLModel, table=True):
     __tablename__ = "shipment_event"
 
@@ -140,17 +154,89 @@ class ShipmentEvent(SQLModel, table=True):
         )
     )
 
+    # Monotonic change sequence, cursor of the shipment change feeds
+    seq: int | None = Field(
+        default=None,
+        sa_column=Column(
+            BigInteger,
+            EVENT_SEQ,
+            index=True,
+            unique=True,
+        ),
+    )
+
     location: int
     status: ShipmentStatus
     description: str | None = Field(default=None)
 
-    shipment_id: UUID = Field(foreign_key="shipment.id")
+    shipment_id: UUID = Field(foreign_key="shipment.id", index=True)
     shipment: Shipment = Relationship(
         back_populates="timeline",
         sa_relationship_kwargs={"lazy": "selectin"},
     )
 
 
+# Advisory lock numbering events in commit order
+EVENT_SEQ_LOCK = 0x5E0
+
+# Events of a session inserted without a number yet
+_UNNUMBERED_EVENTS = "unnumbered_events"
+
+
+@event.listens_for(ShipmentEvent, "before_insert")
+def _number_event(mapper, connection, shipment_event: ShipmentEvent):
+    if shipment_event.seq is not None:
+        return
+    # Sequences are postgres only, on sqlite (local mode, tests)
+    # the next number is taken in the insert statement itself,
+    # writers take turns so numbers are committed in order
+    if connection.dialect.name == "sqlite":
+        shipment_event.seq = select(
+            func.coalesce(func.max(ShipmentEvent.seq), 0) + 1
+        ).scalar_subquery()
+    else:
+        # Inserted without a number, given one on commit
+        shipment_event.seq = null()
+        object_session(shipment_event).info.setdefault(
+            _UNNUMBERED_EVENTS, []
+        ).append(shipment_event)
+
+
+@event.listens_for(Session, "before_commit")
+def _number_events_on_commit(session: Session):
+    """Numbers the events of a transaction in its last statement
+
+    A number must never be visible before a smaller one still to commit
+    (a cursor would skip it), so transactions numbering events take
+    turns on an advisory lock held until they end. It is taken right
+    before the commit, the rest of the transaction runs alongside
+    others: event writes are limited to one commit at a time, a few
+    hundred to a few thousand a second depending on the commit latency.
+    A lock per seller or partner would not do, a partner's feed has
+    the shipments of many sellers on the one sequence.
+    """
+    session.flush()
+    events = session.info.pop(_UNNUMBERED_EVENTS, None)
+    if not events:
+        return
+
+    connection = session.connection()
+    connection.execute(select(func.pg_advisory_xact_lock(EVENT_SEQ_LOCK)))
+    # Numbered in the order inserted, a single statement for the
+    # usual single event
+    connection.execute(
+        update(ShipmentEvent)
+        .where(ShipmentEvent.id == bindparam("event_id"))
+        .values(seq=EVENT_SEQ.next_value()),
+        [{"event_id": shipment_event.id} for shipment_event in events],
+    )
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_unnumbered_events(session: Session):
+    session.info.pop(_UNNUMBERED_EVENTS, None)
+
+
 class User(SQLModel):
     name: str
 
@@ -285,4 +371,55 @@ class Review(SQLModel, table=True):
     shipment: Shipment = Relationship(
         back_populates="review",
         sa_relationship_kwargs={"lazy": "selectin"},
-    )
\ No newline at end of file
+    )
+
+class WebhookEndpoint(SQLModel, table=True):
+    __tablename__ = "webhook_endpoint"
+
+    id: UUID = Field(
+        sa_column=Column(
+            postgresql.UUID,
+            default=uuid4,
+            primary_key=True,
+        )
+    )
+    created_at: datetime = Field(
+        sa_column=Column(
+            postgresql.TIMESTAMP,
+            default=datetime.now,
+        )
+    )
+
+    url: str
+    # Key to sign deliveries with
+    secret: str = Field(exclude=True)
+    active: bool = Field(default=True)
+    # Deliveries allowed in flight at once
+    max_concurrency: int = Field(default=2)
+
+    seller_id: UUID = Field(foreign_key="seller.id", index=True)
+
+
+class WebhookDeadLetter(SQLModel, table=True):
+    __tablename__ = "webhook_dead_letter"
+
+    id: UUID = Field(
+        sa_column=Column(
+            postgresql.UUID,
+            default=uuid4,
+            primary_key=True,
+        )
+    )
+    created_at: datetime = Field(
+        sa_column=Column(
+            postgresql.TIMESTAMP,
+            default=datetime.now,
+        )
+    )
+
+    # Json batch of events that could not be delivered
+    payload: str
+    error: str
+    attempts: int
+
+    endpoint_id: UUID = Field(foreign_key="webhook_endpoint.id", index=True)
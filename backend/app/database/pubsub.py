@@ -0,0 +1,92 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from redis.exceptions import ConnectionError, RedisError
+
+from app.database.redis import Redis, redis_client
+
+
+class Broadcaster:
+    """Fan out redis pub/sub messages to local subscribers
+
+    All subscribers of a worker share a single pub/sub connection,
+    a redis channel is subscribed only while it has local listeners
+    """
+
+    def __init__(self, redis: Redis, prefix: str, queue_size: int = 32):
+        self.redis = redis
+        self.prefix = prefix
+        self.queue_size = queue_size
+
+        self._queues: dict[str, set[asyncio.Queue]] = {}
+        self._pubsub = None
+        self._reader: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def _channel(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    async def publish(self, key: str, message: str):
+        await self.redis.publish(self._channel(key), message)
+
+    @asynccontextmanager
+    async def subscribe(self, key: str) -> AsyncIterator[asyncio.Queue]:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+
+        async with self._lock:
+            if self._pubsub is None:
+                self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+
+            if key not in self._queues:
+                await self._pubsub.subscribe(self._channel(key))
+            self._queues.setdefault(key, set()).add(queue)
+
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+
+        try:
+            yield queue
+        finally:
+            async with self._lock:
+                queues = self._queues.get(key, set())
+                queues.discard(queue)
+                if not queues:
+                    self._queues.pop(key, None)
+                    try:
+                        await self._pubsub.unsubscribe(self._channel(key))
+                    except RedisError:
+                        # Dropped with the connection, not resubscribed
+                        pass
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=None)
+            except ConnectionError:
+                # Resubscribe local listeners once redis is back
+                await asyncio.sleep(1)
+                async with self._lock:
+                    await self._pubsub.reset()
+                    if self._queues:
+                        await self._pubsub.subscribe(
+                            *(self._channel(key) for key in self._queues)
+                        )
+                continue
+
+            if message is None or message["type"] != "message":
+                continue
+
+            key = message["channel"].removeprefix(f"{self.prefix}:")
+            for queue in self._queues.get(key, ()):
+                # Slow consumers lose the oldest message
+                # instead of holding up everyone else
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(message["data"])
+
+
+shipment_events = Broadcaster(
+    redis_client(0, decode_responses=True),
+    prefix="shipment_events",
+)
@@ -0,0 +1,179 @@
+"""Token bucket rate limits, shared by the api workers
+
+Buckets are kept in redis and taken from by a lua script, so a limit
+holds across workers. Each worker also remembers the last answer of
+redis for a bucket, for a moment: a client well under its limit is let
+through without a round trip to redis (the tokens it takes are charged
+with the next one) and a client told to retry later is refused until
+then without asking redis again.
+"""
+
+import math
+from dataclasses import dataclass
+from time import monotonic
+
+from redis.exceptions import RedisError
+
+from app.config import app_settings, security_settings
+from app.core.logging import logger
+from app.core.metrics import RATE_LIMIT_DECISIONS
+from app.database.redis import Redis, redis_client
+
+# KEYS[1] bucket, ARGV capacity, tokens added per second and tokens
+# taken by requests let through since the last call. Returns whether
+# the request is allowed, milliseconds until it would be and the
+# tokens left.
+TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local pending = tonumber(ARGV[3])
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "at")
+local tokens = tonumber(bucket[1]) or capacity
+local at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - at) * rate) - pending
+
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "at", tostring(now))
+-- Gone once full again
+redis.call("PEXPIRE", KEYS[1], math.max(1, math.ceil((capacity - tokens) / rate * 1000)))
+
+return {allowed, math.max(0, math.ceil((1 - tokens) / rate * 1000)), tostring(tokens)}
+"""
+
+
+def _token_bucket(call, keys: list[bytes], args: list[bytes]):
+    """TOKEN_BUCKET for the in-memory redis of app.fakes.redis"""
+    capacity, rate, pending = map(float, args)
+
+    seconds, micros = call("TIME")
+    now = int(seconds) + int(micros) / 1_000_000
+
+    tokens, at = call("HMGET", keys[0], "tokens", "at")
+    tokens = capacity if tokens is None else float(tokens)
+    at = now if at is None else float(at)
+    tokens = min(capacity, tokens + max(0, now - at) * rate) - pending
+
+    allowed = 0
+    if tokens >= 1:
+        tokens -= 1
+        allowed = 1
+
+    call("HSET", keys[0], "tokens", repr(tokens), "at", repr(now))
+    call("PEXPIRE", keys[0], max(1, math.ceil((capacity - tokens) / rate * 1000)))
+
+    return [allowed, max(0, math.ceil((1 - tokens) / rate * 1000)), repr(tokens).encode()]
+
+
+if app_settings.LOCAL_MODE:
+    from app.fakes.redis import register_script
+
+    register_script(TOKEN_BUCKET, _token_bucket)
+
+
+_rate_limits = redis_client(4)
+
+# Seconds an answer of redis is relied on by a worker
+LOCAL_TTL = 1
+# Share of a bucket a worker lets clients take without asking redis
+LOCAL_SHARE = 0.5
+# Buckets remembered by a worker, the oldest answers are dropped
+LOCAL_SIZE = 10_000
+
+
+@dataclass(slots=True)
+class _Answer:
+    # Tokens left in the bucket when redis answered
+    tokens: float
+    # Monotonic seconds until the answer is relied on, or
+    # until the client can retry when it was refused
+    until: float
+    refused: bool
+    # Tokens taken since without asking redis, not charged yet
+    pending: int = 0
+
+
+class TokenBucket:
+    """Up to `capacity` requests at once, refilled at
+    `capacity` requests per `period` seconds"""
+
+    def __init__(
+        self,
+        name: str,
+        capacity: int,
+        period: float = 60,
+        redis: Redis = _rate_limits,
+    ):
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.script = redis.register_script(TOKEN_BUCKET)
+        self._answers: dict[str, _Answer] = {}
+
+    async def take(self, key: str) -> float:
+        """Takes a token for a request of `key`, returns 0 if the
+        request is allowed, otherwise seconds until it would be"""
+        now = monotonic()
+        answer = self._answers.get(key)
+
+        if answer is not None and now < answer.until:
+            if answer.refused:
+                RATE_LIMIT_DECISIONS.inc(self.name, "refused", "local")
+                return answer.until - now
+            if answer.tokens - answer.pending - 1 >= self.capacity * LOCAL_SHARE:
+                answer.pending += 1
+                RATE_LIMIT_DECISIONS.inc(self.name, "allowed", "local")
+                return 0
+
+        # Charged with this call, others may take more meanwhile
+        pending = 0
+        if answer is not None:
+            pending, answer.pending = answer.pending, 0
+
+        try:
+            allowed, retry_after, tokens = await self.script(
+                keys=[f"rate_limit:{self.name}:{key}"],
+                args=[self.capacity, self.rate, pending],
+            )
+        except RedisError:
+            # Let requests through, limits are a guard, not a dependency
+            if answer is not None:
+                answer.pending += pending
+            logger.warning("Rate limit %s not checked", self.name, exc_info=True)
+            return 0
+
+        # Taken while waiting for redis, charged with the next call
+        current = self._answers.pop(key, None)
+        if len(self._answers) >= LOCAL_SIZE:
+            del self._answers[next(iter(self._answers))]
+
+        retry_after = 0 if allowed else retry_after / 1000
+        self._answers[key] = _Answer(
+            float(tokens),
+            until=monotonic() + (retry_after or LOCAL_TTL),
+            refused=not allowed,
+            pending=current.pending if current is not None else 0,
+        )
+        RATE_LIMIT_DECISIONS.inc(
+            self.name, "allowed" if allowed else "refused", "redis"
+        )
+        return retry_after
+
+
+# Limits of the api, requests per minute
+login_by_ip = TokenBucket("login:ip", security_settings.LOGIN_LIMIT_IP)
+login_by_account = TokenBucket("login:account", security_settings.LOGIN_LIMIT_ACCOUNT)
+password_reset_by_ip = TokenBucket(
+    "password_reset:ip", security_settings.PASSWORD_RESET_LIMIT_IP
+)
+password_reset_by_account = TokenBucket(
+    "password_reset:account", security_settings.PASSWORD_RESET_LIMIT_ACCOUNT
+)
@@ -1,20 +1,47 @@
+import asyncio
+from time import perf_counter
 from uuid import UUID
-from redis.asyncio import Redis
 
-from app.config import db_settings
+from redis import asyncio as redis
 
+from app.config import app_settings, db_settings
+from app.core.metrics import REDIS_COMMAND_SECONDS
+from app.core.timing import add_phase_time
+from app.core.tracing import CLIENT, span
 
-_token_blacklist = Redis(
-    host=db_settings.REDIS_HOST,
-    port=db_settings.REDIS_PORT,
-    db=0,
-)
-_shipment_verification_codes = Redis(
-    host=db_settings.REDIS_HOST,
-    port=db_settings.REDIS_PORT,
-    db=1,
-    decode_responses=True,
-)
+
+class Redis(redis.Redis):
+    """Redis client recording the latency of commands,
+    for /metrics, the redis phase of requests and traces"""
+
+    async def execute_command(self, *args, **options):
+        start = perf_counter()
+        try:
+            with span(f"redis {args[0]}", CLIENT, **{"db.system": "redis"}):
+                return await super().execute_command(*args, **options)
+        finally:
+            duration = perf_counter() - start
+            REDIS_COMMAND_SECONDS.observe(duration, args[0])
+            add_phase_time("redis", duration)
+
+
+def redis_client(db: int, **kwargs) -> Redis:
+    """Client of a redis database, kept in the process in local mode"""
+    if app_settings.LOCAL_MODE:
+        from app.fakes.redis import fake_redis
+
+        return fake_redis(Redis, db=db, **kwargs)
+
+    return Redis(
+        host=db_settings.REDIS_HOST,
+        port=db_settings.REDIS_PORT,
+        db=db,
+        **kwargs,
+    )
+
+
+_token_blacklist = redis_client(0)
+_shipment_verification_codes = redis_client(1, decode_responses=True)
 
 async def add_jti_to_blacklist(jti: str):
     await _token_blacklist.set(jti, "blacklisted")
@@ -27,4 +54,40 @@ async def add_shipment_verification_code(id: UUID, code: int):
     await _shipment_verification_codes.set(str(id), code)
 
 async def get_shipment_verification_code(id: UUID) -> str:
-    return str(await _shipment_verification_codes.get(str(id)))
\ No newline at end of file
+    return str(await _shipment_verification_codes.get(str(id)))
+
+_webhook_queue = redis_client(3, decode_responses=True)
+
+# Seconds to wait for more events before delivering a batch
+WEBHOOK_BATCH_WINDOW = 2
+
+
+async def queue_webhook_event(endpoint_id: UUID, event: str) -> bool:
+    """Queue an event for delivery to a webhook endpoint
+
+    Returns true if no delivery is scheduled for
+    the endpoint yet and one has to be scheduled
+    """
+    async with _webhook_queue.pipeline() as pipe:
+        pipe.rpush(f"webhook:{endpoint_id}:queue", event)
+        pipe.set(
+            f"webhook:{endpoint_id}:scheduled",
+            1,
+            nx=True,
+            ex=WEBHOOK_BATCH_WINDOW * 10,
+        )
+        _, scheduled = await pipe.execute()
+    return bool(scheduled)
+
+
+# Clients of the module, kept connected for the life of the process
+_clients = (_token_blacklist, _shipment_verification_codes, _webhook_queue)
+
+
+async def connect_clients():
+    """Opens a connection of each client ahead of the first request"""
+    await asyncio.gather(*(client.ping() for client in _clients))
+
+
+async def close_clients():
+    await asyncio.gather(*(client.aclose() for client in _clients))
@@ -1,16 +1,30 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from sqlmodel import SQLModel
 
 from app.config import db_settings
+from app.core.metrics import instrument_engine
+from app.core.tracing import trace_engine
 
 # Create a database engine to connect with database
 engine = create_async_engine(
     # database type/dialect and file name
-    url=db_settings.POSTGRES_URL,
+    url=db_settings.DATABASE_URL,
     # Log sql queries
     # echo=True,
 )
+# Query counts and durations for /metrics
+instrument_engine(engine)
+trace_engine(engine)
+
+# Engine for worker tasks, each task runs in its own
+# event loop so connections can't be pooled across them
+worker_engine = create_async_engine(
+    url=db_settings.DATABASE_URL,
+    poolclass=NullPool,
+)
+trace_engine(worker_engine)
 
 
 async def create_db_tables():
@@ -19,11 +33,12 @@ async def create_db_tables():
         await connection.run_sync(SQLModel.metadata.create_all)
 
 
-async def get_session():
-    async_session = sessionmaker(
-        bind=engine, class_=AsyncSession, expire_on_commit=False,
-    )
+async_session = sessionmaker(
+    bind=engine, class_=AsyncSession, expire_on_commit=False,
+)
 
+
+async def get_session():
     async with async_session() as session:
         yield session
 
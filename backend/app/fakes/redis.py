@@ -0,0 +1,505 @@
+"""In-memory stand-in for redis, inside the process
+
+A connection class for redis-py's asyncio client, so clients built
+with `fake_redis()` keep everything of the real client (subclasses,
+pipelines, pub/sub) and only the socket is replaced by a dict. Meant
+for benchmarks and local runs without a redis server, data is shared
+by all fake clients of the process and lost on exit.
+
+Supports the commands the app uses: strings and counters, expiry,
+lists, hashes, pub/sub and transactions (WATCH is not enforced).
+Lua is not run, scripts of the app have a python twin registered with
+`register_script()` that EVAL and EVALSHA run in its place.
+Commands run one at a time, clients can be used from several threads
+and event loops (like celery tasks run eagerly in the local profile).
+"""
+
+import asyncio
+import fnmatch
+import hashlib
+import threading
+from collections import deque
+from time import monotonic, time
+from typing import Any, Callable
+
+from redis.asyncio import ConnectionPool, Redis
+from redis.asyncio.connection import AbstractConnection
+from redis.exceptions import NoScriptError, ResponseError
+
+Reply = Any
+
+# Runs a command from a script, like redis.call
+Call = Callable[..., Reply]
+# Python twin of a lua script, called with (call, keys, args)
+Script = Callable[[Call, list[bytes], list[bytes]], Reply]
+
+_OK = b"OK"
+_WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+class _Database:
+    def __init__(self):
+        self.data: dict[bytes, bytes | list | dict] = {}
+        # Deadlines of keys with a ttl, monotonic seconds
+        self.expiry: dict[bytes, float] = {}
+
+    def get(self, key: bytes, kind: type | None = None):
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= monotonic():
+            self.delete(key)
+        value = self.data.get(key)
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise ResponseError(_WRONGTYPE)
+        return value
+
+    def set(self, key: bytes, value, keep_ttl: bool = False):
+        self.data[key] = value
+        if not keep_ttl:
+            self.expiry.pop(key, None)
+
+    def delete(self, key: bytes) -> bool:
+        self.expiry.pop(key, None)
+        return self.data.pop(key, None) is not None
+
+
+class FakeServer:
+    """Data of all fake clients, by database number"""
+
+    def __init__(self):
+        self.databases: dict[int, _Database] = {}
+        self.channels: dict[bytes, set["FakeConnection"]] = {}
+        self.lock = threading.RLock()
+
+    def database(self, db: int) -> _Database:
+        return self.databases.setdefault(db, _Database())
+
+    def flushall(self):
+        with self.lock:
+            self.databases.clear()
+
+
+server = FakeServer()
+
+# Twins of the scripts, by sha1 of their lua source
+_scripts: dict[bytes, Script] = {}
+
+
+def register_script(source: str, function: Script):
+    """Runs `function` in place of the lua `source`, it gets redis.call
+    as `call` and is run atomically, like scripts in redis"""
+    _scripts[hashlib.sha1(source.encode()).hexdigest().encode()] = function
+
+
+def _int(value: bytes) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ResponseError("value is not an integer or out of range") from None
+
+
+class FakeConnection(AbstractConnection):
+    """Connection running commands against the in-memory server"""
+
+    def __init__(self, *, server: FakeServer = server, **kwargs):
+        super().__init__(**kwargs)
+        self.server = server
+        self._connected = False
+        self._replies: deque[Reply] = deque()
+        self._waiter: asyncio.Future | None = None
+        # Commands queued by MULTI until EXEC
+        self._transaction: list[list[bytes]] | None = None
+        self._subscriptions: set[bytes] = set()
+
+    def repr_pieces(self):
+        return [("server", "fake"), ("db", self.db)]
+
+    def _host_error(self) -> str:
+        return "fake redis"
+
+    @property
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def _connect(self):
+        self._connected = True
+
+    async def on_connect(self):
+        # No handshake, the database is picked by number
+        pass
+
+    async def disconnect(self, nowait: bool = False):
+        self._connected = False
+        self._replies.clear()
+        self._transaction = None
+        with self.server.lock:
+            for channel in self._subscriptions:
+                self.server.channels.get(channel, set()).discard(self)
+            self._subscriptions.clear()
+
+    async def check_health(self):
+        pass
+
+    def pack_command(self, *args) -> list[list[bytes]]:
+        return [[self.encoder.encode(arg) for arg in args]]
+
+    def pack_commands(self, commands) -> list[list[bytes]]:
+        return [packed for args in commands for packed in self.pack_command(*args)]
+
+    async def send_packed_command(self, command, check_health: bool = True):
+        if not self.is_connected:
+            await self.connect()
+        with self.server.lock:
+            for args in command:
+                # Multi word commands like `CLIENT SETINFO` are sent as one
+                name, *rest = args[0].split()
+                self._reply(self._run([name.upper(), *rest, *args[1:]]))
+
+    async def can_read_destructive(self) -> bool:
+        return bool(self._replies)
+
+    async def read_response(
+        self,
+        disable_decoding: bool = False,
+        timeout: float | None = None,
+        *,
+        disconnect_on_error: bool = True,
+        push_request: bool | None = False,
+    ):
+        if not self._replies:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                # Unless published from another thread in the meantime
+                if not self._replies:
+                    await asyncio.wait_for(self._waiter, timeout)
+            except TimeoutError:
+                return None
+            finally:
+                self._waiter = None
+
+        reply = self._replies.popleft()
+        if isinstance(reply, ResponseError):
+            raise reply
+        if self.encoder.decode_responses and not disable_decoding:
+            return self._decode(reply)
+        return reply
+
+    def _decode(self, reply: Reply) -> Reply:
+        if isinstance(reply, list):
+            return [self._decode(item) for item in reply]
+        if isinstance(reply, bytes):
+            return self.encoder.decode(reply)
+        return reply
+
+    def _reply(self, reply: Reply):
+        self._replies.append(reply)
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            # Published from another loop or thread, like a celery task
+            waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+
+    @staticmethod
+    def _wake(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def _run(self, args: list[bytes]) -> Reply:
+        name = args[0].decode()
+        if self._transaction is not None and name not in ("EXEC", "DISCARD", "MULTI"):
+            self._transaction.append(args)
+            return b"QUEUED"
+
+        command: Callable | None = getattr(self, f"_{name.lower()}", None)
+        if command is None:
+            return ResponseError(f"unknown command '{name}'")
+        try:
+            return command(*args[1:])
+        except ResponseError as error:
+            return error
+        except TypeError:
+            return ResponseError(f"wrong number of arguments for '{name}' command")
+
+    @property
+    def _db(self) -> _Database:
+        return self.server.database(int(self.db))
+
+    ### Connection and transactions
+
+    def _ping(self, message: bytes | None = None):
+        if self._subscriptions:
+            return [b"pong", message or b""]
+        return message if message is not None else b"PONG"
+
+    def _select(self, db: bytes):
+        self.db = _int(db)
+        return _OK
+
+    def _client(self, *args):
+        return _OK
+
+    def _multi(self):
+        if self._transaction is not None:
+            return ResponseError("MULTI calls can not be nested")
+        self._transaction = []
+        return _OK
+
+    def _exec(self):
+        if self._transaction is None:
+            return ResponseError("EXEC without MULTI")
+        commands, self._transaction = self._transaction, None
+        return [self._run(args) for args in commands]
+
+    def _discard(self):
+        self._transaction = None
+        return _OK
+
+    def _watch(self, *keys):
+        return _OK
+
+    def _unwatch(self):
+        return _OK
+
+    def _flushdb(self, *args):
+        self.server.databases.pop(int(self.db), None)
+        return _OK
+
+    def _flushall(self, *args):
+        self.server.flushall()
+        return _OK
+
+    def _time(self):
+        now = time()
+        return [str(int(now)).encode(), str(int(now % 1 * 1_000_000)).encode()]
+
+    ### Scripts
+
+    def _script(self, subcommand: bytes, *args):
+        match subcommand.upper():
+            case b"LOAD":
+                (source,) = args
+                sha = hashlib.sha1(source).hexdigest().encode()
+                if sha not in _scripts:
+                    raise ResponseError("no python twin registered for the script")
+                return sha
+            case b"EXISTS":
+                return [int(sha.lower() in _scripts) for sha in args]
+            case b"FLUSH":
+                return _OK
+        raise ResponseError(f"unknown subcommand '{subcommand.decode()}'")
+
+    def _eval(self, source: bytes, numkeys: bytes, *args):
+        return self._evalsha(self._script(b"LOAD", source), numkeys, *args)
+
+    def _evalsha(self, sha: bytes, numkeys: bytes, *args):
+        script = _scripts.get(sha.lower())
+        if script is None:
+            raise NoScriptError("NOSCRIPT No matching script")
+        numkeys = _int(numkeys)
+        return script(self._call, list(args[:numkeys]), list(args[numkeys:]))
+
+    def _call(self, *args) -> Reply:
+        reply = self._run([self.encoder.encode(arg) for arg in args])
+        if isinstance(reply, ResponseError):
+            raise reply
+        return reply
+
+    ### Keys
+
+    def _exists(self, *keys):
+        return sum(self._db.get(key) is not None for key in keys)
+
+    def _del(self, *keys):
+        return sum(self._db.delete(key) for key in keys)
+
+    def _keys(self, pattern: bytes):
+        db = self._db
+        return [
+            key
+            for key in list(db.data)
+            if fnmatch.fnmatchcase(key, pattern) and db.get(key) is not None
+        ]
+
+    def _expire(self, key: bytes, seconds: bytes, *flags):
+        return self._pexpire(key, str(_int(seconds) * 1000).encode())
+
+    def _pexpire(self, key: bytes, milliseconds: bytes, *flags):
+        db = self._db
+        if db.get(key) is None:
+            return 0
+        db.expiry[key] = monotonic() + _int(milliseconds) / 1000
+        return 1
+
+    def _pttl(self, key: bytes):
+        db = self._db
+        if db.get(key) is None:
+            return -2
+        deadline = db.expiry.get(key)
+        return -1 if deadline is None else round((deadline - monotonic()) * 1000)
+
+    def _ttl(self, key: bytes):
+        ttl = self._pttl(key)
+        return ttl if ttl < 0 else round(ttl / 1000)
+
+    ### Strings
+
+    def _get(self, key: bytes):
+        return self._db.get(key, bytes)
+
+    def _mget(self, *keys):
+        db = self._db
+        return [
+            value if isinstance(value := db.get(key), bytes) else None
+            for key in keys
+        ]
+
+    def _set(self, key: bytes, value: bytes, *options):
+        db = self._db
+        options = [option.upper() for option in options]
+        old = db.get(key)
+        if b"GET" in options and old is not None and not isinstance(old, bytes):
+            raise ResponseError(_WRONGTYPE)
+        reply = old if b"GET" in options else _OK
+
+        if (b"NX" in options and old is not None) or (
+            b"XX" in options and old is None
+        ):
+            return old if b"GET" in options else None
+
+        db.set(key, value, keep_ttl=b"KEEPTTL" in options)
+        for unit, scale in ((b"EX", 1000), (b"PX", 1)):
+            if unit in options:
+                ttl = _int(options[options.index(unit) + 1]) * scale
+                db.expiry[key] = monotonic() + ttl / 1000
+        return reply
+
+    def _incrby(self, key: bytes, amount: bytes):
+        db = self._db
+        value = _int(db.get(key, bytes) or b"0") + _int(amount)
+        db.set(key, str(value).encode(), keep_ttl=True)
+        return value
+
+    def _incr(self, key: bytes):
+        return self._incrby(key, b"1")
+
+    def _decrby(self, key: bytes, amount: bytes):
+        return self._incrby(key, str(-_int(amount)).encode())
+
+    def _decr(self, key: bytes):
+        return self._incrby(key, b"-1")
+
+    ### Lists
+
+    def _push(self, key: bytes, values: tuple[bytes, ...], left: bool) -> int:
+        db = self._db
+        items = db.get(key, list)
+        if items is None:
+            items = []
+            db.set(key, items)
+        if left:
+            items[:0] = reversed(values)
+        else:
+            items.extend(values)
+        return len(items)
+
+    def _rpush(self, key: bytes, *values):
+        return self._push(key, values, left=False)
+
+    def _lpush(self, key: bytes, *values):
+        return self._push(key, values, left=True)
+
+    def _lpop(self, key: bytes, count: bytes | None = None):
+        db = self._db
+        items = db.get(key, list)
+        if not items:
+            return None
+        popped = items[: 1 if count is None else _int(count)]
+        del items[: len(popped)]
+        if not items:
+            db.delete(key)
+        return popped[0] if count is None else popped
+
+    def _llen(self, key: bytes):
+        return len(self._db.get(key, list) or ())
+
+    def _lrange(self, key: bytes, start: bytes, stop: bytes):
+        items = self._db.get(key, list) or []
+        stop = _int(stop)
+        return items[_int(start) : None if stop == -1 else stop + 1]
+
+    ### Hashes
+
+    def _hset(self, key: bytes, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError
+        db = self._db
+        fields = db.get(key, dict)
+        if fields is None:
+            fields = {}
+            db.set(key, fields)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in fields
+            fields[field] = value
+        return added
+
+    def _hget(self, key: bytes, field: bytes):
+        return (self._db.get(key, dict) or {}).get(field)
+
+    def _hmget(self, key: bytes, *fields_):
+        fields = self._db.get(key, dict) or {}
+        return [fields.get(field) for field in fields_]
+
+    def _hgetall(self, key: bytes):
+        fields = self._db.get(key, dict) or {}
+        return [item for pair in fields.items() for item in pair]
+
+    def _hdel(self, key: bytes, *fields_):
+        db = self._db
+        fields = db.get(key, dict) or {}
+        deleted = sum(fields.pop(field, None) is not None for field in fields_)
+        if not fields:
+            db.delete(key)
+        return deleted
+
+    def _hincrby(self, key: bytes, field: bytes, amount: bytes):
+        db = self._db
+        fields = db.get(key, dict)
+        if fields is None:
+            fields = {}
+            db.set(key, fields)
+        value = _int(fields.get(field, b"0")) + _int(amount)
+        fields[field] = str(value).encode()
+        return value
+
+    ### Pub/sub
+
+    def _publish(self, channel: bytes, message: bytes):
+        subscribers = self.server.channels.get(channel, ())
+        for connection in subscribers:
+            connection._reply([b"message", channel, message])
+        return len(subscribers)
+
+    def _subscribe(self, *channels):
+        for channel in channels:
+            self.server.channels.setdefault(channel, set()).add(self)
+            self._subscriptions.add(channel)
+            self._reply([b"subscribe", channel, len(self._subscriptions)])
+        # Each channel has its own reply, already queued
+        return self._replies.pop()
+
+    def _unsubscribe(self, *channels):
+        channels = channels or tuple(self._subscriptions) or (None,)
+        for channel in channels:
+            if channel is not None:
+                self._subscriptions.discard(channel)
+                self.server.channels.get(channel, set()).discard(self)
+            self._reply([b"unsubscribe", channel, len(self._subscriptions)])
+        return self._replies.pop()
+
+
+def fake_redis(cls: type[Redis] = Redis, db: int = 0, **kwargs) -> Redis:
+    """Client of the in-memory server, `cls` can be a subclass of
+    redis.asyncio.Redis and `kwargs` are options of its connections
+    (like decode_responses)"""
+    return cls(
+        connection_pool=ConnectionPool(connection_class=FakeConnection, db=db, **kwargs)
+    )
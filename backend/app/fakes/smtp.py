@@ -0,0 +1,118 @@
+"""Local stand-in for the smtp server
+
+Run with `fastapi run app/fakes/smtp.py --port 8092`, it accepts mail
+on port 1025 (`SMTP_PORT`). Point the app to it with `MAIL_SERVER` and
+`MAIL_PORT=1025` and `MAIL_STARTTLS=false`, any credentials are accepted.
+Received mails are recorded and listed at `GET /messages`.
+
+In local mode (`LOCAL_MODE`) mails are not sent, the app records them
+in its own process and serves the listing at `/local/smtp/messages`.
+"""
+
+import asyncio
+import os
+import re
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email import message_from_bytes, policy
+
+from fastapi import FastAPI
+
+SMTP_PORT = int(os.getenv("SMTP_PORT", "1025"))
+# Oldest mails are dropped past this many, for long load tests
+MAX_MESSAGES = 10_000
+
+messages: deque[dict] = deque(maxlen=MAX_MESSAGES)
+
+# Address of `MAIL FROM:<address> BODY=8BITMIME`
+_ADDRESS = re.compile(r"<([^>]*)>")
+
+
+def _address(argument: str) -> str:
+    match = _ADDRESS.search(argument)
+    return match.group(1) if match else argument.partition(":")[2].strip()
+
+
+def record(sender: str, recipients: list[str], data: bytes):
+    mail = message_from_bytes(data, policy=policy.default)
+    body = mail.get_body(preferencelist=("html", "plain"))
+    messages.append(
+        {
+            "from": sender,
+            "to": recipients,
+            "subject": mail["subject"],
+            "body": body.get_content() if body is not None else "",
+            "received_at": datetime.now(timezone.utc).isoformat(),
+        }
+    )
+
+
+async def _session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    async def reply(line: str):
+        writer.write(f"{line}\r\n".encode())
+        await writer.drain()
+
+    sender = ""
+    recipients: list[str] = []
+    await reply("220 fake smtp ready")
+
+    try:
+        while line := await reader.readline():
+            command, _, argument = line.decode().strip().partition(" ")
+            match command.upper():
+                case "EHLO":
+                    await reply("250-fake smtp\r\n250-8BITMIME\r\n250 AUTH PLAIN LOGIN")
+                case "HELO":
+                    await reply("250 fake smtp")
+                case "AUTH":
+                    await reply("235 accepted")
+                case "MAIL":
+                    sender = _address(argument)
+                    recipients = []
+                    await reply("250 ok")
+                case "RCPT":
+                    recipients.append(_address(argument))
+                    await reply("250 ok")
+                case "DATA":
+                    await reply("354 end with <CRLF>.<CRLF>")
+                    data = bytearray()
+                    while (line := await reader.readline()) not in (b".\r\n", b""):
+                        # Undo dot stuffing
+                        data += line[1:] if line.startswith(b"..") else line
+                    record(sender, recipients, bytes(data))
+                    await reply("250 queued")
+                case "RSET":
+                    sender, recipients = "", []
+                    await reply("250 ok")
+                case "NOOP":
+                    await reply("250 ok")
+                case "QUIT":
+                    await reply("221 bye")
+                    break
+                case _:
+                    await reply("502 not implemented")
+    finally:
+        writer.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    server = await asyncio.start_server(_session, "0.0.0.0", SMTP_PORT)
+    async with server:
+        yield
+
+
+app = FastAPI(title="Fake SMTP", lifespan=lifespan)
+
+
+### Received mails, latest last
+@app.get("/messages")
+async def get_messages(to: str | None = None):
+    return [message for message in messages if to is None or to in message["to"]]
+
+
+### Clear received mails
+@app.delete("/messages")
+async def clear_messages():
+    messages.clear()
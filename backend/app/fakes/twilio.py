@@ -0,0 +1,83 @@
+"""Local stand-in for the twilio messages api
+
+Run with `fastapi run app/fakes/twilio.py --port 8090` and set
+`TWILIO_API_URL=http://localhost:8090` to send sms offline.
+Sent messages are recorded and listed at `GET /messages`.
+
+In local mode (`LOCAL_MODE`) the app uses `Client` instead, recording
+in its own process, and serves the listing at `/local/twilio/messages`.
+"""
+
+from datetime import datetime, timezone
+from typing import Annotated
+from uuid import uuid4
+
+from fastapi import FastAPI, Form, status
+
+app = FastAPI(title="Fake Twilio")
+
+messages: list[dict] = []
+
+
+def record_message(account_sid: str, to: str, from_: str, body: str) -> dict:
+    now = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S +0000")
+    message = {
+        "sid": f"SM{uuid4().hex}",
+        "account_sid": account_sid,
+        "to": to,
+        "from": from_,
+        "body": body,
+        "status": "queued",
+        "num_segments": "1",
+        "direction": "outbound-api",
+        "date_created": now,
+        "date_updated": now,
+        "api_version": "2010-04-01",
+    }
+    messages.append(message)
+    return message
+
+
+class _Messages:
+    def __init__(self, account_sid: str):
+        self.account_sid = account_sid
+
+    def create(self, to: str, from_: str, body: str) -> dict:
+        return record_message(self.account_sid, to, from_, body)
+
+    async def create_async(self, to: str, from_: str, body: str) -> dict:
+        return self.create(to, from_, body)
+
+
+class Client:
+    """Stand-in for twilio.rest.Client in the same process,
+    messages are recorded without going over http"""
+
+    def __init__(self, account_sid: str):
+        self.messages = _Messages(account_sid)
+
+
+### Create a message, same shape as twilio's response
+@app.post(
+    "/2010-04-01/Accounts/{account_sid}/Messages.json",
+    status_code=status.HTTP_201_CREATED,
+)
+async def create_message(
+    account_sid: str,
+    to: Annotated[str, Form(alias="To")],
+    from_: Annotated[str, Form(alias="From")],
+    body: Annotated[str, Form(alias="Body")],
+):
+    return record_message(account_sid, to, from_, body)
+
+
+### Recorded messages, latest last
+@app.get("/messages")
+async def get_messages(to: str | None = None):
+    return [message for message in messages if to is None or message["to"] == to]
+
+
+### Clear recorded messages
+@app.delete("/messages")
+async def clear_messages():
+    messages.clear()
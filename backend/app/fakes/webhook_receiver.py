@@ -0,0 +1,69 @@
+"""Local receiver for seller webhook deliveries
+
+Run with `fastapi run app/fakes/webhook_receiver.py --port 8091` and
+register `http://localhost:8091/hooks` as a seller webhook. Set
+`WEBHOOK_SECRET` to the secret returned on registration to verify
+signatures. Received batches are listed at `GET /hooks`. Tests post
+to it in-process through httpx's ASGITransport.
+"""
+
+import hmac
+import json
+import os
+
+from fastapi import FastAPI, Header, Request, Response, status
+
+from app.utils import sign_webhook_payload
+
+app = FastAPI(title="Webhook Receiver")
+
+deliveries: list[dict] = []
+# Responses to fail with before accepting deliveries again
+failures = {"remaining": 0}
+
+
+### Receive a batch of events
+@app.post("/hooks")
+async def receive(
+    request: Request,
+    x_fastship_timestamp: int = Header(),
+    x_fastship_signature: str = Header(),
+):
+    body = await request.body()
+
+    secret = os.getenv("WEBHOOK_SECRET")
+    if secret and not hmac.compare_digest(
+        x_fastship_signature,
+        "sha256=" + sign_webhook_payload(secret, x_fastship_timestamp, body),
+    ):
+        return Response(status_code=status.HTTP_401_UNAUTHORIZED)
+
+    if failures["remaining"] > 0:
+        failures["remaining"] -= 1
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    deliveries.append(
+        {
+            "timestamp": x_fastship_timestamp,
+            "events": json.loads(body)["events"],
+        }
+    )
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+### Received batches, latest last
+@app.get("/hooks")
+async def get_deliveries():
+    return deliveries
+
+
+### Fail the next deliveries to exercise retries
+@app.post("/hooks/fail")
+async def fail_next(count: int = 1):
+    failures["remaining"] = count
+
+
+### Clear received batches
+@app.delete("/hooks")
+async def clear_deliveries():
+    deliveries.clear()
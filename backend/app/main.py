@@ -1,12 +1,25 @@
+import sys
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.routing import APIRoute
 from scalar_fastapi import get_scalar_api_reference
 
+from app.api.idempotency import IdempotencyMiddleware
 from app.api.router import master_router
 from app.api.tag import APITag
+from app.api.warmup import warm_up
+from app.config import app_settings
+from app.core import metrics
+from app.core.admission import AdmissionMiddleware
+from app.core.timing import ServerTimingMiddleware
+from app.core.tracing import TracingMiddleware
 from app.core.exceptions import add_exception_handlers
-# from app.core.logging import logger
+from app.core.logging import RequestIdMiddleware
+from app.core.profiler import ProfilerMiddleware
+from app.database import redis
+from app.database.session import create_db_tables, engine
 
 description = """
 Delivery Management System for sellers and delivery agents
@@ -39,39 +52,109 @@ tags_metadata = [
 def custom_generate_unique_id_function(route: APIRoute) -> str:
     return route.name
 
-app = FastAPI(
-    title="FastShip",
-    description=description,
-    docs_url=None,
-    redoc_url=None,
-    version="0.1.0",
-    openapi_tags=tags_metadata,
-    # generate_unique_id_function=custom_generate_unique_id_function,
-)
-
-# Add CORS middleware to allow requests from the frontend
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:5173"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Add all endpoints
-app.include_router(master_router)
-
-# Add custom exception handlers
-add_exception_handlers(app)
-
-@app.get('/')
-def root():
-    return {"message": "Welcome to FastShip API!"}
-
-# Scalar API Documentation
-@app.get("/docs", include_in_schema=False)
-def get_scalar_docs():
-    return get_scalar_api_reference(
-        openapi_url=app.openapi_url,
-        title="Scalar API",
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if app_settings.LOCAL_MODE:
+        # Tables of the sqlite database
+        await create_db_tables()
+
+    # Ready once pools are open and first queries ran
+    await warm_up()
+    yield
+
+    # Release pooled notification clients, if any were used
+    notification = sys.modules.get("app.services.notification")
+    if notification is not None:
+        await notification.close_async_twilio_client()
+    await redis.close_clients()
+    await engine.dispose()
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(
+        title="FastShip",
+        description=description,
+        docs_url=None,
+        redoc_url=None,
+        version="0.1.0",
+        openapi_tags=tags_metadata,
+        lifespan=lifespan,
+        # generate_unique_id_function=custom_generate_unique_id_function,
     )
+
+    # Requests wait for a slot of their class (reads, writes, logins,
+    # pages, exports) and are shed with a 503 once waiting too long
+    app.add_middleware(AdmissionMiddleware)
+
+    # Retries of shipment changes with an `Idempotency-Key`
+    # get the response of the first request instead of running.
+    # Outside admission, retries waiting for it don't hold a slot
+    app.add_middleware(
+        IdempotencyMiddleware,
+        routes=(("POST", "/shipment/"), ("PATCH", "/shipment/")),
+    )
+
+    # Add CORS middleware to allow requests from the frontend
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["http://localhost:5173"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Marks requests picked by /admin/profile/requests
+    app.add_middleware(ProfilerMiddleware)
+
+    # Server-Timing header and slow request log, runs
+    # inside the metrics middleware collecting the timings
+    app.add_middleware(ServerTimingMiddleware)
+
+    # Record request latencies and db usage for /metrics
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    # Root span of requests, continuing the trace of a `traceparent`
+    app.add_middleware(TracingMiddleware)
+
+    # Id of the request in its logs and the `X-Request-ID` header
+    app.add_middleware(RequestIdMiddleware)
+
+    # Add all endpoints
+    app.include_router(master_router)
+
+    # Add custom exception handlers
+    add_exception_handlers(app)
+
+    if app_settings.LOCAL_MODE:
+        from app.fakes import smtp, twilio
+
+        # Mails and sms recorded instead of sent
+        app.mount("/local/smtp", smtp.app)
+        app.mount("/local/twilio", twilio.app)
+
+    @app.get('/')
+    def root():
+        return {"message": "Welcome to FastShip API!"}
+
+    # Prometheus metrics of this worker process
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        return Response(
+            metrics.render(),
+            media_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+    # Scalar API Documentation
+    @app.get("/docs", include_in_schema=False)
+    def get_scalar_docs():
+        return get_scalar_api_reference(
+            openapi_url=app.openapi_url,
+            title="Scalar API",
+        )
+
+    return app
+
+
+# Found by `fastapi run`
+app = create_app()
@@ -2,12 +2,19 @@ from uuid import UUID
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import SQLModel
 
+from app.database.loaders import Loaders, get_loaders
+
 
 class BaseService:
     def __init__(self, model, session: AsyncSession):
         self.model = model
         self.session = session
 
+    # Batching loaders of the session, shared with the dependencies
+    @property
+    def loaders(self) -> Loaders:
+        return get_loaders(self.session)
+
     async def _get(self, id: UUID):
         return await self.session.get(self.model, id)
     
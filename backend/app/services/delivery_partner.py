@@ -1,5 +1,5 @@
-from typing import Sequence
-
+from sqlalchemy import func
+from sqlalchemy.orm import lazyload
 from sqlmodel import select
 
 from app.api.schemas.delivery_partner import DeliveryPartnerCreate
@@ -25,21 +25,37 @@ class DeliveryPartnerService(UserService):
             )
         return await self._update(partner)
 
-    async def get_partner_by_zipcode(self, zipcode: int) -> Sequence[DeliveryPartner]:
-        return (
-            await self.session.scalars(
-                select(DeliveryPartner)
-                .join(DeliveryPartner.servicable_locations)
-                .where(Location.zip_code == zipcode)
+    # Partners serving a zip code, with their handling capacity left.
+    # Not shared with concurrent lookups, the capacity is read in the
+    # transaction assigning the shipment
+    async def get_partner_by_zipcode(
+        self, zipcode: int
+    ) -> list[tuple[DeliveryPartner, int]]:
+        rows = await self.session.execute(
+            select(DeliveryPartner, func.count(Shipment.id))
+            .join(DeliveryPartner.servicable_locations)
+            .outerjoin(DeliveryPartner.shipments)
+            .where(Location.zip_code == zipcode)
+            .group_by(DeliveryPartner.id)
+            # Counted instead of loading every shipment of the partners
+            .options(
+                lazyload(DeliveryPartner.servicable_locations),
+                lazyload(DeliveryPartner.shipments),
             )
-        ).all()
-    
+        )
+        # Shipments counted like DeliveryPartner.active_shipments
+        return [
+            (partner, partner.max_handling_capacity - shipments)
+            for partner, shipments in rows
+        ]
+
     async def assign_shipment(self, shipment: Shipment):
         eligible_partners = await self.get_partner_by_zipcode(shipment.destination)
 
-        for partner in eligible_partners:
-            if partner.current_handling_capacity > 0:
-                partner.shipments.append(shipment)
+        for partner, capacity in eligible_partners:
+            if capacity > 0:
+                # Shipments of the partner are not loaded for it
+                shipment.delivery_partner = partner
                 return partner
 
         # If no eliglible partners found or
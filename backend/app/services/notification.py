@@ -1,27 +1,137 @@
+import asyncio
+from email.message import Message
+from email.utils import getaddresses
+from functools import cache
+from urllib.parse import urlsplit
+
 from fastapi import BackgroundTasks
 from fastapi_mail import ConnectionConfig, FastMail, MessageSchema, MessageType
+from fastapi_mail.fastmail import email_dispatched
 from pydantic import EmailStr
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client
 
-from app.config import notification_settings
+from app.config import app_settings, notification_settings
+from app.core.tracing import CLIENT, span
 from app.utils import TEMPLATE_DIR
 
 
-class NotificationService:
-    def __init__(self, tasks: BackgroundTasks):
-        self.tasks = tasks
-        self.fastmail = FastMail(
-            ConnectionConfig(
-                **notification_settings.model_dump(
-                    exclude=["TWILIO_SID", "TWILIO_AUTH_TOKEN", "TWILIO_NUMBER"]
-                ),
-                TEMPLATE_FOLDER=TEMPLATE_DIR,
-            )
+def _twilio_url(url: str) -> str:
+    # Redirect twilio api calls to the configured
+    # base url (e.g. a local fake twilio server)
+    if not notification_settings.TWILIO_API_URL:
+        return url
+
+    base = urlsplit(notification_settings.TWILIO_API_URL)
+    return urlsplit(url)._replace(scheme=base.scheme, netloc=base.netloc).geturl()
+
+
+class _TwilioHttpClient(TwilioHttpClient):
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, _twilio_url(url), *args, **kwargs)
+
+
+class _AsyncTwilioHttpClient(AsyncTwilioHttpClient):
+    async def request(self, method, url, *args, **kwargs):
+        return await super().request(method, _twilio_url(url), *args, **kwargs)
+
+
+def _record_mail(message: Message):
+    from app.fakes import smtp
+
+    smtp.record(
+        message["From"],
+        [address for _, address in getaddresses(message.get_all("To", []))],
+        message.as_bytes(),
+    )
+
+
+# Process wide mail client, the connection
+# config is validated only once
+@cache
+def get_fastmail() -> FastMail:
+    if app_settings.LOCAL_MODE:
+        # Mails are rendered but only recorded
+        email_dispatched.connect(_record_mail)
+
+    return FastMail(
+        ConnectionConfig(
+            **notification_settings.model_dump(
+                exclude={
+                    "TWILIO_SID",
+                    "TWILIO_AUTH_TOKEN",
+                    "TWILIO_NUMBER",
+                    "TWILIO_API_URL",
+                    "NOTIFICATION_TIMEOUT",
+                }
+            ),
+            TEMPLATE_FOLDER=TEMPLATE_DIR,
+            TIMEOUT=int(notification_settings.NOTIFICATION_TIMEOUT),
+            SUPPRESS_SEND=int(app_settings.LOCAL_MODE),
         )
-        self.twilio_client = Client(
+    )
+
+
+# Process wide blocking twilio client with a pooled
+# http session, for use in worker tasks and threads
+@cache
+def get_twilio_client() -> Client:
+    if app_settings.LOCAL_MODE:
+        return _local_twilio_client()
+
+    return Client(
+        notification_settings.TWILIO_SID,
+        notification_settings.TWILIO_AUTH_TOKEN,
+        http_client=_TwilioHttpClient(
+            pool_connections=True,
+            timeout=notification_settings.NOTIFICATION_TIMEOUT,
+        ),
+    )
+
+
+# Messages are recorded in the process in local mode
+@cache
+def _local_twilio_client():
+    from app.fakes import twilio
+
+    return twilio.Client(notification_settings.TWILIO_SID)
+
+
+_async_twilio_clients: dict[asyncio.AbstractEventLoop, Client] = {}
+
+
+# Non blocking twilio client, the pooled aiohttp session
+# is bound to the running event loop so one is kept per loop
+def get_async_twilio_client() -> Client:
+    if app_settings.LOCAL_MODE:
+        return _local_twilio_client()
+
+    loop = asyncio.get_running_loop()
+
+    client = _async_twilio_clients.get(loop)
+    if client is None:
+        client = _async_twilio_clients[loop] = Client(
             notification_settings.TWILIO_SID,
             notification_settings.TWILIO_AUTH_TOKEN,
+            http_client=_AsyncTwilioHttpClient(
+                pool_connections=True,
+                timeout=notification_settings.NOTIFICATION_TIMEOUT,
+            ),
         )
+    return client
+
+
+async def close_async_twilio_client():
+    client = _async_twilio_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.http_client.close()
+
+
+class NotificationService:
+    def __init__(self, tasks: BackgroundTasks):
+        self.tasks = tasks
+        self.fastmail = get_fastmail()
 
     async def send_email(
         self,
@@ -30,7 +140,7 @@ class NotificationService:
         body: str,
     ):
         self.tasks.add_task(
-            self.fastmail.send_message,
+            self._send_message,
             message=MessageSchema(
                 recipients=recipients,
                 subject=subject,
@@ -47,7 +157,7 @@ class NotificationService:
         template_name: str,
     ):
         self.tasks.add_task(
-            self.fastmail.send_message,
+            self._send_message,
             message=MessageSchema(
                 recipients=recipients,
                 subject=subject,
@@ -58,8 +168,17 @@ class NotificationService:
         )
 
     async def send_sms(self, to: str, body: str):
-        self.twilio_client.messages.create(
-            from_=notification_settings.TWILIO_NUMBER,
-            to=to,
-            body=body,
-        )
+        # Sent after the response, without blocking the event loop
+        self.tasks.add_task(self._send_sms, to=to, body=body)
+
+    async def _send_message(self, *args, **kwargs):
+        with span("smtp send", CLIENT):
+            await self.fastmail.send_message(*args, **kwargs)
+
+    async def _send_sms(self, to: str, body: str):
+        with span("twilio send sms", CLIENT):
+            await get_async_twilio_client().messages.create_async(
+                from_=notification_settings.TWILIO_NUMBER,
+                to=to,
+                body=body,
+            )
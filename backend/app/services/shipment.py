@@ -1,11 +1,35 @@
+from collections import defaultdict
 from datetime import datetime, timedelta
+from typing import AsyncIterator, Sequence
 from uuid import UUID
 
+from sqlalchemy import ColumnElement, Row, Select, Subquery, and_, func, or_
 from sqlalchemy.ext.asyncio import AsyncSession
-
-from app.api.schemas.shipment import ShipmentCreate, ShipmentUpdate
+from sqlmodel import select
+
+from app.api.schemas.shipment import ShipmentCreate, ShipmentUpdate, ShipmentView
+from app.api.serialization import (
+    ShipmentData,
+    ShipmentEventRecord,
+    TagRecord,
+    shipment_event_read,
+    shipment_read,
+    sparse_shipment_read,
+    tag_read,
+)
 from app.core.exceptions import ClientNotAuthorized, EntityNotFound, InvalidToken
-from app.database.models import DeliveryPartner, Review, Seller, Shipment, ShipmentStatus, TagName
+from app.core.singleflight import SingleFlight
+from app.database.models import (
+    DeliveryPartner,
+    Review,
+    Seller,
+    Shipment,
+    ShipmentEvent,
+    ShipmentStatus,
+    ShipmentTag,
+    Tag,
+    TagName,
+)
 from app.database.redis import get_shipment_verification_code
 from app.services.shipment_event import ShipmentEventService
 from app.utils import decode_url_safe_token
@@ -14,6 +38,21 @@ from .base import BaseService
 from .delivery_partner import DeliveryPartnerService
 
 
+FULL_VIEW = ShipmentView()
+
+# Shipment reads in progress, by id and view
+_reads = SingleFlight("shipment.read")
+
+# Shipment columns selectable by a view
+SHIPMENT_COLUMNS = {
+    "id": Shipment.id,
+    "content": Shipment.content,
+    "weight": Shipment.weight,
+    "destination": Shipment.destination,
+    "estimated_delivery": Shipment.estimated_delivery,
+}
+
+
 class ShipmentService(BaseService):
     def __init__(
         self,
@@ -27,11 +66,240 @@ class ShipmentService(BaseService):
 
     # Get a shipment by id
     async def get(self, id: UUID) -> Shipment | None:
-        shipment = await self._get(id)
+        shipment = await self.loaders.shipments.load(id)
         if not shipment:
             raise EntityNotFound()
         return shipment
 
+    # Get a shipment by id as response data, concurrent
+    # reads of a shipment share one load
+    async def read(self, id: UUID, view: ShipmentView = FULL_VIEW) -> ShipmentData:
+        shipments = await _reads.do(
+            (id, view.fields, view.timeline_depth),
+            lambda: self._read(Shipment.id == id, view=view),
+        )
+        if not shipments:
+            raise EntityNotFound()
+        return shipments[id]
+
+    # Get all shipments of a seller or partner as response data
+    async def read_all(
+        self,
+        seller: Seller | None = None,
+        partner: DeliveryPartner | None = None,
+        view: ShipmentView = FULL_VIEW,
+    ) -> list[ShipmentData]:
+        return list(
+            (
+                await self._read(
+                    Shipment.seller_id == seller.id
+                    if seller
+                    else Shipment.delivery_partner_id == partner.id,
+                    view=view,
+                )
+            ).values()
+        )
+
+    # Get shipments by ids as response data, that the client
+    # (seller or partner) has access to
+    async def read_many(
+        self,
+        ids: Sequence[UUID],
+        client_id: UUID,
+    ) -> dict[UUID, ShipmentData | None]:
+        shipments = await self._read(
+            Shipment.id.in_(ids),
+            or_(
+                Shipment.seller_id == client_id,
+                Shipment.delivery_partner_id == client_id,
+            ),
+        )
+        return {id: shipments.get(id) for id in ids}
+
+    # Stream shipments of a seller in batches as response data,
+    # rows are read from a server side cursor. Each batch takes one
+    # more query for tags, and one for timelines deeper than the
+    # latest event, which is joined otherwise (see _shape)
+    async def stream(
+        self,
+        seller: Seller,
+        view: ShipmentView = FULL_VIEW,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[list[ShipmentData]]:
+        condition = Shipment.seller_id == seller.id
+        ids = select(Shipment.id).where(condition)
+
+        result = await self.session.stream(
+            self._query(ids, view)
+            .where(condition)
+            .order_by(Shipment.created_at)
+            .execution_options(yield_per=batch_size)
+        )
+        async for rows in result.partitions():
+            shipments = await self._shape(rows, [row.id for row in rows], view)
+            yield list(shipments.values())
+
+    # Read shipments from flat rows with a fixed number of queries,
+    # loading only what the view asks for
+    async def _read(
+        self,
+        *conditions: ColumnElement[bool],
+        view: ShipmentView = FULL_VIEW,
+    ) -> dict[UUID, ShipmentData]:
+        ids = select(Shipment.id).where(*conditions)
+
+        rows = (
+            await self.session.execute(
+                self._query(ids, view)
+                .where(*conditions)
+                .order_by(Shipment.created_at)
+            )
+        ).all()
+        if not rows:
+            return {}
+
+        return await self._shape(rows, ids, view)
+
+    # Shipment columns of the view, status and the latest
+    # event are joined into the same query
+    def _query(self, ids: Select, view: ShipmentView) -> Select:
+        query = select(
+            *(
+                column
+                for name, column in SHIPMENT_COLUMNS.items()
+                if name in view.fields
+            )
+        )
+        if not self._joins_latest_event(view):
+            return query
+
+        with_timeline = "timeline" in view.fields
+        latest = self._ranked_events(ids)
+        return query.add_columns(
+            *(
+                column.label(f"event_{column.name}")
+                for column in latest.c
+                if column.name != "rank"
+                and (with_timeline or column.name == "status")
+            )
+        ).outerjoin(
+            latest,
+            and_(latest.c.shipment_id == Shipment.id, latest.c.rank == 1),
+        )
+
+    def _joins_latest_event(self, view: ShipmentView) -> bool:
+        if "timeline" in view.fields:
+            return view.timeline_depth == 1
+        return "status" in view.fields
+
+    # Response data from shipment rows, longer timelines
+    # and tags take a query each
+    async def _shape(
+        self,
+        rows: Sequence[Row],
+        ids: Select | Sequence[UUID],
+        view: ShipmentView,
+    ) -> dict[UUID, ShipmentData]:
+        if "timeline" not in view.fields:
+            timelines = {}
+        elif self._joins_latest_event(view):
+            timelines = {
+                row.id: [shipment_event_read(row, prefix="event_")]
+                if row.event_id
+                else []
+                for row in rows
+            }
+        else:
+            timelines = await self._get_timelines(ids, view.timeline_depth)
+
+        tags = await self._get_tags(ids) if "tags" in view.fields else {}
+
+        if view.is_full:
+            return {
+                row.id: shipment_read(row, timelines[row.id], tags[row.id])
+                for row in rows
+            }
+        return {
+            row.id: sparse_shipment_read(
+                row,
+                view.fields,
+                timelines.get(row.id, []),
+                tags.get(row.id, []),
+            )
+            for row in rows
+        }
+
+    # Events of shipments ranked from latest (1) to oldest
+    def _ranked_events(self, ids: Select | Sequence[UUID]) -> Subquery:
+        return (
+            select(
+                *ShipmentEvent.__table__.columns,
+                func.row_number()
+                .over(
+                    partition_by=ShipmentEvent.shipment_id,
+                    order_by=ShipmentEvent.created_at.desc(),
+                )
+                .label("rank"),
+            )
+            .where(ShipmentEvent.shipment_id.in_(ids))
+            .subquery()
+        )
+
+    async def _get_timelines(
+        self,
+        ids: Select | Sequence[UUID],
+        depth: int | None = None,
+    ) -> dict[UUID, list[ShipmentEventRecord]]:
+        timelines = defaultdict(list)
+
+        if depth is None:
+            query = select(*ShipmentEvent.__table__.columns).where(
+                ShipmentEvent.shipment_id.in_(ids)
+            )
+            created_at = ShipmentEvent.created_at
+        else:
+            ranked = self._ranked_events(ids)
+            query = select(ranked).where(ranked.c.rank <= depth)
+            created_at = ranked.c.created_at
+
+        rows = await self.session.execute(query.order_by(created_at))
+        for row in rows:
+            timelines[row.shipment_id].append(shipment_event_read(row))
+
+        return timelines
+
+    async def _get_tags(
+        self,
+        ids: Select | Sequence[UUID],
+    ) -> dict[UUID, list[TagRecord]]:
+        tags = defaultdict(list)
+
+        rows = await self.session.execute(
+            select(ShipmentTag.shipment_id, Tag.name, Tag.instruction)
+            .join(Tag, Tag.id == ShipmentTag.tag_id)
+            .where(ShipmentTag.shipment_id.in_(ids))
+        )
+        for row in rows:
+            tags[row.shipment_id].append(tag_read(row))
+
+        return tags
+
+    # Shipments changed since the cursor, of a seller or partner
+    async def get_changes(
+        self,
+        since: int,
+        limit: int,
+        seller: Seller | None = None,
+        partner: DeliveryPartner | None = None,
+    ) -> dict:
+        return await self.event_service.get_changes(
+            Shipment.seller_id == seller.id
+            if seller
+            else Shipment.delivery_partner_id == partner.id,
+            since,
+            limit,
+        )
+
     # Add a new shipment
     async def add(self, shipment_create: ShipmentCreate, seller: Seller) -> Shipment:
         new_shipment = Shipment(
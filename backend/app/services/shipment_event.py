@@ -1,11 +1,23 @@
 from random import randint
 
+from kombu.exceptions import OperationalError
+from redis.exceptions import RedisError
+from sqlalchemy import ColumnElement
+from sqlmodel import select
+
 from app.config import app_settings
+from app.core.logging import logger
 from app.database.models import Shipment, ShipmentEvent, ShipmentStatus
-from app.database.redis import add_shipment_verification_code
+from app.database.pubsub import shipment_events
+from app.database.redis import (
+    WEBHOOK_BATCH_WINDOW,
+    add_shipment_verification_code,
+    queue_webhook_event,
+)
 from app.services.base import BaseService
+from app.services.webhook import WebhookService
 from app.utils import generate_url_safe_token
-from app.worker.tasks import send_email_with_template, send_sms
+from app.worker.tasks import deliver_webhooks, send_email_with_template, send_sms
 
 
 class ShipmentEventService(BaseService):
@@ -39,13 +51,74 @@ class ShipmentEventService(BaseService):
 
         await self._notify(shipment, status)
 
-        return await self._add(new_event)
+        event = await self._add(new_event)
+
+        data = event.model_dump_json()
+        # The event is committed, a fan out failing doesn't fail the
+        # request (a retry would add the event and notify again)
+        try:
+            # Push to clients streaming the shipment timeline
+            await shipment_events.publish(str(shipment.id), data)
+            await self._notify_webhooks(shipment, data)
+        except (RedisError, OperationalError):
+            logger.warning(
+                "Fan out of event %s failed",
+                event.id,
+                exc_info=True,
+                extra={"shipment_id": str(shipment.id)},
+            )
+
+        return event
 
     async def get_latest_event(self, shipment: Shipment):
         timeline = shipment.timeline
         timeline.sort(key=lambda event: event.created_at)
         return timeline[-1]
 
+    async def get_changes(
+        self,
+        condition: ColumnElement[bool],
+        since: int,
+        limit: int,
+    ) -> dict:
+        rows = (
+            await self.session.execute(
+                select(
+                    ShipmentEvent.seq,
+                    ShipmentEvent.shipment_id,
+                    ShipmentEvent.status,
+                    ShipmentEvent.location,
+                    ShipmentEvent.created_at,
+                )
+                .join(Shipment, Shipment.id == ShipmentEvent.shipment_id)
+                # Numbered in commit order (see models._number_events_on_commit),
+                # no event can show up later behind the cursor
+                .where(condition, ShipmentEvent.seq > since)
+                .order_by(ShipmentEvent.seq)
+                .limit(limit + 1)
+            )
+        ).all()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        # Only the latest change of each shipment
+        latest = {row.shipment_id: row for row in rows}
+
+        return {
+            "changes": [
+                {
+                    "id": row.shipment_id,
+                    "status": row.status,
+                    "location": row.location,
+                    "timestamp": row.created_at,
+                }
+                for row in sorted(latest.values(), key=lambda row: row.seq)
+            ],
+            "cursor": rows[-1].seq if rows else since,
+            "has_more": has_more,
+        }
+
     def _generate_description(self, status: ShipmentStatus, location: int):
         match status:
             case ShipmentStatus.placed:
@@ -59,6 +132,20 @@ class ShipmentEventService(BaseService):
             case _:  # and ShipmentStatus.in_transit
                 return f"scanned at {location}"
 
+    async def _notify_webhooks(self, shipment: Shipment, data: str):
+        endpoint_ids = await WebhookService(self.session).get_active_ids(
+            shipment.seller_id
+        )
+
+        for endpoint_id in endpoint_ids:
+            # Events are batched, only the first one in
+            # a window schedules the delivery
+            if await queue_webhook_event(endpoint_id, data):
+                deliver_webhooks.apply_async(
+                    kwargs={"endpoint_id": str(endpoint_id)},
+                    countdown=WEBHOOK_BATCH_WINDOW,
+                )
+
     async def _notify(self, shipment: Shipment, status: ShipmentStatus):
         
         if status == ShipmentStatus.in_transit:
@@ -1,13 +1,18 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from uuid import UUID
 
 from passlib.context import CryptContext
 from passlib.exc import PasswordValueError
 from sqlalchemy import select
+from sqlalchemy.orm import raiseload
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import app_settings
 from app.core.exceptions import BadCredentials, BadPassword, ClientNotVerified, InvalidToken
+from app.core.metrics import Gauge
 from app.database.models import User
 from app.utils import (
     decode_url_safe_token,
@@ -23,6 +28,31 @@ password_context = CryptContext(
     deprecated="auto",
 )
 
+# Bcrypt is slow on purpose, hash and verify passwords
+# in threads instead of blocking the event loop
+password_executor = ThreadPoolExecutor(
+    max_workers=os.cpu_count(),
+    thread_name_prefix="bcrypt",
+)
+
+Gauge(
+    "password_hash_queue_depth",
+    "Password hashes and verifications waiting for a bcrypt thread",
+    function=lambda: password_executor._work_queue.qsize(),
+)
+
+
+async def hash_password(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(
+        password_executor, password_context.hash, password
+    )
+
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(
+        password_executor, password_context.verify, password, password_hash
+    )
+
 
 class UserService(BaseService):
     def __init__(self, model: User, session: AsyncSession):
@@ -33,7 +63,7 @@ class UserService(BaseService):
         try:
             user = self.model(
                 **data,
-                password_hash=password_context.hash(data["password"]),
+                password_hash=await hash_password(data["password"]),
             )
         except PasswordValueError:
             raise BadPassword()
@@ -72,14 +102,18 @@ class UserService(BaseService):
 
     async def _get_by_email(self, email) -> User | None:
         return await self.session.scalar(
-            select(self.model).where(self.model.email == email)
+            select(self.model)
+            .where(self.model.email == email)
+            # Only columns of the user are needed, its collections
+            # would pull in every shipment of the client
+            .options(raiseload("*"))
         )
 
     async def _generate_token(self, email, password) -> str:
         # Validate the credentials
         user = await self._get_by_email(email)
 
-        if user is None or not password_context.verify(
+        if user is None or not await verify_password(
             password,
             user.password_hash,
         ):
@@ -123,7 +157,7 @@ class UserService(BaseService):
             return False
 
         user = await self._get(UUID(token_data["id"]))
-        user.password_hash = password_context.hash(password)
+        user.password_hash = await hash_password(password)
 
         await self._update(user)
 
@@ -0,0 +1,338 @@
+import asyncio
+import ipaddress
+import secrets
+import socket
+import time
+from random import random
+from typing import Sequence
+from urllib.parse import urlsplit
+from uuid import UUID, uuid4
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+
+from app.api.schemas.webhook import WebhookCreate
+from app.config import app_settings
+from app.core import tracing
+from app.core.exceptions import (
+    ClientNotAuthorized,
+    EntityNotFound,
+    WebhookUrlNotAllowed,
+)
+from app.database.models import Seller, WebhookDeadLetter, WebhookEndpoint
+from app.database.redis import Redis, redis_client
+from app.database.session import worker_engine
+from app.utils import sign_webhook_payload
+
+from .base import BaseService
+
+# Max events sent in a single delivery
+WEBHOOK_BATCH_SIZE = 50
+# Deliveries attempted before the batch is dead lettered
+WEBHOOK_MAX_ATTEMPTS = 8
+# Retry delays grow exponentially from base up to max (seconds)
+WEBHOOK_BACKOFF_BASE = 2
+WEBHOOK_BACKOFF_MAX = 600
+WEBHOOK_TIMEOUT = 10
+# Seconds a worker holds a batch it delivers, past it (the worker
+# died) the batch is taken over by the next delivery to the endpoint
+WEBHOOK_LEASE = WEBHOOK_TIMEOUT * 6
+
+# KEYS[1] queue of the endpoint, KEYS[2] hash of its batches to the
+# time their lease ends. ARGV id of a new batch, events per batch, the
+# current time, the end of the lease (unix seconds) and the prefix of
+# batch keys. Takes over a batch whose lease ended or moves the next
+# events of the queue to a new batch. Returns the batch id with its
+# events, nothing when there are none.
+CLAIM_BATCH = """
+local now = tonumber(ARGV[3])
+local leases = redis.call("HGETALL", KEYS[2])
+for i = 1, #leases, 2 do
+    if tonumber(leases[i + 1]) < now then
+        redis.call("HSET", KEYS[2], leases[i], ARGV[4])
+        return {leases[i], redis.call("LRANGE", ARGV[5] .. leases[i], 0, -1)}
+    end
+end
+
+local events = redis.call("LPOP", KEYS[1], ARGV[2])
+if not events then
+    return nil
+end
+redis.call("RPUSH", ARGV[5] .. ARGV[1], unpack(events))
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[4])
+return {ARGV[1], events}
+"""
+
+
+def _claim_batch(call, keys: list[bytes], args: list[bytes]):
+    """CLAIM_BATCH for the in-memory redis of app.fakes.redis"""
+    id, size, now, lease, prefix = args
+
+    leases = call("HGETALL", keys[1])
+    for batch, until in zip(leases[::2], leases[1::2]):
+        if float(until) < float(now):
+            call("HSET", keys[1], batch, lease)
+            return [batch, call("LRANGE", prefix + batch, 0, -1)]
+
+    events = call("LPOP", keys[0], size)
+    if not events:
+        return None
+    call("RPUSH", prefix + id, *events)
+    call("HSET", keys[1], id, lease)
+    return [id, events]
+
+
+if app_settings.LOCAL_MODE:
+    from app.fakes.redis import register_script
+
+    register_script(CLAIM_BATCH, _claim_batch)
+
+
+class WebhookService(BaseService):
+    def __init__(self, session: AsyncSession):
+        super().__init__(WebhookEndpoint, session)
+
+    async def add(self, webhook: WebhookCreate, seller: Seller) -> WebhookEndpoint:
+        # Not to have the worker post to internal services
+        await public_addresses(str(webhook.url))
+
+        return await self._add(
+            WebhookEndpoint(
+                url=str(webhook.url),
+                max_concurrency=webhook.max_concurrency,
+                secret=secrets.token_urlsafe(32),
+                seller_id=seller.id,
+            )
+        )
+
+    async def get_all(self, seller: Seller) -> Sequence[WebhookEndpoint]:
+        return (
+            await self.session.scalars(
+                select(WebhookEndpoint).where(WebhookEndpoint.seller_id == seller.id)
+            )
+        ).all()
+
+    async def get_active_ids(self, seller_id: UUID) -> Sequence[UUID]:
+        return (
+            await self.session.scalars(
+                select(WebhookEndpoint.id).where(
+                    WebhookEndpoint.seller_id == seller_id,
+                    WebhookEndpoint.active,
+                )
+            )
+        ).all()
+
+    async def delete(self, id: UUID, seller: Seller):
+        webhook = await self._get(id)
+
+        if webhook is None:
+            raise EntityNotFound()
+        if webhook.seller_id != seller.id:
+            raise ClientNotAuthorized()
+
+        # Deactivate instead of deleting to keep dead letters
+        webhook.active = False
+        await self._update(webhook)
+
+
+class WebhookEndpointBusy(Exception):
+    """Endpoint has max concurrent deliveries in flight"""
+
+
+class WebhookDeliveryFailed(Exception):
+    """Endpoint did not accept the batch"""
+
+    def __init__(self, batch: str, events: list[str], error: str):
+        super().__init__(error)
+        self.batch = batch
+        self.events = events
+
+
+async def public_addresses(url: str) -> list[str]:
+    """Addresses the host of `url` resolves to, raises
+    WebhookUrlNotAllowed if one of them is not public
+    (private, loopback, link local or reserved)"""
+    parts = urlsplit(url)
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        addresses = [
+            info[4][0]
+            for info in await asyncio.get_running_loop().getaddrinfo(
+                parts.hostname, port, type=socket.SOCK_STREAM
+            )
+        ]
+    except (OSError, UnicodeError, ValueError):
+        raise WebhookUrlNotAllowed()
+
+    # Local receivers (app.fakes.webhook_receiver) run on localhost
+    if not app_settings.LOCAL_MODE and not all(
+        ipaddress.ip_address(address).is_global for address in addresses
+    ):
+        raise WebhookUrlNotAllowed()
+    return addresses
+
+
+def webhook_backoff(attempt: int) -> float:
+    delay = min(WEBHOOK_BACKOFF_BASE * 2**attempt, WEBHOOK_BACKOFF_MAX)
+    # Jitter to spread out retries of many batches
+    return delay * (0.5 + random() / 2)
+
+
+async def deliver_webhook_batch(
+    endpoint_id: UUID,
+    batch: str | None = None,
+) -> bool:
+    """Post a batch of queued events to a webhook endpoint
+
+    Sends the given batch (retries) or claims the next one, a batch
+    left by a worker that died or the next events of the queue. Events
+    are kept in redis until delivered or dead lettered. Returns true if
+    more events are left in the endpoint's queue
+    """
+    queue = f"webhook:{endpoint_id}:queue"
+    inflight = f"webhook:{endpoint_id}:inflight"
+    leases = f"webhook:{endpoint_id}:batches"
+    prefix = f"webhook:{endpoint_id}:batch:"
+
+    # Tasks run in their own event loop, the
+    # client's connections can't be shared
+    redis = redis_client(3, decode_responses=True)
+    try:
+        async with AsyncSession(worker_engine) as session:
+            endpoint = await session.get(WebhookEndpoint, endpoint_id)
+
+        if endpoint is None or not endpoint.active:
+            batches = (await redis.hgetall(leases)).keys()
+            await redis.delete(queue, leases, *(prefix + id for id in batches))
+            return False
+
+        # Limit concurrent deliveries to the endpoint
+        if await redis.incr(inflight) > endpoint.max_concurrency:
+            await redis.decr(inflight)
+            raise WebhookEndpointBusy()
+        # Don't let a killed worker hold a slot forever
+        await redis.expire(inflight, WEBHOOK_LEASE)
+
+        try:
+            now = time.time()
+            if batch is None:
+                # Events queued from now on schedule a new delivery
+                await redis.delete(f"webhook:{endpoint_id}:scheduled")
+                claimed = await redis.register_script(CLAIM_BATCH)(
+                    keys=[queue, leases],
+                    args=[
+                        uuid4().hex,
+                        WEBHOOK_BATCH_SIZE,
+                        now,
+                        now + WEBHOOK_LEASE,
+                        prefix,
+                    ],
+                )
+                batch, events = claimed or (None, [])
+            else:
+                await redis.hset(leases, batch, now + WEBHOOK_LEASE)
+                events = await redis.lrange(prefix + batch, 0, -1)
+
+            if events:
+                try:
+                    await _post_batch(endpoint, batch, events)
+                except WebhookDeliveryFailed:
+                    # Held until after the longest retry delay
+                    await redis.hset(
+                        leases,
+                        batch,
+                        time.time() + WEBHOOK_BACKOFF_MAX + WEBHOOK_LEASE,
+                    )
+                    raise
+            if batch is not None:
+                await _release_batch(redis, endpoint_id, batch)
+        finally:
+            await redis.decr(inflight)
+
+        return await redis.llen(queue) > 0
+    finally:
+        await redis.aclose()
+
+
+async def _release_batch(redis: Redis, endpoint_id: UUID, batch: str):
+    async with redis.pipeline() as pipe:
+        pipe.delete(f"webhook:{endpoint_id}:batch:{batch}")
+        pipe.hdel(f"webhook:{endpoint_id}:batches", batch)
+        await pipe.execute()
+
+
+async def _post_batch(endpoint: WebhookEndpoint, batch: str, events: list[str]):
+    # Posted by the worker only, not imported by the api
+    import httpx
+
+    # Resolved again, the host may point elsewhere since it was
+    # registered, and the request is sent to the address checked
+    try:
+        address = (await public_addresses(endpoint.url))[0]
+    except WebhookUrlNotAllowed:
+        raise WebhookDeliveryFailed(
+            batch, events, "Url does not resolve to a public address"
+        )
+    url = httpx.URL(endpoint.url)
+
+    body = f'{{"events":[{",".join(events)}]}}'.encode()
+    timestamp = int(time.time())
+
+    headers = {
+        "Host": url.netloc.decode(),
+        "Content-Type": "application/json",
+        "X-FastShip-Timestamp": str(timestamp),
+        "X-FastShip-Signature": "sha256="
+        + sign_webhook_payload(endpoint.secret, timestamp, body),
+    }
+
+    try:
+        with tracing.span(
+            "webhook POST",
+            tracing.CLIENT,
+            **{"server.address": endpoint.url, "webhook.events": len(events)},
+        ) as span:
+            tracing.inject(headers)
+            # Redirects are not followed, they could lead anywhere
+            async with httpx.AsyncClient(
+                timeout=WEBHOOK_TIMEOUT, follow_redirects=False
+            ) as client:
+                response = await client.post(
+                    url.copy_with(host=address),
+                    content=body,
+                    headers=headers,
+                    # Certificate checked against the host, not the address
+                    extensions={"sni_hostname": url.host},
+                )
+            if span is not None:
+                span.attributes["http.response.status_code"] = response.status_code
+    except httpx.HTTPError as error:
+        raise WebhookDeliveryFailed(batch, events, repr(error))
+
+    if not response.is_success:
+        raise WebhookDeliveryFailed(batch, events, f"HTTP {response.status_code}")
+
+
+async def dead_letter_webhook_batch(
+    endpoint_id: UUID,
+    batch: str,
+    events: list[str],
+    error: str,
+    attempts: int,
+):
+    async with AsyncSession(worker_engine) as session:
+        session.add(
+            WebhookDeadLetter(
+                endpoint_id=endpoint_id,
+                payload=f"[{','.join(events)}]",
+                error=error,
+                attempts=attempts,
+            )
+        )
+        await session.commit()
+
+    redis = redis_client(3, decode_responses=True)
+    try:
+        await _release_batch(redis, endpoint_id, batch)
+    finally:
+        await redis.aclose()
@@ -0,0 +1,348 @@
+"""Test harness running the api against an in-memory sqlite database
+
+Every sql statement is logged through engine events, so tests can
+declare a query budget for a request:
+
+    with query_budget(3):
+        response = await client.get("/shipment/", params={"id": id})
+
+A request exceeding its budget fails the test with the statements
+it ran, repeated statement shapes first as they point at N+1 loads.
+
+Run from backend/ with `python -m pytest`
+"""
+
+import os
+
+# Settings are read on import, point them to local test values
+for name, value in {
+    "POSTGRES_SERVER": "localhost",
+    "POSTGRES_PORT": "5432",
+    "POSTGRES_USER": "test",
+    "POSTGRES_PASSWORD": "test",
+    "POSTGRES_DB": "test",
+    "REDIS_HOST": "localhost",
+    "REDIS_PORT": "6379",
+    "JWT_SECRET": "test-secret",
+    "JWT_ALGORITHM": "HS256",
+    "MAIL_USERNAME": "test",
+    "MAIL_PASSWORD": "test",
+    "MAIL_FROM": "test@example.com",
+    "MAIL_PORT": "1025",
+    "MAIL_SERVER": "localhost",
+    "MAIL_FROM_NAME": "FastShip",
+    "TWILIO_SID": "ACtest",
+    "TWILIO_AUTH_TOKEN": "test",
+    "TWILIO_NUMBER": "+15005550006",
+    "SIMULATE_DELAY": "false",
+}.items():
+    os.environ.setdefault(name, value)
+
+import asyncio
+import re
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from celery import Task
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, StaticPool
+from sqlmodel import SQLModel
+
+import app.database.redis as redis_clients
+from app.database.models import (
+    DeliveryPartner,
+    Location,
+    Seller,
+    Shipment,
+    ShipmentEvent,
+    ShipmentStatus,
+    Tag,
+    TagName,
+)
+from app.database.pubsub import Broadcaster, shipment_events
+from app.database.redis import Redis
+from app.database.session import get_session
+from app.fakes.redis import fake_redis, server
+from app.main import app
+from app.utils import generate_access_token
+
+# Placeholders of bound parameters in sqlite, postgres (asyncpg) and psycopg
+_PARAMETER = r"(?:\?|\$\d+|%\(\w+\)s)"
+_PARAMETER_LIST = re.compile(rf"\({_PARAMETER}(?:, {_PARAMETER})*\)")
+
+
+class QueryLog:
+    """Sql statements run on an engine"""
+
+    def __init__(self, engine):
+        self.statements: list[str] = []
+        event.listen(engine.sync_engine, "before_cursor_execute", self._log)
+
+    def _log(self, conn, cursor, statement, parameters, context, many):
+        self.statements.append(statement)
+
+    @staticmethod
+    def shape(statement: str) -> str:
+        # Same query with any number of IN (...) parameters
+        return _PARAMETER_LIST.sub("(...)", " ".join(statement.split()))
+
+    @contextmanager
+    def budget(self, max_queries: int):
+        start = len(self.statements)
+        yield
+        statements = self.statements[start:]
+
+        if len(statements) > max_queries:
+            pytest.fail(
+                self.report(statements, max_queries),
+                pytrace=False,
+            )
+
+    @classmethod
+    def report(cls, statements: list[str], max_queries: int) -> str:
+        lines = [f"{len(statements)} queries ran, the budget is {max_queries}"]
+
+        repeated = [
+            (count, shape)
+            for shape, count in Counter(map(cls.shape, statements)).most_common()
+            if count > 1
+        ]
+        if repeated:
+            lines.append("\nRepeated statements (possible N+1):")
+            lines.extend(f"  {count}x {shape}" for count, shape in repeated)
+
+        lines.append("\nStatements:")
+        lines.extend(
+            f"  {n}. {cls.shape(statement)}"
+            for n, statement in enumerate(statements, 1)
+        )
+        return "\n".join(lines)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def engine():
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    async with engine.begin() as connection:
+        await connection.run_sync(SQLModel.metadata.create_all)
+
+    yield engine
+
+    await engine.dispose()
+
+
+@pytest.fixture
+def query_log(engine) -> QueryLog:
+    return QueryLog(engine)
+
+
+@pytest.fixture
+def query_budget(query_log):
+    return query_log.budget
+
+
+@pytest.fixture
+def session_maker(engine):
+    return sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+
+@pytest.fixture
+async def client(session_maker, monkeypatch):
+    async def get_test_session():
+        async with session_maker() as session:
+            yield session
+
+    # Tokens are not blacklisted, no redis needed
+    async def is_jti_blacklisted(jti: str) -> bool:
+        return False
+
+    monkeypatch.setattr("app.api.dependencies.is_jti_blacklisted", is_jti_blacklisted)
+    app.dependency_overrides[get_session] = get_test_session
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://test",
+    ) as client:
+        yield client
+
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def auth_headers():
+    def auth_headers(user: Seller | DeliveryPartner) -> dict:
+        token = generate_access_token(
+            {"user": {"name": user.name, "id": str(user.id)}}
+        )
+        return {"Authorization": f"Bearer {token}"}
+
+    return auth_headers
+
+
+@pytest.fixture
+async def seller(session_maker) -> Seller:
+    async with session_maker() as session:
+        seller = Seller(
+            name="Seller",
+            email="seller@example.com",
+            email_verified=True,
+            password_hash="-",
+            address="1 Seller Street",
+            zip_code=11001,
+        )
+        session.add(seller)
+        await session.commit()
+        return seller
+
+
+@pytest.fixture
+async def partner(session_maker) -> DeliveryPartner:
+    async with session_maker() as session:
+        partner = DeliveryPartner(
+            name="Partner",
+            email="partner@example.com",
+            email_verified=True,
+            password_hash="-",
+            max_handling_capacity=100,
+            servicable_locations=[Location(zip_code=11002)],
+        )
+        session.add(partner)
+        await session.commit()
+        return partner
+
+
+@pytest.fixture
+def add_shipments(session_maker, seller, partner):
+    # Shipments of the seller, assigned to the partner,
+    # with a timeline of two events and the fragile tag
+    async def add_shipments(count: int) -> list[Shipment]:
+        async with session_maker() as session:
+            tag = Tag(name=TagName.FRAGILE, instruction="Handle with care")
+            session.add(Tag(name=TagName.EXPRESS, instruction="Deliver first"))
+            shipments = [
+                Shipment(
+                    client_contact_email="client@example.com",
+                    content=f"Shipment {n}",
+                    weight=1.5,
+                    destination=11002,
+                    estimated_delivery=datetime.now() + timedelta(days=3),
+                    seller_id=seller.id,
+                    delivery_partner_id=partner.id,
+                    tags=[tag],
+                )
+                for n in range(count)
+            ]
+            session.add_all(shipments)
+            await session.commit()
+
+            session.add_all(
+                ShipmentEvent(
+                    location=location,
+                    status=status,
+                    shipment_id=shipment.id,
+                )
+                for shipment in shipments
+                for location, status in (
+                    (11001, ShipmentStatus.placed),
+                    (11002, ShipmentStatus.in_transit),
+                )
+            )
+            await session.commit()
+            return shipments
+
+    return add_shipments
+
+
+@pytest.fixture
+async def shipment(add_shipments) -> Shipment:
+    return (await add_shipments(1))[0]
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    """Redis clients of the app on the in-memory redis, emptied first"""
+    server.flushall()
+    for name, db, decode in (
+        ("_token_blacklist", 0, False),
+        ("_shipment_verification_codes", 1, True),
+        ("_webhook_queue", 3, True),
+    ):
+        monkeypatch.setattr(
+            redis_clients, name, fake_redis(Redis, db=db, decode_responses=decode)
+        )
+    # Subscriptions start over, the reader task and lock of the
+    # broadcaster belong to the event loop of a test
+    events = Broadcaster(
+        fake_redis(Redis, decode_responses=True), prefix=shipment_events.prefix
+    )
+    for name, value in vars(events).items():
+        monkeypatch.setattr(shipment_events, name, value)
+    # Tasks open clients of their own
+    monkeypatch.setattr(
+        "app.services.webhook.redis_client",
+        lambda db, **kwargs: fake_redis(Redis, db=db, **kwargs),
+    )
+
+
+class Tasks:
+    """Celery tasks queued by the code under test, run when asked"""
+
+    def __init__(self):
+        # Task, args, kwargs and options (like countdown) of apply_async
+        self.queued: list[tuple[Task, tuple, dict, dict]] = []
+        self.ran: list[tuple[str, dict, dict]] = []
+
+    async def run_next(self):
+        task, args, kwargs, options = self.queued.pop(0)
+        self.ran.append((task.name.rsplit(".", 1)[-1], kwargs, options))
+        # Tasks bridge to async code with async_to_sync, off the loop
+        await asyncio.to_thread(task.apply, args, kwargs, throw=True)
+
+    async def run(self, limit: int = 100):
+        """Runs the queued tasks, and the ones they queue, ignoring
+        countdowns"""
+        for _ in range(limit):
+            if not self.queued:
+                return
+            await self.run_next()
+        pytest.fail(f"Tasks still queued after {limit} runs")
+
+
+@pytest.fixture
+def tasks(monkeypatch) -> Tasks:
+    tasks = Tasks()
+
+    def apply_async(task, args=None, kwargs=None, **options):
+        tasks.queued.append((task, tuple(args or ()), kwargs or {}, options))
+
+    monkeypatch.setattr(Task, "apply_async", apply_async)
+    return tasks
+
+
+@pytest.fixture
+async def worker_engine(tmp_path, monkeypatch):
+    # Tasks run in event loops of their own, each with its own connection
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'worker.db'}",
+        poolclass=NullPool,
+    )
+    async with engine.begin() as connection:
+        await connection.run_sync(SQLModel.metadata.create_all)
+    monkeypatch.setattr("app.services.webhook.worker_engine", engine)
+
+    yield engine
+
+    await engine.dispose()
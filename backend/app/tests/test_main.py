@@ -0,0 +1,1117 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import partial, partialmethod
+from queue import Queue
+from uuid import uuid4
+
+import httpx
+import pytest
+import uvicorn
+from celery.signals import after_task_publish
+from fastapi import BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse
+from redis.exceptions import RedisError
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+
+import app.database.redis as redis_clients
+from app.api import idempotency
+from app.config import app_settings, security_settings
+from app.core import timing, tracing
+from app.core.admission import (
+    AUTH_ROUTES,
+    EXEMPT_ROUTES,
+    EXPORT_ROUTES,
+    PAGE_ROUTES,
+    AdmissionMiddleware,
+    Gate,
+    Limits,
+    Shed,
+    route_class,
+)
+from app.core.logging import ErrorSampler, logger
+from app.core.logging import _handler as log_handler
+from app.core.metrics import MetricsMiddleware
+from app.core.singleflight import SingleFlight
+from app.core.tracing import parse_traceparent
+from app.database import ratelimit
+from app.database.models import (
+    Seller,
+    Shipment,
+    ShipmentStatus,
+    WebhookDeadLetter,
+    WebhookEndpoint,
+)
+from app.database.pubsub import Broadcaster, shipment_events
+from app.fakes import twilio as fake_twilio
+from app.fakes import webhook_receiver as receiver
+from app.fakes.redis import fake_redis, register_script, server
+from app.main import app
+from app.services import notification
+from app.services import webhook as webhook_service
+from app.services.notification import NotificationService
+from app.services.shipment import ShipmentService
+from app.services.shipment_event import ShipmentEventService
+from app.services.user import password_context
+from app.worker import tasks as worker_tasks
+from app.worker.tasks import deliver_webhooks
+
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_root(client):
+    response = await client.get("/")
+
+    assert response.status_code == 200
+
+
+### Query budgets, reads take the same number of
+### queries for any number of shipments
+
+
+async def test_get_shipment(client, shipment, query_budget):
+    with query_budget(3):
+        response = await client.get("/shipment/", params={"id": str(shipment.id)})
+
+    assert response.status_code == 200
+    assert [event["status"] for event in response.json()["timeline"]] == [
+        "placed",
+        "in_transit",
+    ]
+
+
+async def test_get_shipment_sparse(client, shipment, query_budget):
+    with query_budget(1):
+        response = await client.get(
+            "/shipment/",
+            params={"id": str(shipment.id), "fields": "id,status"},
+        )
+
+    assert response.json() == {"id": str(shipment.id), "status": "in_transit"}
+
+
+async def test_get_shipment_not_found(client, seller, query_budget):
+    with query_budget(1):
+        response = await client.get("/shipment/", params={"id": str(seller.id)})
+
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("count", [1, 25])
+async def test_lookup_shipments(
+    auth_headers,
+    client,
+    seller,
+    add_shipments,
+    count,
+    query_budget,
+):
+    shipments = await add_shipments(count)
+
+    with query_budget(4):
+        response = await client.post(
+            "/shipment/lookup",
+            json={"ids": [str(shipment.id) for shipment in shipments]},
+            headers=auth_headers(seller),
+        )
+
+    assert response.status_code == 200
+    assert len(response.json()["shipments"]) == count
+
+
+@pytest.mark.parametrize("count", [1, 25])
+async def test_seller_shipments(
+    auth_headers,
+    client,
+    seller,
+    add_shipments,
+    count,
+    query_budget,
+):
+    await add_shipments(count)
+
+    with query_budget(4):
+        response = await client.get("/seller/shipments", headers=auth_headers(seller))
+
+    assert response.status_code == 200
+    assert len(response.json()) == count
+
+
+@pytest.mark.parametrize("count", [1, 25])
+async def test_partner_shipments(
+    auth_headers,
+    client,
+    partner,
+    add_shipments,
+    count,
+    query_budget,
+):
+    await add_shipments(count)
+
+    with query_budget(5):
+        response = await client.get("/partner/shipments", headers=auth_headers(partner))
+
+    assert response.status_code == 200
+    assert len(response.json()) == count
+
+
+async def test_seller_export(
+    auth_headers,
+    client,
+    seller,
+    add_shipments,
+    query_budget,
+    monkeypatch,
+    session_maker,
+):
+    # The export opens its own session
+    monkeypatch.setattr("app.api.routers.seller.async_session", session_maker)
+    await add_shipments(25)
+
+    with query_budget(4):
+        response = await client.get(
+            "/seller/shipments/export",
+            headers=auth_headers(seller),
+        )
+
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 26
+
+    # Tags take a query per batch, the latest status is joined
+    monkeypatch.setattr(
+        ShipmentService,
+        "stream",
+        partialmethod(ShipmentService.stream, batch_size=10),
+    )
+    with query_budget(5):
+        response = await client.get(
+            "/seller/shipments/export",
+            headers=auth_headers(seller),
+        )
+
+    assert len(response.text.splitlines()) == 26
+
+
+async def test_seller_profile(
+    auth_headers,
+    client,
+    seller,
+    add_shipments,
+    query_budget,
+):
+    # Shipments of the seller are not loaded with the profile
+    await add_shipments(25)
+
+    with query_budget(1):
+        response = await client.get("/seller/me", headers=auth_headers(seller))
+
+    assert response.json()["email"] == seller.email
+
+
+async def test_partner_profile(
+    auth_headers,
+    client,
+    partner,
+    add_shipments,
+    query_budget,
+):
+    await add_shipments(25)
+
+    with query_budget(2):
+        response = await client.get("/partner/me", headers=auth_headers(partner))
+
+    assert response.json()["servicable_locations"] == [{"zip_code": 11002}]
+
+
+async def test_tracking_page(client, shipment, query_budget):
+    with query_budget(7):
+        response = await client.get("/shipment/track", params={"id": str(shipment.id)})
+
+    assert response.status_code == 200
+
+
+async def test_add_tag(client, add_shipments, query_budget):
+    shipment, *_ = await add_shipments(25)
+
+    with query_budget(13):
+        response = await client.get(
+            "/shipment/tag",
+            params={"id": str(shipment.id), "tag_name": "express"},
+        )
+
+    assert response.status_code == 200
+    assert {tag["name"] for tag in response.json()["tags"]} == {"fragile", "express"}
+
+
+### Query budgets of writes and logins, taken with the partner
+### and seller already having shipments
+
+
+async def test_submit_shipment(
+    auth_headers, client, seller, add_shipments, fakes, tasks, query_budget
+):
+    await add_shipments(25)
+
+    with query_budget(10):
+        response = await client.post(
+            "/shipment/",
+            json={
+                "content": "Books",
+                "weight": 2,
+                "destination": 11002,
+                "client_contact_email": "client@example.com",
+            },
+            headers=auth_headers(seller),
+        )
+
+    assert response.status_code == 200
+    assert [event["status"] for event in response.json()["timeline"]] == ["placed"]
+
+
+async def test_update_shipment(
+    auth_headers, client, partner, add_shipments, fakes, tasks, query_budget
+):
+    shipment, *_ = await add_shipments(25)
+
+    with query_budget(14):
+        response = await client.patch(
+            "/shipment/",
+            params={"id": str(shipment.id)},
+            json={"status": "out_for_delivery"},
+            headers=auth_headers(partner),
+        )
+
+    assert response.status_code == 200
+    assert response.json()["timeline"][-1]["status"] == "out_for_delivery"
+
+
+async def test_cancel_shipment(
+    auth_headers, client, seller, add_shipments, fakes, tasks, query_budget
+):
+    shipment, *_ = await add_shipments(25)
+
+    with query_budget(10):
+        response = await client.get(
+            "/shipment/cancel",
+            params={"id": str(shipment.id)},
+            headers=auth_headers(seller),
+        )
+
+    assert response.status_code == 200
+    response = await client.get("/shipment/", params={"id": str(shipment.id)})
+    assert response.json()["timeline"][-1]["status"] == "cancelled"
+
+
+@pytest.mark.parametrize("kind", ["seller", "partner"])
+async def test_login(
+    client,
+    session_maker,
+    seller,
+    partner,
+    add_shipments,
+    rate_limits,
+    query_budget,
+    kind,
+):
+    await add_shipments(25)
+    user = seller if kind == "seller" else partner
+    # The fixtures have no password
+    async with session_maker() as session:
+        user = await session.get(type(user), user.id)
+        user.password_hash = password_context.hash("password")
+        await session.commit()
+
+    with query_budget(1):
+        response = await client.post(
+            f"/{kind}/token",
+            data={"username": user.email, "password": "password"},
+        )
+
+    assert response.status_code == 200
+    assert response.json()["token_type"] == "jwt"
+
+
+async def test_shipment_changes(
+    auth_headers,
+    client,
+    seller,
+    add_shipments,
+    query_budget,
+):
+    shipments = await add_shipments(25)
+
+    with query_budget(2):
+        response = await client.get(
+            "/seller/shipments/changes",
+            headers=auth_headers(seller),
+        )
+
+    # Only the latest of the two events of each shipment
+    page = response.json()
+    assert [(change["id"], change["status"]) for change in page["changes"]] == [
+        (str(shipment.id), "in_transit") for shipment in shipments
+    ]
+    assert (page["cursor"], page["has_more"]) == (50, False)
+
+
+async def test_shipment_change_cursor(auth_headers, client, seller, add_shipments):
+    first, second = await add_shipments(2)
+
+    async def changes(since: int, limit: int) -> dict:
+        response = await client.get(
+            "/seller/shipments/changes",
+            params={"since": since, "limit": limit},
+            headers=auth_headers(seller),
+        )
+        return response.json()
+
+    # Events numbered 1 to 4, two of each shipment
+    page = await changes(0, 3)
+    assert [(change["id"], change["status"]) for change in page["changes"]] == [
+        (str(first.id), "in_transit"),
+        (str(second.id), "placed"),
+    ]
+    assert (page["cursor"], page["has_more"]) == (3, True)
+
+    page = await changes(page["cursor"], 3)
+    assert [(change["id"], change["status"]) for change in page["changes"]] == [
+        (str(second.id), "in_transit"),
+    ]
+    assert (page["cursor"], page["has_more"]) == (4, False)
+
+    page = await changes(page["cursor"], 3)
+    assert (page["changes"], page["cursor"]) == ([], 4)
+
+
+async def test_webhook_urls(auth_headers, client, seller):
+    for url in (
+        "http://example.com/hooks",
+        "https://127.0.0.1/hooks",
+        "https://169.254.169.254/latest/meta-data",
+        "https://10.0.0.1/hooks",
+        "https://localhost/hooks",
+    ):
+        response = await client.post(
+            "/seller/webhooks",
+            json={"url": url},
+            headers=auth_headers(seller),
+        )
+
+        assert response.status_code == 422, url
+
+
+### Harness
+
+
+async def test_statement_shape(query_log):
+    assert query_log.shape(
+        "SELECT tag.name\nFROM tag\nWHERE tag.id IN (?, ?, ?)"
+    ) == query_log.shape("SELECT tag.name FROM tag WHERE tag.id IN ($1)")
+
+
+async def test_query_budget_reports_repeated_statements(engine, query_log):
+    with pytest.raises(pytest.fail.Exception) as failure:
+        with query_log.budget(2):
+            async with engine.connect() as connection:
+                for n in range(3):
+                    await connection.execute(text("SELECT :n"), {"n": n})
+
+    assert "3 queries ran, the budget is 2" in str(failure.value)
+    assert "3x SELECT ?" in str(failure.value)
+
+
+### Logging
+
+
+async def test_request_id(client):
+    response = await client.get("/", headers={"X-Request-ID": "abc-123"})
+
+    assert response.headers["X-Request-ID"] == "abc-123"
+
+
+async def test_handled_errors_are_sampled():
+    sampler = ErrorSampler(size=2, window=60)
+
+    assert [sampler.sample("InvalidToken") for _ in range(4)] == [0, 0, None, None]
+
+    # Next window reports the errors skipped in the last one
+    sampler.window = 0
+    assert sampler.sample("InvalidToken") == 2
+
+
+async def test_dropped_log_records(client, monkeypatch):
+    # The logging thread is behind, its queue full
+    queue = Queue(1)
+    queue.put_nowait(None)
+    monkeypatch.setattr(log_handler, "queue", queue)
+    monkeypatch.setattr(log_handler, "_pid", os.getpid())
+    monkeypatch.setattr(log_handler, "dropped", 0)
+
+    logger.warning("Dropped")
+    logger.warning("Dropped too")
+
+    response = await client.get("/metrics")
+    assert "\nlog_records_dropped_total 2\n" in response.text
+
+
+async def test_slow_requests_exclude_streams(monkeypatch):
+    monkeypatch.setattr(timing.app_settings, "SLOW_REQUEST_THRESHOLD", 0.05)
+    monkeypatch.setattr(timing, "slow_requests", deque())
+
+    async def endpoint(scope, receive, send):
+        async def events():
+            for _ in range(3):
+                await asyncio.sleep(0.03)
+                yield b"event\n"
+
+        if scope["path"] == "/events":
+            response = StreamingResponse(events())
+        else:
+            await asyncio.sleep(0.06)
+            response = JSONResponse({})
+        await response(scope, receive, send)
+
+    app = MetricsMiddleware(timing.ServerTimingMiddleware(endpoint))
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://test",
+    ) as client:
+        # Streamed for longer than the threshold, started right away
+        await client.get("/events")
+        await client.get("/slow")
+
+    assert [request["path"] for request in timing.slow_requests] == ["/slow"]
+
+
+### Tracing
+
+
+async def test_trace_propagates_to_tasks(
+    auth_headers, client, seller, shipment, fakes, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(tracing, "enabled", True)
+    monkeypatch.setattr(app_settings, "TRACE_EXPORTER", "file")
+    monkeypatch.setattr(app_settings, "TRACE_FILE", tmp_path / "traces.jsonl")
+    # Published to an in-memory broker, no result backend
+    task = worker_tasks.send_email_with_template
+    monkeypatch.setitem(worker_tasks.app.conf, "broker_url", "memory://")
+    monkeypatch.setattr(task, "ignore_result", True)
+    monkeypatch.setattr(worker_tasks, "send_message", lambda **kwargs: None)
+
+    published = []
+
+    def record(sender: str, headers: dict, body: tuple, **kwargs):
+        published.append((headers, body))
+
+    after_task_publish.connect(record, weak=False)
+    trace_id, parent_id = "a" * 32, "b" * 16
+    try:
+        response = await client.get(
+            "/shipment/cancel",
+            params={"id": str(shipment.id)},
+            headers={
+                **auth_headers(seller),
+                "traceparent": f"00-{trace_id}-{parent_id}-01",
+            },
+        )
+    finally:
+        after_task_publish.disconnect(record)
+        worker_tasks.app.close()
+    assert response.status_code == 200
+
+    # The cancellation mail is queued in the trace of the request
+    [(headers, (args, kwargs, _))] = published
+    publish_id = parse_traceparent(headers["traceparent"])[1]
+    assert headers["traceparent"] == f"00-{trace_id}-{publish_id}-01"
+
+    # And run in it by the worker
+    task.apply(args, kwargs, headers=headers)
+
+    tracing.exporter.flush()
+    with open(tmp_path / "traces.jsonl") as file:
+        spans = {span["name"]: span for span in map(json.loads, file)}
+    assert {span["traceId"] for span in spans.values()} == {trace_id}
+    request = spans["GET /shipment/cancel"]
+    assert request["parentSpanId"] == parent_id
+    publish = spans[f"celery publish {task.name}"]
+    assert (publish["spanId"], publish["parentSpanId"]) == (
+        publish_id,
+        request["spanId"],
+    )
+    assert spans[f"celery run {task.name}"]["parentSpanId"] == publish_id
+
+
+### Profiling
+
+
+async def test_profile(client, monkeypatch):
+    response = await client.post("/admin/profile", params={"seconds": 0.1})
+    # Disabled without an admin token
+    assert response.status_code == 401
+
+    monkeypatch.setattr(security_settings, "ADMIN_TOKEN", "admin-token")
+    for headers in ({}, {"X-Admin-Token": "wrong"}):
+        response = await client.post(
+            "/admin/profile", params={"seconds": 0.1}, headers=headers
+        )
+        assert response.status_code == 401
+
+    stop = threading.Event()
+
+    def spin():
+        while not stop.is_set():
+            pass
+
+    spinner = threading.Thread(target=spin, name="spinner")
+    spinner.start()
+    start = time.perf_counter()
+    try:
+        response = await client.post(
+            "/admin/profile",
+            params={"seconds": 0.2, "interval": 0.001},
+            headers={"X-Admin-Token": "admin-token"},
+        )
+    finally:
+        stop.set()
+        spinner.join()
+    assert time.perf_counter() - start < 1
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert int(response.headers["X-Profile-Samples"]) > 0
+    # Collapsed stacks, the thread name first and a count of samples
+    stacks = {}
+    for line in response.text.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        stacks[stack] = int(count)
+    spinning = [
+        stack
+        for stack in stacks
+        if stack.startswith("spinner;") and "test_profile.<locals>.spin (" in stack
+    ]
+    assert spinning
+
+
+### Notifications
+
+
+async def test_send_sms(monkeypatch):
+    # The twilio stand-in served on the event loop of the test,
+    # it could not answer a client blocking the loop
+    server = uvicorn.Server(
+        uvicorn.Config(
+            fake_twilio.app, port=0, log_level="warning", lifespan="off", ws="none"
+        )
+    )
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    monkeypatch.setattr(
+        notification.notification_settings,
+        "TWILIO_API_URL",
+        f"http://127.0.0.1:{port}",
+    )
+    monkeypatch.setattr(fake_twilio, "messages", [])
+
+    tasks = BackgroundTasks()
+    await NotificationService(tasks).send_sms("+15551234567", "Arriving soon")
+    # Sent after the response
+    assert fake_twilio.messages == []
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    ticker = asyncio.create_task(tick())
+    try:
+        async with asyncio.timeout(5):
+            await tasks()
+    finally:
+        ticker.cancel()
+        await notification.close_async_twilio_client()
+        server.should_exit = True
+        await serving
+
+    [message] = fake_twilio.messages
+    assert (message["to"], message["from"], message["body"]) == (
+        "+15551234567",
+        notification.notification_settings.TWILIO_NUMBER,
+        "Arriving soon",
+    )
+    assert message["account_sid"] == notification.notification_settings.TWILIO_SID
+    # Other tasks ran while the sms was sent
+    assert ticks > 1
+
+
+### Rate limits
+
+
+@pytest.fixture
+def rate_limits(monkeypatch):
+    # Buckets in the in-memory redis, emptied between tests
+    register_script(ratelimit.TOKEN_BUCKET, ratelimit._token_bucket)
+    server.flushall()
+    redis = fake_redis(db=4)
+    for bucket in (ratelimit.login_by_ip, ratelimit.login_by_account):
+        monkeypatch.setattr(bucket, "script", redis.register_script(bucket.script.script))
+        monkeypatch.setattr(bucket, "_answers", {})
+
+
+async def test_login_rate_limit(client, rate_limits):
+    form = {"username": "seller@example.com", "password": "wrong"}
+    limit = ratelimit.login_by_account.capacity
+
+    for _ in range(limit):
+        response = await client.post("/seller/token", data=form)
+        assert response.status_code == 401
+
+    response = await client.post("/seller/token", data=form)
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 60 / limit + 1
+
+    # Other accounts from the same client are still served
+    form["username"] = "other@example.com"
+    response = await client.post("/seller/token", data=form)
+    assert response.status_code == 401
+
+
+### Shipment event streams
+
+
+async def add_event(session_maker, shipment: Shipment, status: ShipmentStatus):
+    async with session_maker() as session:
+        shipment = await session.get(Shipment, shipment.id)
+        return await ShipmentEventService(session).add(shipment, 11002, status)
+
+
+async def subscribed(shipment: Shipment):
+    # Streams read the timeline once subscribed to new events
+    async with asyncio.timeout(1):
+        while str(shipment.id) not in shipment_events._queues:
+            await asyncio.sleep(0.01)
+
+
+def sse_events(body: str) -> list[tuple[str, dict]]:
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["id"], json.loads(fields["data"])))
+    return events
+
+
+async def websocket(path: str) -> list[dict]:
+    """Messages sent to a websocket client until the app closes it"""
+    scope = {
+        "type": "websocket",
+        "asgi": {"version": "3.0"},
+        "scheme": "ws",
+        "server": ("test", 80),
+        "client": ("127.0.0.1", 50000),
+        "root_path": "",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "headers": [(b"host", b"test")],
+        "subprotocols": [],
+    }
+    received = deque([{"type": "websocket.connect"}])
+    messages = []
+
+    async def receive():
+        if received:
+            return received.popleft()
+        # The client sends nothing more
+        await asyncio.Future()
+
+    async def send(message: dict):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages
+
+
+async def test_shipment_event_stream(client, shipment, session_maker, fakes, tasks):
+    stream = asyncio.create_task(client.get(f"/shipment/{shipment.id}/events"))
+    await subscribed(shipment)
+
+    # Pushed as they are added, the stream ends with the final status
+    added = [
+        await add_event(session_maker, shipment, status)
+        for status in (ShipmentStatus.out_for_delivery, ShipmentStatus.delivered)
+    ]
+    async with asyncio.timeout(1):
+        response = await stream
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = sse_events(response.text)
+    assert [event["status"] for _, event in events] == [
+        "placed",
+        "in_transit",
+        "out_for_delivery",
+        "delivered",
+    ]
+    assert [id for id, _ in events[2:]] == [str(event.id) for event in added]
+
+    # Resumed after the last event received, the shipment is
+    # delivered so the stream ends with the timeline
+    response = await client.get(
+        f"/shipment/{shipment.id}/events", headers={"Last-Event-ID": events[1][0]}
+    )
+    assert sse_events(response.text) == events[2:]
+
+
+async def test_shipment_event_websocket(
+    client, shipment, session_maker, fakes, tasks
+):
+    connection = asyncio.create_task(websocket(f"/shipment/{shipment.id}/ws"))
+    await subscribed(shipment)
+    cancelled = await add_event(session_maker, shipment, ShipmentStatus.cancelled)
+    async with asyncio.timeout(1):
+        messages = await connection
+
+    assert messages[0]["type"] == "websocket.accept"
+    events = [json.loads(message["text"]) for message in messages[1:-1]]
+    assert [event["status"] for event in events] == [
+        "placed",
+        "in_transit",
+        "cancelled",
+    ]
+    assert events[-1]["id"] == str(cancelled.id)
+    assert messages[-1]["type"] == "websocket.close"
+
+    # Unknown shipments are refused
+    messages = await websocket(f"/shipment/{uuid4()}/ws")
+    assert messages == [{"type": "websocket.close", "code": 1008, "reason": ""}]
+
+
+### Webhook deliveries
+
+
+@pytest.fixture
+async def webhook(worker_engine, fakes, monkeypatch) -> WebhookEndpoint:
+    register_script(webhook_service.CLAIM_BATCH, webhook_service._claim_batch)
+    receiver.deliveries.clear()
+    receiver.failures["remaining"] = 0
+
+    async with AsyncSession(worker_engine, expire_on_commit=False) as session:
+        seller = Seller(
+            name="Seller",
+            email="seller@example.com",
+            password_hash="-",
+            address="1 Seller Street",
+            zip_code=11001,
+        )
+        session.add(seller)
+        await session.commit()
+        endpoint = WebhookEndpoint(
+            url="https://hooks.example.com/hooks",
+            secret="secret",
+            seller_id=seller.id,
+        )
+        session.add(endpoint)
+        await session.commit()
+
+    # Signatures are checked by the receiver
+    monkeypatch.setenv("WEBHOOK_SECRET", "secret")
+
+    # Posted to the local receiver, at a public address
+    async def public_addresses(url: str) -> list[str]:
+        return ["93.184.216.34"]
+
+    monkeypatch.setattr(webhook_service, "public_addresses", public_addresses)
+    monkeypatch.setattr(
+        httpx,
+        "AsyncClient",
+        partial(httpx.AsyncClient, transport=httpx.ASGITransport(app=receiver.app)),
+    )
+    return endpoint
+
+
+async def queue_events(endpoint: WebhookEndpoint, count: int):
+    # Like ShipmentEventService._notify_webhooks
+    for n in range(count):
+        if await redis_clients.queue_webhook_event(endpoint.id, f'{{"n":{n}}}'):
+            deliver_webhooks.apply_async(
+                kwargs={"endpoint_id": str(endpoint.id)},
+                countdown=redis_clients.WEBHOOK_BATCH_WINDOW,
+            )
+
+
+async def webhook_keys(endpoint: WebhookEndpoint) -> set[str]:
+    # Left once deliveries are done, the counter of deliveries in flight
+    keys = await fake_redis(db=3, decode_responses=True).keys("webhook:*")
+    return set(keys) - {f"webhook:{endpoint.id}:inflight"}
+
+
+async def test_webhook_delivery(webhook, tasks):
+    await queue_events(webhook, 3)
+    receiver.failures["remaining"] = 1
+
+    await tasks.run()
+
+    # One signed batch, delivered on the retry of the batch held in redis
+    assert [delivery["events"] for delivery in receiver.deliveries] == [
+        [{"n": 0}, {"n": 1}, {"n": 2}]
+    ]
+    (_, first, _), (_, retry, options) = tasks.ran
+    assert first == {"endpoint_id": str(webhook.id)}
+    assert (retry["attempt"], retry["batch"] is not None) == (1, True)
+    assert options["countdown"] > 0
+    assert await webhook_keys(webhook) == set()
+
+
+async def test_webhook_dead_letter(webhook, tasks, worker_engine):
+    await queue_events(webhook, 2)
+    receiver.failures["remaining"] = webhook_service.WEBHOOK_MAX_ATTEMPTS
+
+    await tasks.run()
+
+    assert receiver.deliveries == []
+    assert len(tasks.ran) == webhook_service.WEBHOOK_MAX_ATTEMPTS
+    async with AsyncSession(worker_engine) as session:
+        (dead_letter,) = (await session.scalars(select(WebhookDeadLetter))).all()
+    assert dead_letter.payload == '[{"n":0},{"n":1}]'
+    assert (dead_letter.error, dead_letter.attempts) == ("HTTP 503", 8)
+    assert await webhook_keys(webhook) == set()
+
+
+async def test_webhook_concurrency(webhook, tasks):
+    redis = fake_redis(db=3, decode_responses=True)
+    await redis.set(f"webhook:{webhook.id}:inflight", webhook.max_concurrency)
+    await queue_events(webhook, 1)
+
+    # No slot free, tried again a second later
+    await tasks.run_next()
+    assert receiver.deliveries == []
+    assert tasks.queued[0][3] == {"countdown": 1}
+
+    await redis.decr(f"webhook:{webhook.id}:inflight")
+    await tasks.run()
+    assert len(receiver.deliveries) == 1
+
+
+async def test_webhook_batch_taken_over(webhook, tasks):
+    # A worker claimed a batch and died, its lease is over
+    await queue_events(webhook, 2)
+    redis = fake_redis(db=3, decode_responses=True)
+    claim = redis.register_script(webhook_service.CLAIM_BATCH)
+    now = time.time()
+    await claim(
+        keys=[f"webhook:{webhook.id}:queue", f"webhook:{webhook.id}:batches"],
+        args=["lost", 50, now, now - 1, f"webhook:{webhook.id}:batch:"],
+    )
+
+    await tasks.run()
+
+    assert [delivery["events"] for delivery in receiver.deliveries] == [
+        [{"n": 0}, {"n": 1}]
+    ]
+    assert await webhook_keys(webhook) == set()
+
+
+### Idempotency keys
+
+
+async def test_idempotency_key(monkeypatch):
+    monkeypatch.setattr(idempotency, "_records", fake_redis(db=5))
+    monkeypatch.setattr(
+        idempotency,
+        "_finished",
+        Broadcaster(fake_redis(db=5, decode_responses=True), prefix="idempotency"),
+    )
+    runs = 0
+
+    async def add_shipment(scope, receive, send):
+        nonlocal runs
+        runs += 1
+        await asyncio.sleep(0.05)
+        await JSONResponse({"run": runs}, status_code=201)(scope, receive, send)
+
+    app = idempotency.IdempotencyMiddleware(add_shipment, routes=[("POST", "/shipment/")])
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://test",
+    ) as client:
+
+        def post(body: dict):
+            return client.post(
+                "/shipment/",
+                json=body,
+                headers={"Authorization": "Bearer token", "Idempotency-Key": "abc"},
+            )
+
+        # The retry waits for the first request still running
+        first, retry = await asyncio.gather(post({"weight": 1}), post({"weight": 1}))
+        later = await post({"weight": 1})
+        reused = await post({"weight": 2})
+
+    assert runs == 1
+    for response in (first, retry, later):
+        assert response.status_code == 201
+        assert response.json() == {"run": 1}
+    assert "Idempotent-Replayed" not in first.headers
+    assert later.headers["Idempotent-Replayed"] == "true"
+    assert reused.status_code == 422
+
+
+async def test_idempotency_key_redis_down(monkeypatch):
+    records = fake_redis(db=5)
+    finished = Broadcaster(fake_redis(db=5, decode_responses=True), prefix="idempotency")
+    monkeypatch.setattr(idempotency, "_records", records)
+    monkeypatch.setattr(idempotency, "_finished", finished)
+
+    async def unavailable(*args, **kwargs):
+        raise RedisError("unavailable")
+
+    # The key is claimed, redis goes away after
+    for client, method in ((records, "get"), (records, "delete"), (finished, "publish")):
+        monkeypatch.setattr(client, method, unavailable)
+    runs = 0
+
+    async def add_shipment(scope, receive, send):
+        nonlocal runs
+        runs += 1
+        await asyncio.sleep(0.05)
+        await JSONResponse({}, status_code=500)(scope, receive, send)
+
+    app = idempotency.IdempotencyMiddleware(add_shipment, routes=[("POST", "/shipment/")])
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://test",
+    ) as client:
+        # The key isn't released and the retry can't wait for it, both run
+        responses = await asyncio.gather(
+            *(
+                client.post(
+                    "/shipment/",
+                    json={"weight": 1},
+                    headers={"Authorization": "Bearer token", "Idempotency-Key": "abc"},
+                )
+                for _ in range(2)
+            )
+        )
+
+    assert runs == 2
+    assert [response.status_code for response in responses] == [500, 500]
+
+
+### Admission control
+
+
+async def test_admission_gate():
+    gate = Gate("write", Limits(concurrency=1, queue_size=2, timeout=0.5))
+    admitted = []
+
+    async def request(name: str, priority: bool = False):
+        try:
+            await gate.acquire(priority)
+        except Shed as shed:
+            admitted.append(f"{name} {shed.reason}")
+            return
+        admitted.append(name)
+        await asyncio.sleep(0.01)
+        gate.release()
+
+    await gate.acquire()
+    waiting = [asyncio.create_task(request(name)) for name in ("a", "b")]
+    await asyncio.sleep(0)
+    # The queue is full, a priority request takes the place of the newest
+    await request("c")
+    waiting.append(asyncio.create_task(request("update", priority=True)))
+    await asyncio.sleep(0)
+
+    gate.release()
+    await asyncio.gather(*waiting)
+    assert admitted == ["c queue_full", "b displaced", "update", "a"]
+
+    # Shed once waiting longer than the timeout
+    await gate.acquire()
+    await request("d")
+    assert admitted[-1] == "d timeout"
+
+    # A priority request past its deadline displaces no one (the slot
+    # is still taken)
+    waiting = [asyncio.create_task(request(name)) for name in ("e", "f")]
+    await asyncio.sleep(0)
+    gate.average = 1.0
+    await request("late", priority=True)
+    gate.average = 0.0
+    gate.release()
+    await asyncio.gather(*waiting)
+    assert admitted[-3:] == ["late deadline", "e", "f"]
+
+
+async def test_admission_classes():
+    classes = {
+        (method, route.path): route_class(method, route.path)
+        for route in app.routes
+        for method in getattr(route, "methods", None) or ()
+    }
+
+    assert classes[("PATCH", "/shipment/")] == "write"
+    assert classes[("POST", "/shipment/lookup")] == "read"
+    assert classes[("POST", "/seller/token")] == "auth"
+    assert classes[("GET", "/shipment/track")] == "page"
+    assert classes[("GET", "/seller/shipments/export")] == "export"
+    assert classes[("GET", "/metrics")] is None
+    # Every route named in the classes exists
+    routes = {route for _, route in classes}
+    for named in (AUTH_ROUTES, PAGE_ROUTES, EXPORT_ROUTES, EXEMPT_ROUTES):
+        assert named <= routes
+
+    # Idempotent retries wait for the first request outside of
+    # admission, not holding a slot it may need (outermost first)
+    middleware = [entry.cls for entry in app.user_middleware]
+    assert middleware.index(idempotency.IdempotencyMiddleware) < middleware.index(
+        AdmissionMiddleware
+    )
+
+
+### Single-flight reads
+
+
+async def test_single_flight():
+    reads = SingleFlight("test")
+    calls = []
+
+    async def read(n: int):
+        calls.append(n)
+        await asyncio.sleep(0.01)
+        return n
+
+    # Concurrent calls share the first one
+    shared = await asyncio.gather(*(reads.do("a", partial(read, n)) for n in range(5)))
+    assert shared == [0] * 5
+    # Later ones run again
+    assert await reads.do("a", lambda: read(5)) == 5
+    assert calls == [0, 5]
+
+    # A waiting call runs it once the running one is cancelled
+    first = asyncio.create_task(reads.do("b", lambda: read(6)))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(reads.do("b", lambda: read(7)))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == 7
+
+
+async def test_shipment_reads_share_one_load(client, shipment, query_budget):
+    # Ten at once take the queries of one read
+    with query_budget(3):
+        responses = await asyncio.gather(
+            *(client.get("/shipment/", params={"id": shipment.id}) for _ in range(10))
+        )
+
+    assert {response.status_code for response in responses} == {200}
+    assert len({response.content for response in responses}) == 1
@@ -1,3 +1,5 @@
+import hashlib
+import hmac
 from datetime import datetime, timedelta, timezone
 from json import JSONDecodeError, dumps
 from pathlib import Path
@@ -60,6 +62,14 @@ def decode_url_safe_token(
         return None
 
 
+def sign_webhook_payload(secret: str, timestamp: int, body: bytes) -> str:
+    return hmac.new(
+        secret.encode(),
+        f"{timestamp}.".encode() + body,
+        hashlib.sha256,
+    ).hexdigest()
+
+
 def print_label(data: Any, title: str | None = None):
 
     from rich import print
@@ -0,0 +1,55 @@
+"""Celery tasks run inside the api process, for the local profile
+
+Tasks are applied eagerly, but on a pool of threads instead of the
+caller's: callers don't wait for them, tasks bridging to async code
+(async_to_sync) get a thread without a running event loop, and a
+countdown is honored with a timer. Like a worker, tasks carry the
+trace context and request id of the caller.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+
+from celery import Task
+from celery.utils import uuid
+
+from app.core import tracing
+from app.core.logging import request_id
+
+# Tasks running at once, like the concurrency of a worker
+CONCURRENCY = 8
+
+_executor = ThreadPoolExecutor(CONCURRENCY, thread_name_prefix="celery-local")
+
+
+class LocalTask(Task):
+    def apply_async(
+        self,
+        args=None,
+        kwargs=None,
+        task_id: str | None = None,
+        countdown: float | None = None,
+        eta: datetime | None = None,
+        **options,
+    ):
+        task_id = task_id or uuid()
+
+        headers = {}
+        tracing.inject(headers)
+        if (id := request_id.get()) is not None:
+            headers["request_id"] = id
+
+        run = partial(self.apply, args, kwargs, task_id=task_id, headers=headers)
+        if eta is not None:
+            countdown = (eta - datetime.now(timezone.utc)).total_seconds()
+
+        if countdown and countdown > 0:
+            timer = threading.Timer(countdown, _executor.submit, (run,))
+            timer.daemon = True
+            timer.start()
+        else:
+            _executor.submit(run)
+
+        return self.AsyncResult(task_id)
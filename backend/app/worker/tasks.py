@@ -1,35 +1,138 @@
+import threading
+from contextvars import Token
+from time import perf_counter
+from uuid import UUID
+
 from asgiref.sync import async_to_sync
 from celery import Celery
-from fastapi_mail import ConnectionConfig, FastMail, MessageSchema, MessageType
+from celery.signals import (
+    after_task_publish,
+    before_task_publish,
+    task_postrun,
+    task_prerun,
+    worker_process_init,
+)
 from pydantic import EmailStr
-from twilio.rest import Client
 
-from app.config import db_settings, notification_settings
-from app.utils import TEMPLATE_DIR
+from app.config import app_settings, db_settings, notification_settings
+from app.core import tracing
+from app.core.logging import request_id
+from app.core.metrics import CELERY_PUBLISH_SECONDS
+from app.services.webhook import (
+    WEBHOOK_MAX_ATTEMPTS,
+    WebhookDeliveryFailed,
+    WebhookEndpointBusy,
+    dead_letter_webhook_batch,
+    deliver_webhook_batch,
+    webhook_backoff,
+)
 
-fast_mail = FastMail(
-    ConnectionConfig(
-        **notification_settings.model_dump(
-            exclude=["TWILIO_SID", "TWILIO_AUTH_TOKEN", "TWILIO_NUMBER"]
-        ),
-        TEMPLATE_FOLDER=TEMPLATE_DIR,
+
+# Tasks are published by the api process too, the mail and
+# twilio clients (and their imports) are only loaded to run them
+def send_message(*args, **kwargs):
+    from app.services.notification import get_fastmail
+
+    with tracing.span("smtp send", tracing.CLIENT):
+        return async_to_sync(get_fastmail().send_message)(*args, **kwargs)
+
+
+if app_settings.LOCAL_MODE:
+    from app.worker.local import LocalTask
+
+    # Tasks run on threads of the api process
+    app = Celery(
+        "api_tasks",
+        broker="memory://",
+        task_cls=LocalTask,
+        task_always_eager=True,
+    )
+else:
+    app = Celery(
+        "api_tasks",
+        broker=db_settings.REDIS_URL(9),
+        backend=db_settings.REDIS_URL(9),
+        broker_connection_retry_on_startup=True,
     )
-)
 
-twilio_client = Client(
-    notification_settings.TWILIO_SID,
-    notification_settings.TWILIO_AUTH_TOKEN,
-)
+# Tasks are published synchronously by the calling thread
+_publish = threading.local()
 
-send_message = async_to_sync(fast_mail.send_message)
 
+@before_task_publish.connect
+def _start_publish(sender: str, headers: dict, **kwargs):
+    _publish.start = perf_counter()
+    _publish.span = None
+
+    # Task runs in the trace of the request (or task) queuing it
+    parent = tracing.current_span.get()
+    if parent is not None and parent.sampled:
+        _publish.span = parent.child(
+            f"celery publish {sender}",
+            tracing.PRODUCER,
+            **{"messaging.system": "celery"},
+        )
+        headers["traceparent"] = _publish.span.traceparent
+    else:
+        tracing.inject(headers)
+
+    # Logs of the task share the id of the request
+    if (id := request_id.get()) is not None:
+        headers["request_id"] = id
+
+
+@after_task_publish.connect
+def _record_publish(sender: str, **kwargs):
+    CELERY_PUBLISH_SECONDS.observe(perf_counter() - _publish.start, sender)
+    if _publish.span is not None:
+        _publish.span.finish()
+
+
+@worker_process_init.connect
+def _name_worker_traces(**kwargs):
+    tracing.exporter.service = f"{app_settings.APP_NAME.lower()}-worker"
 
-app = Celery(
-    "api_tasks",
-    broker=db_settings.REDIS_URL(9),
-    backend=db_settings.REDIS_URL(9),
-    broker_connection_retry_on_startup=True,
-)
+
+@worker_process_init.connect
+def _load_notification_clients(**kwargs):
+    # Workers load them up front instead of on the first task
+    from app.services import notification  # noqa: F401
+
+
+# Root spans of the tasks being run, with the context tokens
+_task_spans: dict[str, tuple[tracing.Span, Token, Token]] = {}
+
+
+def _header(task, name: str) -> str | None:
+    # Headers of eagerly applied tasks aren't request attributes
+    return task.request.get(name) or (task.request.headers or {}).get(name)
+
+
+@task_prerun.connect
+def _start_task_span(task_id: str, task, **kwargs):
+    root = tracing.start_trace(
+        f"celery run {task.name}",
+        _header(task, "traceparent"),
+        tracing.CONSUMER,
+        **{"messaging.system": "celery", "messaging.message.id": task_id},
+    )
+    _task_spans[task_id] = (
+        root,
+        tracing.current_span.set(root),
+        request_id.set(_header(task, "request_id") or task_id),
+    )
+
+
+@task_postrun.connect
+def _finish_task_span(task_id: str, state: str | None = None, **kwargs):
+    root, span_token, id_token = _task_spans.pop(task_id, (None, None, None))
+    if root is None:
+        return
+    tracing.current_span.reset(span_token)
+    request_id.reset(id_token)
+    if state == "FAILURE":
+        root.error = repr(kwargs.get("retval"))
+    root.finish()
 
 
 @app.task
@@ -38,6 +141,8 @@ def send_mail(
     subject: str,
     body: str,
 ):
+    from fastapi_mail import MessageSchema, MessageType
+
     send_message(
         message=MessageSchema(
             recipients=recipients,
@@ -56,6 +161,8 @@ def send_email_with_template(
     context: dict,
     template_name: str,
 ):
+    from fastapi_mail import MessageSchema, MessageType
+
     send_message(
         message=MessageSchema(
             recipients=recipients,
@@ -69,8 +176,47 @@ def send_email_with_template(
 
 @app.task
 def send_sms(to: str, body: str):
-    twilio_client.messages.create(
-        from_=notification_settings.TWILIO_NUMBER,
-        to=to,
-        body=body,
-    )
\ No newline at end of file
+    from app.services.notification import get_twilio_client
+
+    with tracing.span("twilio send sms", tracing.CLIENT):
+        get_twilio_client().messages.create(
+            from_=notification_settings.TWILIO_NUMBER,
+            to=to,
+            body=body,
+        )
+
+@app.task(bind=True)
+def deliver_webhooks(
+    self,
+    endpoint_id: str,
+    batch: str | None = None,
+    attempt: int = 0,
+):
+    try:
+        has_more = async_to_sync(deliver_webhook_batch)(UUID(endpoint_id), batch)
+    except WebhookEndpointBusy:
+        # Try again once a delivery slot frees up
+        self.apply_async(
+            kwargs={"endpoint_id": endpoint_id, "batch": batch, "attempt": attempt},
+            countdown=1,
+        )
+        return
+    except WebhookDeliveryFailed as error:
+        if attempt + 1 >= WEBHOOK_MAX_ATTEMPTS:
+            async_to_sync(dead_letter_webhook_batch)(
+                UUID(endpoint_id), error.batch, error.events, str(error), attempt + 1
+            )
+            return
+        self.apply_async(
+            kwargs={
+                "endpoint_id": endpoint_id,
+                "batch": error.batch,
+                "attempt": attempt + 1,
+            },
+            countdown=webhook_backoff(attempt),
+        )
+        return
+
+    # Keep draining the queue
+    if has_more:
+        self.apply_async(kwargs={"endpoint_id": endpoint_id})
@@ -0,0 +1,462 @@
+"""Synthetic data for scale testing
+
+Bulk loads sellers, delivery partners, locations and the ones each
+partner services, and shipments with their timelines, tags and
+reviews. The same seed (and --end) always generates the same rows,
+ids of missing tags and password hashes (salted from the seed) too.
+
+Shipments are spread over sellers with a power law (--skew), so the
+first sellers get most of them, like the few large sellers in
+production. Their timelines run from placed to delivered (or cancelled)
+and stop at --end, recent shipments are still on their way.
+
+Rows are written with COPY on postgres, with multi-row inserts on
+other databases, in chunks of shipments:
+
+    python -m benchmarks.generate --sellers 1000 --partners 200 \\
+        --locations 5000 --shipments 2500000 --seed 1
+
+Run it on a database with the schema (`alembic upgrade head`, or
+--create-tables) and no generated data of the same seed yet. All
+users have the password of --password.
+"""
+
+import argparse
+import asyncio
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate
+from time import perf_counter
+from uuid import UUID
+
+from sqlalchemy import Table, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+from sqlmodel import SQLModel
+
+from app.database.models import (
+    DeliveryPartner,
+    Location,
+    Review,
+    Seller,
+    ServicableLocation,
+    Shipment,
+    ShipmentEvent,
+    ShipmentStatus,
+    ShipmentTag,
+    Tag,
+    TagName,
+)
+
+FIRST_ZIP_CODE = 10_000
+CONTENTS = (
+    "Books",
+    "Electronics",
+    "Clothing",
+    "Shoes",
+    "Groceries",
+    "Furniture parts",
+    "Toys",
+    "Documents",
+    "Medicine",
+    "Kitchenware",
+)
+COMMENTS = ("Fast delivery", "Well packed", "Arrived late", "Box was damaged", None)
+INSTRUCTIONS = {
+    TagName.EXPRESS: "Deliver before standard shipments",
+    TagName.STANDARD: "Regular handling",
+    TagName.FRAGILE: "Handle with care",
+    TagName.HEAVY: "Use lifting equipment",
+    TagName.INTERNATIONAL: "Check customs documents",
+    TagName.DOMESTIC: "Regular handling",
+    TagName.TEMPERATURE_CONTROLLED: "Keep refrigerated",
+    TagName.GIFT: "Do not include the invoice",
+    TagName.RETURN: "Return to the seller",
+    TagName.DOCUMENTS: "Keep dry and flat",
+}
+
+
+class Writer:
+    """Writes rows with COPY on postgres (asyncpg),
+    multi-row inserts otherwise"""
+
+    def __init__(self, connection: AsyncConnection):
+        self.connection = connection
+        self.copy = connection.dialect.name == "postgresql"
+        self.rows: dict[str, int] = {}
+
+    async def write(self, table: Table, columns: tuple[str, ...], rows: list[tuple]):
+        if not rows:
+            return
+        if self.copy:
+            raw = await self.connection.get_raw_connection()
+            await raw.driver_connection.copy_records_to_table(
+                table.name,
+                records=rows,
+                columns=columns,
+            )
+        else:
+            await self.connection.execute(
+                insert(table),
+                [dict(zip(columns, row)) for row in rows],
+            )
+        self.rows[table.name] = self.rows.get(table.name, 0) + len(rows)
+
+
+class Generator:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.end = args.end
+
+        self.sellers: list[tuple[UUID, int]] = []
+        self.partners: list[tuple[UUID, list[int]]] = []
+        self.tags: list[UUID] = []
+        self.seq = 0
+
+    def uuid(self) -> UUID:
+        return UUID(int=self.rng.getrandbits(128), version=4)
+
+    def timestamp(self, days: float) -> datetime:
+        return self.end - timedelta(seconds=self.rng.uniform(0, days * 86_400))
+
+    async def locations(self, writer: Writer) -> list[int]:
+        zip_codes = range(FIRST_ZIP_CODE, FIRST_ZIP_CODE + self.args.locations)
+        existing = set(
+            await writer.connection.scalars(
+                select(Location.zip_code).where(
+                    Location.zip_code.between(zip_codes[0], zip_codes[-1])
+                )
+            )
+        )
+        await writer.write(
+            Location.__table__,
+            ("zip_code",),
+            [(zip_code,) for zip_code in zip_codes if zip_code not in existing],
+        )
+        return list(zip_codes)
+
+    async def tag_ids(self, writer: Writer):
+        # Tags are shared with the app, only missing ones are added
+        tags = dict(
+            (await writer.connection.execute(select(Tag.name, Tag.id))).all()
+        )
+        # Ids drawn for every tag, the rows after them don't
+        # depend on the tags the database already has
+        ids = {name: self.uuid() for name in TagName}
+        missing = [
+            {"id": ids[name], "name": name, "instruction": INSTRUCTIONS[name]}
+            for name in TagName
+            if name not in tags
+        ]
+        if missing:
+            await writer.connection.execute(insert(Tag.__table__), missing)
+            tags.update((tag["name"], tag["id"]) for tag in missing)
+        # Ids differ between databases, tags are picked by name
+        self.tags = [tags[name] for name in TagName]
+
+    async def users(self, writer: Writer, zip_codes: list[int], password_hash: str):
+        rng = self.rng
+        seed = self.args.seed
+        sellers = []
+        for n in range(self.args.sellers):
+            id, zip_code = self.uuid(), rng.choice(zip_codes)
+            self.sellers.append((id, zip_code))
+            sellers.append(
+                (
+                    id,
+                    self.timestamp(self.args.days * 2),
+                    f"Seller {n}",
+                    f"seller-{seed}-{n}@example.com",
+                    True,
+                    password_hash,
+                    f"{n} Market Street",
+                    zip_code,
+                )
+            )
+        await writer.write(
+            Seller.__table__,
+            (
+                "id",
+                "created_at",
+                "name",
+                "email",
+                "email_verified",
+                "password_hash",
+                "address",
+                "zip_code",
+            ),
+            sellers,
+        )
+
+        partners, links = [], []
+        for n in range(self.args.partners):
+            id = self.uuid()
+            serviced = rng.sample(
+                zip_codes, min(self.args.zips_per_partner, len(zip_codes))
+            )
+            self.partners.append((id, serviced))
+            partners.append(
+                (
+                    id,
+                    self.timestamp(self.args.days * 2),
+                    f"Partner {n}",
+                    f"partner-{seed}-{n}@example.com",
+                    True,
+                    password_hash,
+                    1_000_000,
+                )
+            )
+            links.extend((id, zip_code) for zip_code in serviced)
+        await writer.write(
+            DeliveryPartner.__table__,
+            (
+                "id",
+                "created_at",
+                "name",
+                "email",
+                "email_verified",
+                "password_hash",
+                "max_handling_capacity",
+            ),
+            partners,
+        )
+        await writer.write(
+            ServicableLocation.__table__, ("partner_id", "location_id"), links
+        )
+
+    def timeline(
+        self,
+        shipment_id: UUID,
+        created_at: datetime,
+        origin: int,
+        destination: int,
+        zip_codes: list[int],
+    ) -> list[tuple]:
+        rng = self.rng
+        hops = [rng.choice(zip_codes) for _ in range(rng.randint(1, 3))]
+        steps = [
+            (ShipmentStatus.placed, origin, "assigned delivery partner"),
+            *((ShipmentStatus.in_transit, zip, f"scanned at {zip}") for zip in hops),
+            (ShipmentStatus.out_for_delivery, destination, "shipment out for delivery"),
+            (ShipmentStatus.delivered, destination, "successfully delivered"),
+        ]
+        if rng.random() < self.args.cancel_rate:
+            steps = [
+                *steps[: rng.randint(1, 2)],
+                (ShipmentStatus.cancelled, origin, "cancelled by seller"),
+            ]
+
+        events = []
+        timestamp = created_at
+        for status, location, description in steps:
+            if timestamp > self.end:
+                break
+            self.seq += 1
+            events.append(
+                (
+                    self.uuid(),
+                    timestamp,
+                    self.seq,
+                    location,
+                    status,
+                    description,
+                    shipment_id,
+                )
+            )
+            timestamp += timedelta(hours=rng.uniform(2, 30))
+        return events
+
+    async def shipments(self, writer: Writer, zip_codes: list[int], count: int):
+        rng = self.rng
+        args = self.args
+        seller_weights = list(
+            accumulate(1 / (n + 1) ** args.skew for n in range(len(self.sellers)))
+        )
+        shipments, events, tags, reviews = [], [], [], []
+
+        for seller_id, origin in rng.choices(
+            self.sellers, cum_weights=seller_weights, k=count
+        ):
+            partner_id, serviced = rng.choice(self.partners)
+            destination = rng.choice(serviced)
+            id = self.uuid()
+            created_at = self.timestamp(args.days)
+            shipments.append(
+                (
+                    id,
+                    created_at,
+                    f"client{rng.randrange(1_000_000)}@example.com",
+                    f"+1555{rng.randrange(10_000_000):07d}"
+                    if rng.random() < 0.5
+                    else None,
+                    rng.choice(CONTENTS),
+                    round(rng.uniform(0.1, 25), 1),
+                    destination,
+                    created_at + timedelta(days=rng.randint(2, 7)),
+                    seller_id,
+                    partner_id,
+                )
+            )
+
+            timeline = self.timeline(id, created_at, origin, destination, zip_codes)
+            events.extend(timeline)
+
+            tag_count = rng.choices((0, 1, 2, 3), (50, 30, 15, 5))[0]
+            tags.extend((id, tag_id) for tag_id in rng.sample(self.tags, tag_count))
+
+            last = timeline[-1]
+            if last[4] == ShipmentStatus.delivered and rng.random() < args.review_rate:
+                reviews.append(
+                    (
+                        self.uuid(),
+                        last[1] + timedelta(hours=rng.uniform(1, 72)),
+                        rng.choices((1, 2, 3, 4, 5), (5, 5, 10, 30, 50))[0],
+                        rng.choice(COMMENTS),
+                        id,
+                    )
+                )
+
+        await writer.write(
+            Shipment.__table__,
+            (
+                "id",
+                "created_at",
+                "client_contact_email",
+                "client_contact_phone",
+                "content",
+                "weight",
+                "destination",
+                "estimated_delivery",
+                "seller_id",
+                "delivery_partner_id",
+            ),
+            shipments,
+        )
+        await writer.write(
+            ShipmentEvent.__table__,
+            (
+                "id",
+                "created_at",
+                "seq",
+                "location",
+                "status",
+                "description",
+                "shipment_id",
+            ),
+            events,
+        )
+        await writer.write(ShipmentTag.__table__, ("shipment_id", "tag_id"), tags)
+        await writer.write(
+            Review.__table__,
+            ("id", "created_at", "rating", "comment", "shipment_id"),
+            reviews,
+        )
+
+
+async def generate(args: argparse.Namespace, password_hash: str):
+    engine = create_async_engine(args.url)
+    generator = Generator(args)
+    start = perf_counter()
+
+    if args.create_tables:
+        async with engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+
+    async with engine.begin() as connection:
+        writer = Writer(connection)
+        zip_codes = await generator.locations(writer)
+        await generator.tag_ids(writer)
+        await generator.users(writer, zip_codes, password_hash)
+        # Event numbers follow the ones already in the change feed
+        generator.seq = (
+            await connection.scalar(text("SELECT max(seq) FROM shipment_event"))
+            or 0
+        )
+        rows = writer.rows
+
+    remaining = args.shipments
+    while remaining > 0:
+        count = min(args.chunk, remaining)
+        async with engine.begin() as connection:
+            writer = Writer(connection)
+            await generator.shipments(writer, zip_codes, count)
+        for table, n in writer.rows.items():
+            rows[table] = rows.get(table, 0) + n
+        remaining -= count
+
+        elapsed = perf_counter() - start
+        print(
+            f"{args.shipments - remaining:>10} shipments "
+            f"{rows['shipment_event']:>11} events {elapsed:8.1f}s",
+            flush=True,
+        )
+
+    if engine.dialect.name == "postgresql":
+        async with engine.begin() as connection:
+            # New events are numbered after the generated ones
+            await connection.execute(
+                text("SELECT setval('shipment_event_seq', :seq)"),
+                {"seq": max(generator.seq, 1)},
+            )
+    await engine.dispose()
+
+    elapsed = perf_counter() - start
+    for table, n in rows.items():
+        print(f"{table:>20} {n:>11} rows")
+    print(f"{sum(rows.values()):,} rows in {elapsed:.1f}s")
+
+
+# Characters of a bcrypt salt, the last one only carries 4 bits
+_SALT_CHARACTERS = "./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+
+
+def password_hash(password: str, seed: int) -> str:
+    """Bcrypt hash with a salt drawn from the seed, the same for every
+    run of a seed"""
+    from app.services.user import password_context
+
+    rng = random.Random(f"{seed}-salt")
+    salt = "".join(rng.choices(_SALT_CHARACTERS, k=21)) + rng.choice(".Oeu")
+    return password_context.handler().using(salt=salt).hash(password)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="Database url, the app's one by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--end",
+        type=datetime.fromisoformat,
+        default=datetime.now().replace(hour=0, minute=0, second=0, microsecond=0),
+        help="Time the data is generated up to, today by default",
+    )
+    parser.add_argument("--days", type=float, default=365, help="Days of shipments")
+    parser.add_argument("--sellers", type=int, default=100)
+    parser.add_argument("--partners", type=int, default=20)
+    parser.add_argument("--locations", type=int, default=1000)
+    parser.add_argument("--zips-per-partner", type=int, default=50)
+    parser.add_argument("--shipments", type=int, default=100_000)
+    parser.add_argument(
+        "--skew",
+        type=float,
+        default=1,
+        help="Power law exponent of shipments per seller, 0 spreads them evenly",
+    )
+    parser.add_argument("--cancel-rate", type=float, default=0.05)
+    parser.add_argument("--review-rate", type=float, default=0.3)
+    parser.add_argument("--chunk", type=int, default=20_000, help="Shipments per write")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--create-tables", action="store_true")
+    args = parser.parse_args()
+
+    if args.url is None:
+        from app.config import db_settings
+
+        args.url = db_settings.POSTGRES_URL
+
+    # Hashed once, bcrypt takes a while
+    asyncio.run(generate(args, password_hash(args.password, args.seed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+"""End to end load test of a running api
+
+Simulated users run scenarios picked at random by weight, for a
+fixed duration:
+
+    signup   seller signs up, verifies the email and logs in
+    login    seller logs in
+    submit   seller submits a shipment
+    deliver  partner moves a shipment to out for delivery, reads the
+             otp sent to the client by sms and marks it delivered
+    track    client polls a shipment
+    listing  seller or partner lists their shipments
+
+Emails and sms are read from the stand-ins of app.fakes.smtp and
+app.fakes.twilio, run the compose stack with them:
+
+    docker compose -f compose.yaml -f compose.load.yaml up -d
+    python -m benchmarks.load --duration 60 --users 50 \\
+        --mix submit=2,deliver=1,track=10,listing=3 --output load.json
+
+Or against a single process in local mode, without docker:
+
+    LOCAL_MODE=true LOGIN_LIMIT_IP=1000000 LOGIN_LIMIT_ACCOUNT=1000000 \\
+        PASSWORD_RESET_LIMIT_IP=1000000 PASSWORD_RESET_LIMIT_ACCOUNT=1000000 \\
+        fastapi run app/main.py --workers 1
+    python -m benchmarks.load --smtp-url http://localhost:8000/local/smtp \\
+        --twilio-url http://localhost:8000/local/twilio
+
+All users log in from the same address, the login and password reset
+rate limits are lifted (compose.load.yaml does it too) so the error
+rate is the api's, not the limiter's.
+
+Admission control (app.core.admission) sheds requests a worker can't
+take in time with a 503, they are counted as errors. Logins and
+signups are the first shed, 4 at a time per worker spend most of their
+time hashing passwords: with many users, a mix heavy on them (like
+the default) reports a share of them shed. That is the api protecting
+itself, lower their weights in `--mix` to measure the other routes.
+
+Runs are reproducible for a seed. The report has the throughput,
+latency percentiles and error rate of each endpoint, along with the
+time for notifications to reach the stand-ins, pass it as
+`--baseline` to a later run to compare them. The accounts of a seed are
+made again by each run, start from an empty database (remove local.db)
+or pass another `--seed`.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from math import ceil
+from time import perf_counter
+
+import httpx
+
+SCENARIOS = ("signup", "login", "submit", "deliver", "track", "listing")
+DEFAULT_MIX = {
+    "signup": 1,
+    "login": 2,
+    "submit": 4,
+    "deliver": 2,
+    "track": 12,
+    "listing": 4,
+}
+PASSWORD = "load-test-password"
+# Zip codes of partners, one each so the partner of a shipment is known
+FIRST_ZIP_CODE = 20_000
+# Signups run at once in the setup, like the logins admission control
+# lets through at once (app.core.admission), requests it sheds anyway
+# are retried after their Retry-After
+SETUP_CONCURRENCY = 4
+SETUP_RETRIES = 10
+
+_VERIFY_TOKEN = re.compile(r"/verify\?token=([\w.\-]+)")
+_OTP = re.compile(r"\b(\d{6})\b")
+
+
+@dataclass
+class Config:
+    base_url: str = "http://localhost:8000"
+    smtp_url: str = "http://localhost:8092"
+    twilio_url: str = "http://localhost:8090"
+    duration: float = 60
+    users: int = 20
+    sellers: int = 10
+    partners: int = 5
+    mix: dict[str, int] = field(default_factory=lambda: dict(DEFAULT_MIX))
+    seed: int = 0
+    # Seconds to wait for an email or sms to reach the stand-ins
+    notification_timeout: float = 30
+    label: str = ""
+
+
+def percentile(values: list[float], p: float) -> float:
+    # Nearest rank, values are sorted
+    return values[max(ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def summary(values: list[float]) -> dict:
+    values = sorted(values)
+    return {
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "mean": round(sum(values) / len(values) * 1000, 2),
+        "max": round(values[-1] * 1000, 2),
+    }
+
+
+class Recorder:
+    """Latencies (seconds) and statuses of requests, by endpoint"""
+
+    def __init__(self):
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.statuses: defaultdict[str, Counter] = defaultdict(Counter)
+        self.errors: Counter[str] = Counter()
+        # Time for emails and sms to reach the stand-ins
+        self.notifications: defaultdict[str, list[float]] = defaultdict(list)
+        self.enabled = True
+
+    def record(self, endpoint: str, seconds: float, status: int | str, ok: bool):
+        if not self.enabled:
+            return
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][str(status)] += 1
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def report(self, config: Config, started_at: datetime, duration: float) -> dict:
+        endpoints = {}
+        for endpoint in sorted(self.latencies):
+            latencies = self.latencies[endpoint]
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "error_rate": round(self.errors[endpoint] / len(latencies), 4),
+                "throughput": round(len(latencies) / duration, 2),
+                "latency_ms": summary(latencies),
+                "statuses": dict(sorted(self.statuses[endpoint].items())),
+            }
+
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        errors = sum(self.errors.values())
+        return {
+            "label": config.label,
+            "started_at": started_at.isoformat(),
+            "duration": round(duration, 2),
+            "config": asdict(config),
+            "totals": {
+                "requests": requests,
+                "errors": errors,
+                "error_rate": round(errors / requests, 4) if requests else 0,
+                "throughput": round(requests / duration, 2),
+            },
+            "endpoints": endpoints,
+            "notifications_ms": {
+                kind: summary(latencies)
+                for kind, latencies in sorted(self.notifications.items())
+            },
+        }
+
+
+class ScenarioFailed(Exception):
+    pass
+
+
+@dataclass
+class Account:
+    email: str
+    token: str = ""
+    zip_code: int = 0
+
+
+class LoadTest:
+    def __init__(self, config: Config):
+        self.config = config
+        self.recorder = Recorder()
+        self.sellers: list[Account] = []
+        self.partners: list[Account] = []
+        # Shipments placed and not yet delivered, by partner email
+        self.placed: defaultdict[str, list[tuple[str, str]]] = defaultdict(list)
+        self.shipments: list[str] = []
+        self._ids = 0
+
+    def _next_id(self) -> int:
+        self._ids += 1
+        return self._ids
+
+    async def request(
+        self,
+        client: httpx.AsyncClient,
+        method: str,
+        endpoint: str,
+        token: str | None = None,
+        expected: int = 200,
+        **kwargs,
+    ) -> httpx.Response:
+        """Request to an endpoint (route template), raises
+        ScenarioFailed on errors, after recording them"""
+        if token:
+            kwargs["headers"] = {"Authorization": f"Bearer {token}"}
+
+        start = perf_counter()
+        name = f"{method} {endpoint}"
+        for attempt in range(SETUP_RETRIES + 1):
+            try:
+                response = await client.request(method, endpoint, **kwargs)
+            except httpx.HTTPError as error:
+                self.recorder.record(
+                    name, perf_counter() - start, type(error).__name__, False
+                )
+                raise ScenarioFailed(f"{name}: {error!r}")
+
+            # Only the setup waits out shedding, runs report it
+            if (
+                response.status_code != 503
+                or self.recorder.enabled
+                or attempt == SETUP_RETRIES
+            ):
+                break
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+
+        ok = response.status_code == expected
+        self.recorder.record(name, perf_counter() - start, response.status_code, ok)
+        if not ok:
+            raise ScenarioFailed(f"{name}: HTTP {response.status_code}")
+        return response
+
+    async def wait_for_notification(
+        self,
+        stand_in: httpx.AsyncClient,
+        kind: str,
+        to: str,
+        pattern: re.Pattern,
+    ) -> str:
+        """First match of a pattern in the mail or sms sent to `to`"""
+        start = perf_counter()
+        while perf_counter() - start < self.config.notification_timeout:
+            response = await stand_in.get("/messages", params={"to": to})
+            for message in reversed(response.json()):
+                if match := pattern.search(message["body"]):
+                    if self.recorder.enabled:
+                        self.recorder.notifications[kind].append(
+                            perf_counter() - start
+                        )
+                    return match.group(1)
+            await asyncio.sleep(0.1)
+        raise ScenarioFailed(f"No {kind} to {to}")
+
+    ### Scenarios
+
+    async def signup(self, client, rng: random.Random, kind: str = "seller"):
+        id = self._next_id()
+        account = Account(email=f"load-{kind}-{self.config.seed}-{id}@example.com")
+        if kind == "seller":
+            data = {
+                "name": f"Seller {id}",
+                "address": f"{id} Load Street",
+                "zip_code": FIRST_ZIP_CODE - 1,
+            }
+        else:
+            account.zip_code = FIRST_ZIP_CODE + id
+            data = {
+                "name": f"Partner {id}",
+                "max_handling_capacity": 1_000_000,
+                "serviceable_zip_codes": [account.zip_code],
+            }
+
+        await self.request(
+            client,
+            "POST",
+            f"/{kind}/signup",
+            json={**data, "email": account.email, "password": PASSWORD},
+        )
+        token = await self.wait_for_notification(
+            self.smtp, "email", account.email, _VERIFY_TOKEN
+        )
+        await self.request(client, "GET", f"/{kind}/verify", params={"token": token})
+        await self.login(client, rng, account, kind)
+
+        (self.sellers if kind == "seller" else self.partners).append(account)
+
+    async def login(
+        self,
+        client,
+        rng: random.Random,
+        account: Account | None = None,
+        kind: str = "seller",
+    ):
+        account = account or rng.choice(self.sellers)
+        response = await self.request(
+            client,
+            "POST",
+            f"/{kind}/token",
+            data={"username": account.email, "password": PASSWORD},
+        )
+        account.token = response.json()["access_token"]
+
+    async def submit(self, client, rng: random.Random):
+        seller = rng.choice(self.sellers)
+        partner = rng.choice(self.partners)
+        phone = f"+1555{self._next_id():07d}"
+        response = await self.request(
+            client,
+            "POST",
+            "/shipment/",
+            token=seller.token,
+            json={
+                "content": "Load test parcel",
+                "weight": round(rng.uniform(0.5, 20), 1),
+                "destination": partner.zip_code,
+                "client_contact_email": "client@example.com",
+                "client_contact_phone": phone,
+            },
+        )
+        id = response.json()["id"]
+        self.shipments.append(id)
+        self.placed[partner.email].append((id, phone))
+
+    async def deliver(self, client, rng: random.Random):
+        partners = [partner for partner in self.partners if self.placed[partner.email]]
+        if not partners:
+            return await self.submit(client, rng)
+        partner = rng.choice(partners)
+        id, phone = self.placed[partner.email].pop(0)
+
+        await self.request(
+            client,
+            "PATCH",
+            "/shipment/",
+            token=partner.token,
+            params={"id": id},
+            json={"status": "out_for_delivery", "location": partner.zip_code},
+        )
+        code = await self.wait_for_notification(self.twilio, "sms", phone, _OTP)
+        await self.request(
+            client,
+            "PATCH",
+            "/shipment/",
+            token=partner.token,
+            params={"id": id},
+            json={
+                "status": "delivered",
+                "location": partner.zip_code,
+                "verification_code": code,
+            },
+        )
+
+    async def track(self, client, rng: random.Random):
+        if not self.shipments:
+            return await self.submit(client, rng)
+        await self.request(
+            client,
+            "GET",
+            "/shipment/",
+            params={"id": rng.choice(self.shipments)},
+        )
+
+    async def listing(self, client, rng: random.Random):
+        if rng.random() < 0.5:
+            await self.request(
+                client, "GET", "/seller/shipments", token=rng.choice(self.sellers).token
+            )
+        else:
+            await self.request(
+                client,
+                "GET",
+                "/partner/shipments",
+                token=rng.choice(self.partners).token,
+            )
+
+    ### Run
+
+    async def setup(self, client: httpx.AsyncClient):
+        """Accounts and shipments the scenarios start from, not
+        part of the results"""
+        rng = random.Random(self.config.seed)
+        self.recorder.enabled = False
+        slots = asyncio.Semaphore(SETUP_CONCURRENCY)
+
+        async def signup(kind: str):
+            async with slots:
+                await self.signup(client, rng, kind)
+
+        await asyncio.gather(*(signup("partner") for _ in range(self.config.partners)))
+        await asyncio.gather(*(signup("seller") for _ in range(self.config.sellers)))
+        for _ in range(self.config.sellers):
+            await self.submit(client, rng)
+        self.recorder.enabled = True
+
+    async def user(self, client: httpx.AsyncClient, n: int, deadline: float):
+        rng = random.Random(f"{self.config.seed}-{n}")
+        scenarios = [name for name in SCENARIOS if self.config.mix.get(name)]
+        weights = [self.config.mix[name] for name in scenarios]
+
+        while perf_counter() < deadline:
+            scenario = rng.choices(scenarios, weights)[0]
+            try:
+                await getattr(self, scenario)(client, rng)
+            except ScenarioFailed as error:
+                print(f"{scenario}: {error}", file=sys.stderr)
+
+    async def run(self) -> dict:
+        limits = httpx.Limits(max_connections=self.config.users)
+        async with (
+            httpx.AsyncClient(
+                base_url=self.config.base_url, limits=limits, timeout=30
+            ) as client,
+            httpx.AsyncClient(base_url=self.config.smtp_url) as self.smtp,
+            httpx.AsyncClient(base_url=self.config.twilio_url) as self.twilio,
+        ):
+            await self.setup(client)
+
+            started_at = datetime.now(timezone.utc)
+            start = perf_counter()
+            deadline = start + self.config.duration
+            await asyncio.gather(
+                *(self.user(client, n, deadline) for n in range(self.config.users))
+            )
+            duration = perf_counter() - start
+
+        return self.recorder.report(self.config, started_at, duration)
+
+
+def compare(report: dict, baseline: dict) -> str:
+    """Changes of throughput and latencies from a baseline report"""
+
+    def change(old: float, new: float) -> str:
+        return f"{old:>9} -> {new:>9} ({(new - old) / old:+.0%})" if old else f"{new:>9}"
+
+    lines = []
+    for endpoint, stats in report["endpoints"].items():
+        old = baseline["endpoints"].get(endpoint)
+        if old is None:
+            continue
+        lines.append(endpoint)
+        lines.append(f"  throughput {change(old['throughput'], stats['throughput'])}")
+        for p in ("p50", "p95", "p99"):
+            lines.append(
+                f"  {p} (ms)   {change(old['latency_ms'][p], stats['latency_ms'][p])}"
+            )
+        lines.append(f"  error rate {old['error_rate']:>9} -> {stats['error_rate']:>9}")
+    return "\n".join(lines)
+
+
+def _mix(value: str) -> dict[str, int]:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def main():
+    defaults = Config()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--base-url", default=defaults.base_url)
+    parser.add_argument("--smtp-url", default=defaults.smtp_url)
+    parser.add_argument("--twilio-url", default=defaults.twilio_url)
+    parser.add_argument("--duration", type=float, default=defaults.duration)
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--sellers", type=int, default=defaults.sellers)
+    parser.add_argument("--partners", type=int, default=defaults.partners)
+    parser.add_argument(
+        "--mix",
+        type=_mix,
+        default=defaults.mix,
+        help="Weights of scenarios, like submit=2,track=10",
+    )
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--label", default="", help="Release or commit tested")
+    parser.add_argument("--output", help="File to write the json report to")
+    parser.add_argument("--baseline", help="Earlier report to compare with")
+    args = parser.parse_args()
+
+    baseline = args.baseline
+    output = args.output
+    del args.baseline, args.output
+    config = Config(**vars(args))
+
+    report = asyncio.run(LoadTest(config).run())
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+    if baseline:
+        with open(baseline) as file:
+            print(compare(report, json.load(file)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Memory footprint of a large shipment listing
+
+Loads the shipments of a seller as ORM instances (with timeline and
+tags) and as the read models of app.api.serialization, and reports
+the memory each takes per shipment, traced with tracemalloc.
+
+    python -m benchmarks.memory [shipments]
+"""
+
+import asyncio
+import gc
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import lazyload, selectinload
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel, select
+
+from app.database.models import (
+    Seller,
+    Shipment,
+    ShipmentEvent,
+    ShipmentStatus,
+    ShipmentTag,
+    Tag,
+    TagName,
+)
+from app.services.shipment import ShipmentService
+
+SHIPMENTS = 100_000
+EVENTS_PER_SHIPMENT = 2
+CHUNK = 5_000
+
+SELLER_ID = uuid4()
+
+
+async def populate(engine, shipments: int):
+    now = datetime.now()
+    tags = [
+        {"id": uuid4(), "name": TagName.FRAGILE, "instruction": "Handle with care"},
+        {"id": uuid4(), "name": TagName.EXPRESS, "instruction": "Deliver first"},
+    ]
+
+    async with engine.begin() as connection:
+        await connection.run_sync(SQLModel.metadata.create_all)
+        await connection.execute(insert(Tag), tags)
+
+        for start in range(0, shipments, CHUNK):
+            rows = [
+                {
+                    "id": uuid4(),
+                    "created_at": now + timedelta(seconds=i),
+                    "client_contact_email": "client@example.com",
+                    "content": f"shipment {i}",
+                    "weight": 1.5,
+                    "destination": 11001,
+                    "estimated_delivery": now + timedelta(days=3),
+                    "seller_id": SELLER_ID,
+                    "delivery_partner_id": uuid4(),
+                }
+                for i in range(start, min(start + CHUNK, shipments))
+            ]
+            await connection.execute(insert(Shipment), rows)
+            await connection.execute(
+                insert(ShipmentEvent),
+                [
+                    {
+                        "id": uuid4(),
+                        "created_at": row["created_at"] + timedelta(hours=n),
+                        "location": 11001,
+                        "status": ShipmentStatus.in_transit,
+                        "description": "scanned at 11001",
+                        "shipment_id": row["id"],
+                    }
+                    for row in rows
+                    for n in range(EVENTS_PER_SHIPMENT)
+                ],
+            )
+            await connection.execute(
+                insert(ShipmentTag),
+                [
+                    {"shipment_id": row["id"], "tag_id": tags[i % 2]["id"]}
+                    for i, row in enumerate(rows)
+                    if i % 2
+                ],
+            )
+
+
+async def orm_listing(session: AsyncSession):
+    return (
+        await session.scalars(
+            select(Shipment)
+            .where(Shipment.seller_id == SELLER_ID)
+            .options(
+                selectinload(Shipment.timeline).lazyload(ShipmentEvent.shipment),
+                selectinload(Shipment.tags).lazyload(Tag.shipments),
+                lazyload("*"),
+            )
+        )
+    ).all()
+
+
+async def read_model_listing(session: AsyncSession):
+    return await ShipmentService(session, None, None).read_all(
+        seller=Seller(id=SELLER_ID)
+    )
+
+
+async def measure(engine, load) -> tuple[int, int, int]:
+    gc.collect()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+
+    async with AsyncSession(engine) as session:
+        shipments = await load(session)
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+
+    return len(shipments), retained - before, peak - before
+
+
+async def main(shipments: int):
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    print(f"populating {shipments} shipments ...")
+    await populate(engine, shipments)
+
+    tracemalloc.start()
+    for name, load in (("orm", orm_listing), ("read model", read_model_listing)):
+        count, retained, peak = await measure(engine, load)
+        assert count == shipments
+        print(
+            f"{name:>10}: {retained / count:8.0f} B/shipment retained, "
+            f"{peak / count:8.0f} B/shipment peak "
+            f"({retained / 2**20:.0f} MiB / {peak / 2**20:.0f} MiB)"
+        )
+    tracemalloc.stop()
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else SHIPMENTS))
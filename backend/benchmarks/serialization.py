@@ -0,0 +1,127 @@
+"""Throughput of a 1,000 shipment list response
+
+Compares FastAPI's default path (validating ORM objects into
+ShipmentRead then encoding) with the trusted row fast path of
+app.api.serialization.
+
+    python -m benchmarks.serialization
+"""
+
+import json
+import timeit
+from collections import namedtuple
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+
+from app.api.schemas.shipment import ShipmentRead
+from app.api.serialization import (
+    json_response,
+    shipment_event_read,
+    shipment_read,
+    tag_read,
+)
+from app.database.models import Shipment, ShipmentEvent, ShipmentStatus, Tag, TagName
+
+ShipmentRow = namedtuple(
+    "ShipmentRow", "id content weight destination estimated_delivery"
+)
+EventRow = namedtuple(
+    "EventRow", "id created_at seq location status description shipment_id"
+)
+TagRow = namedtuple("TagRow", "name instruction")
+
+SHIPMENTS = 1000
+EVENTS_PER_SHIPMENT = 4
+ROUNDS = 20
+
+
+def make_shipments() -> list[Shipment]:
+    tags = [
+        Tag(id=uuid4(), name=TagName.FRAGILE, instruction="Handle with care"),
+        Tag(id=uuid4(), name=TagName.EXPRESS, instruction="Deliver first"),
+    ]
+    now = datetime.now()
+    shipments = []
+    for i in range(SHIPMENTS):
+        shipment = Shipment(
+            id=uuid4(),
+            created_at=now,
+            client_contact_email="client@example.com",
+            content=f"shipment {i}",
+            weight=1.5,
+            destination=11001,
+            estimated_delivery=now + timedelta(days=3),
+            seller_id=uuid4(),
+            delivery_partner_id=uuid4(),
+        )
+        shipment.timeline = [
+            ShipmentEvent(
+                id=uuid4(),
+                created_at=now + timedelta(hours=n),
+                seq=i * EVENTS_PER_SHIPMENT + n,
+                location=11001,
+                status=ShipmentStatus.in_transit,
+                description=f"scanned at {11001}",
+                shipment_id=shipment.id,
+            )
+            for n in range(EVENTS_PER_SHIPMENT)
+        ]
+        shipment.tags = tags
+        shipments.append(shipment)
+    return shipments
+
+
+def main():
+    shipments = make_shipments()
+
+    field = create_model_field("Response_get_shipments", list[ShipmentRead])
+
+    def default_path():
+        # Nothing is awaited inside, run the coroutine to completion
+        try:
+            serialize_response(field=field, response_content=shipments).send(None)
+        except StopIteration as done:
+            return JSONResponse(done.value).body
+
+    # Same data as the rows read by ShipmentService._read,
+    # like the ORM objects they are not part of the timing
+    rows = [
+        (
+            ShipmentRow(*(getattr(shipment, name) for name in ShipmentRow._fields)),
+            [
+                EventRow(*(getattr(event, name) for name in EventRow._fields))
+                for event in shipment.timeline
+            ],
+            [TagRow(tag.name, tag.instruction) for tag in shipment.tags],
+        )
+        for shipment in shipments
+    ]
+
+    def fast_path():
+        return json_response(
+            [
+                shipment_read(
+                    shipment,
+                    [shipment_event_read(event) for event in timeline],
+                    [tag_read(tag) for tag in tags],
+                )
+                for shipment, timeline, tags in rows
+            ]
+        ).body
+
+    assert json.loads(default_path()) == json.loads(fast_path())
+
+    for name, path in (("default", default_path), ("fast path", fast_path)):
+        seconds = min(timeit.repeat(path, number=1, repeat=ROUNDS))
+        print(
+            f"{name:>10}: {seconds * 1000:8.2f} ms/response, "
+            f"{SHIPMENTS / seconds:10.0f} shipments/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
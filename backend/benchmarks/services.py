@@ -0,0 +1,403 @@
+"""Microbenchmarks of the service layer hot paths
+
+Runs the services in-process against an in-memory sqlite database and
+the in-memory redis of app.fakes.redis, no docker needed. Celery tasks
+are not published, their calls are only counted.
+
+Each benchmark runs a fixed number of operations on a fresh database,
+the best of a few rounds is compared with the stored baselines and the
+run fails if any is slower than its baseline by more than the threshold.
+
+    python -m benchmarks.services [names] [--threshold 0.25]
+    python -m benchmarks.services --save   # store new baselines
+
+Baselines depend on the machine, save them on yours before a change
+and compare after it.
+"""
+
+import argparse
+import asyncio
+import inspect
+import sys
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+from typing import Awaitable, Callable
+
+import orjson
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel
+
+import app.database.redis as redis_clients
+from app.api.schemas.shipment import ShipmentCreate, ShipmentUpdate
+from app.api.serialization import json_response
+from app.database.models import (
+    DeliveryPartner,
+    Location,
+    Seller,
+    Shipment,
+    ShipmentEvent,
+    ShipmentStatus,
+    Tag,
+    TagName,
+    WebhookEndpoint,
+)
+from app.database.pubsub import shipment_events
+from app.database.redis import Redis
+from app.fakes.redis import fake_redis, server
+from app.services import shipment_event
+from app.services.delivery_partner import DeliveryPartnerService
+from app.services.shipment import ShipmentService
+from app.services.shipment_event import ShipmentEventService
+from app.utils import (
+    decode_access_token,
+    decode_url_safe_token,
+    generate_access_token,
+    generate_url_safe_token,
+)
+
+BASELINES = Path(__file__).parent / "baselines.json"
+ROUNDS = 5
+THRESHOLD = 0.25
+
+SELLER_ZIP = 11001
+DESTINATION = 11002
+
+
+class Tasks:
+    """Stands in for the celery tasks, counting calls"""
+
+    calls: Counter[str] = Counter()
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def delay(self, *args, **kwargs):
+        self.calls[self.name] += 1
+
+    def apply_async(self, *args, **kwargs):
+        self.calls[self.name] += 1
+
+
+def use_fakes():
+    redis_clients._token_blacklist = fake_redis(Redis, db=0)
+    redis_clients._shipment_verification_codes = fake_redis(
+        Redis, db=1, decode_responses=True
+    )
+    redis_clients._webhook_queue = fake_redis(Redis, db=3, decode_responses=True)
+    shipment_events.redis = fake_redis(Redis, decode_responses=True)
+
+    for name in ("send_email_with_template", "send_sms", "deliver_webhooks"):
+        setattr(shipment_event, name, Tasks(name))
+
+
+@dataclass
+class World:
+    """Fresh database of a round, with a seller, the partners
+    serving its destination and a webhook endpoint"""
+
+    engine: object
+    session: sessionmaker
+    seller: Seller
+    partner: DeliveryPartner
+
+    @classmethod
+    async def create(cls) -> "World":
+        server.flushall()
+        engine = create_async_engine(
+            "sqlite+aiosqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        async with engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+
+        session = sessionmaker(
+            bind=engine, class_=AsyncSession, expire_on_commit=False
+        )
+        async with session() as db:
+            seller = Seller(
+                name="Seller",
+                email="seller@example.com",
+                email_verified=True,
+                password_hash="-",
+                address="1 Seller Street",
+                zip_code=SELLER_ZIP,
+            )
+            destination = Location(zip_code=DESTINATION)
+            # The first partner is full, assignment moves on to the next
+            partners = [
+                DeliveryPartner(
+                    name=f"Partner {n}",
+                    email=f"partner{n}@example.com",
+                    email_verified=True,
+                    password_hash="-",
+                    max_handling_capacity=capacity,
+                    servicable_locations=[destination],
+                )
+                for n, capacity in enumerate((0, 10_000))
+            ]
+            db.add_all([seller, *partners])
+            db.add_all(
+                (
+                    Tag(name=TagName.FRAGILE, instruction="Handle with care"),
+                    Tag(name=TagName.EXPRESS, instruction="Deliver first"),
+                )
+            )
+            await db.commit()
+            db.add(
+                WebhookEndpoint(
+                    url="http://localhost:8091/webhook",
+                    secret="secret",
+                    seller_id=seller.id,
+                )
+            )
+            await db.commit()
+
+        return cls(engine, session, seller, partners[1])
+
+    async def add_shipments(self, count: int) -> list[Shipment]:
+        async with self.session() as db:
+            shipments = [
+                Shipment(
+                    client_contact_email="client@example.com",
+                    content=f"Shipment {n}",
+                    weight=1.5,
+                    destination=DESTINATION,
+                    estimated_delivery=datetime.now() + timedelta(days=3),
+                    seller_id=self.seller.id,
+                    delivery_partner_id=self.partner.id,
+                )
+                for n in range(count)
+            ]
+            db.add_all(shipments)
+            await db.commit()
+            db.add_all(
+                ShipmentEvent(
+                    location=SELLER_ZIP,
+                    status=ShipmentStatus.placed,
+                    shipment_id=shipment.id,
+                )
+                for shipment in shipments
+            )
+            await db.commit()
+            return shipments
+
+    async def close(self):
+        await self.engine.dispose()
+
+
+def shipment_service(session: AsyncSession) -> ShipmentService:
+    return ShipmentService(
+        session,
+        DeliveryPartnerService(session),
+        ShipmentEventService(session),
+    )
+
+
+# Operation to time, called with its index
+Operation = Callable[[int], Awaitable[object] | object]
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Operations per round
+    count: int
+    setup: Callable[[World], Awaitable[Operation]]
+
+
+BENCHMARKS: dict[str, Benchmark] = {}
+
+
+def benchmark(name: str, count: int):
+    def register(setup):
+        BENCHMARKS[name] = Benchmark(name, count, setup)
+        return setup
+
+    return register
+
+
+@benchmark("shipment.add", 50)
+async def shipment_add(world: World) -> Operation:
+    shipment = ShipmentCreate(
+        content="Books",
+        weight=2.5,
+        destination=DESTINATION,
+        client_contact_email="client@example.com",
+    )
+
+    async def add(n: int):
+        async with world.session() as session:
+            await shipment_service(session).add(shipment, world.seller)
+
+    return add
+
+
+@benchmark("shipment.update", 100)
+async def shipment_update(world: World) -> Operation:
+    shipments = await world.add_shipments(100)
+    update = ShipmentUpdate(location=DESTINATION, status=ShipmentStatus.in_transit)
+
+    async def update_shipment(n: int):
+        async with world.session() as session:
+            await shipment_service(session).update(
+                shipments[n].id, update, world.partner
+            )
+
+    return update_shipment
+
+
+@benchmark("partner.assign_shipment", 200)
+async def assign_shipment(world: World) -> Operation:
+    async def assign(n: int):
+        async with world.session() as session:
+            await DeliveryPartnerService(session).assign_shipment(
+                Shipment(destination=DESTINATION)
+            )
+
+    return assign
+
+
+@benchmark("event.add", 100)
+async def event_add(world: World) -> Operation:
+    shipments = await world.add_shipments(100)
+
+    async def add(n: int):
+        async with world.session() as session:
+            await ShipmentEventService(session).add(
+                shipment=shipments[n],
+                location=DESTINATION,
+                status=ShipmentStatus.in_transit,
+            )
+
+    return add
+
+
+@benchmark("utils.generate_access_token", 5_000)
+async def access_token(world: World) -> Operation:
+    data = {"user": {"name": "Seller", "id": str(world.seller.id)}}
+    return lambda n: generate_access_token(data)
+
+
+@benchmark("utils.decode_access_token", 5_000)
+async def decode_token(world: World) -> Operation:
+    token = generate_access_token({"user": {"id": str(world.seller.id)}})
+    return lambda n: decode_access_token(token)
+
+
+@benchmark("utils.generate_url_safe_token", 5_000)
+async def url_safe_token(world: World) -> Operation:
+    data = {"id": str(world.seller.id)}
+    return lambda n: generate_url_safe_token(data)
+
+
+@benchmark("utils.decode_url_safe_token", 5_000)
+async def decode_url_safe(world: World) -> Operation:
+    token = generate_url_safe_token({"id": str(world.seller.id)})
+    expiry = timedelta(days=1)
+    return lambda n: decode_url_safe_token(token, expiry=expiry)
+
+
+@benchmark("serialize.shipments_100", 200)
+async def serialize_shipments(world: World) -> Operation:
+    await world.add_shipments(100)
+    async with world.session() as session:
+        shipments = await shipment_service(session).read_all(seller=world.seller)
+    return lambda n: json_response(shipments)
+
+
+async def run(benchmark: Benchmark) -> float:
+    """Best time of an operation over the rounds, in microseconds"""
+    best = float("inf")
+    for _ in range(ROUNDS):
+        world = await World.create()
+        try:
+            operation = await benchmark.setup(world)
+            is_async = inspect.iscoroutinefunction(operation)
+
+            start = perf_counter()
+            if is_async:
+                for n in range(benchmark.count):
+                    await operation(n)
+            else:
+                for n in range(benchmark.count):
+                    operation(n)
+            best = min(best, (perf_counter() - start) / benchmark.count)
+        finally:
+            await world.close()
+    return best * 1e6
+
+
+def load_baselines() -> dict[str, float]:
+    return orjson.loads(BASELINES.read_bytes()) if BASELINES.exists() else {}
+
+
+async def main(names: list[str], threshold: float, save: bool) -> int:
+    use_fakes()
+    baselines = load_baselines()
+    results: dict[str, float] = {}
+    regressions = []
+
+    for name in names:
+        results[name] = micros = await run(BENCHMARKS[name])
+        baseline = baselines.get(name)
+
+        line = f"{name:<32} {micros:10.1f} us/op"
+        if baseline is not None:
+            change = micros / baseline - 1
+            line += f"   baseline {baseline:10.1f} us/op {change:+8.1%}"
+            if change > threshold:
+                regressions.append(name)
+                line += "   REGRESSION"
+        print(line)
+
+    if save:
+        BASELINES.write_bytes(
+            orjson.dumps(
+                {**baselines, **{name: round(us, 1) for name, us in results.items()}},
+                option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS,
+            )
+            + b"\n"
+        )
+        print(f"baselines saved to {BASELINES}")
+        return 0
+
+    if regressions:
+        print(
+            f"\n{len(regressions)} slower than baseline by more "
+            f"than {threshold:.0%}: {', '.join(regressions)}"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help="slowdown over the baseline that fails the run, 0.25 is 25%%",
+    )
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help="store the results as the new baselines",
+    )
+    args = parser.parse_args()
+    if unknown := set(args.names) - set(BENCHMARKS):
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    sys.exit(
+        asyncio.run(main(args.names or list(BENCHMARKS), args.threshold, args.save))
+    )
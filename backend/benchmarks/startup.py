@@ -0,0 +1,119 @@
+"""Cold start of the api, until it is ready to take requests
+
+Each run starts a fresh interpreter that imports app.main, runs the
+lifespan startup (warm up) and serves a first request, and reports
+the time of each step. Also lists the heavy modules meant to be
+imported lazily that got imported anyway.
+
+    python -m benchmarks.startup [--runs 10] [--local]
+
+`--local` runs in local mode on a throwaway sqlite file, without
+postgres or redis. Otherwise the services of .env are used, warm up
+steps failing to reach them are logged and skipped.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+RUNS = 10
+
+# Not needed by the api process to start
+LAZY_MODULES = ("twilio", "fastapi_mail", "aiohttp", "requests", "httpx", "rich")
+
+
+def run_child():
+    start = perf_counter()
+    from app.main import app
+
+    imported = perf_counter()
+
+    async def serve() -> dict:
+        async with app.router.lifespan_context(app):
+            ready = perf_counter()
+            loaded = [name for name in LAZY_MODULES if name in sys.modules]
+
+            import httpx
+
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app),
+                base_url="http://startup",
+            ) as client:
+                request_start = perf_counter()
+                await client.get("/")
+                first_request = perf_counter() - request_start
+
+        return {
+            "import": imported - start,
+            "warm_up": ready - imported,
+            "ready": ready - start,
+            "first_request": first_request,
+            "lazy_modules_loaded": loaded,
+        }
+
+    # Last line of the output, after any logs
+    print(json.dumps(asyncio.run(serve())))
+
+
+def run(env: dict) -> dict:
+    start = perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child"],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process"] = perf_counter() - start
+    return result
+
+
+def main(runs: int, local: bool):
+    env = {**os.environ, "LOG_LEVEL": "WARNING"}
+    with tempfile.TemporaryDirectory() as directory:
+        if local:
+            env["LOCAL_MODE"] = "true"
+            env["SQLITE_FILE"] = str(Path(directory) / "startup.db")
+
+        results = [run(env) for _ in range(runs)]
+
+    print(f"{runs} runs{' in local mode' if local else ''}, median (min)")
+    for step, label in (
+        ("import", "import app.main"),
+        ("warm_up", "lifespan warm up"),
+        ("ready", "ready"),
+        ("first_request", "first request"),
+        ("process", "process (start to exit)"),
+    ):
+        seconds = [result[step] for result in results]
+        print(
+            f"{label:>24}: {median(seconds) * 1000:8.1f} ms "
+            f"({min(seconds) * 1000:.1f} ms)"
+        )
+
+    loaded = sorted({name for result in results for name in result["lazy_modules_loaded"]})
+    if loaded:
+        print(f"\nimported before ready, expected lazy: {', '.join(loaded)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=RUNS)
+    parser.add_argument("--local", action="store_true", help="run in local mode")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child()
+    else:
+        main(args.runs, args.local)
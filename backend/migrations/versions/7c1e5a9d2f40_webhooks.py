@@ -0,0 +1,52 @@
+"""webhooks
+
+Revision ID: 7c1e5a9d2f40
+Revises: 44bbfc1a1bc1
+Create Date: 2026-10-18 10:12:41.503128
+
+"""
+from typing import Sequence, Union
+
+import sqlmodel
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '7c1e5a9d2f40'
+down_revision: Union[str, None] = '44bbfc1a1bc1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('webhook_endpoint',
+    sa.Column('id', sa.UUID(), nullable=False),
+    sa.Column('created_at', postgresql.TIMESTAMP(), nullable=True),
+    sa.Column('url', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('secret', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('active', sa.Boolean(), nullable=False),
+    sa.Column('max_concurrency', sa.Integer(), nullable=False),
+    sa.Column('seller_id', sa.Uuid(), nullable=False),
+    sa.ForeignKeyConstraint(['seller_id'], ['seller.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_webhook_endpoint_seller_id'), 'webhook_endpoint', ['seller_id'], unique=False)
+    op.create_table('webhook_dead_letter',
+    sa.Column('id', sa.UUID(), nullable=False),
+    sa.Column('created_at', postgresql.TIMESTAMP(), nullable=True),
+    sa.Column('payload', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('error', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('endpoint_id', sa.Uuid(), nullable=False),
+    sa.ForeignKeyConstraint(['endpoint_id'], ['webhook_endpoint.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_webhook_dead_letter_endpoint_id'), 'webhook_dead_letter', ['endpoint_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_webhook_dead_letter_endpoint_id'), table_name='webhook_dead_letter')
+    op.drop_table('webhook_dead_letter')
+    op.drop_index(op.f('ix_webhook_endpoint_seller_id'), table_name='webhook_endpoint')
+    op.drop_table('webhook_endpoint')
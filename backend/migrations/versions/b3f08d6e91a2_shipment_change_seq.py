@@ -0,0 +1,56 @@
+"""shipment change seq
+
+Revision ID: b3f08d6e91a2
+Revises: 7c1e5a9d2f40
+Create Date: 2026-10-18 14:37:05.218446
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3f08d6e91a2'
+down_revision: Union[str, None] = '7c1e5a9d2f40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute(sa.schema.CreateSequence(sa.Sequence('shipment_event_seq')))
+    op.add_column('shipment_event', sa.Column(
+        'seq',
+        sa.BigInteger(),
+        server_default=sa.text("nextval('shipment_event_seq')"),
+        nullable=True,
+    ))
+    # Number existing events in the order they happened
+    op.execute("""
+        UPDATE shipment_event SET seq = ordered.n
+        FROM (
+            SELECT id, row_number() OVER (ORDER BY created_at, id) AS n
+            FROM shipment_event
+        ) AS ordered
+        WHERE shipment_event.id = ordered.id
+    """)
+    op.execute("""
+        SELECT setval(
+            'shipment_event_seq',
+            COALESCE((SELECT max(seq) FROM shipment_event), 0) + 1,
+            false
+        )
+    """)
+    op.create_index(op.f('ix_shipment_event_seq'), 'shipment_event', ['seq'], unique=True)
+    op.create_index(op.f('ix_shipment_event_shipment_id'), 'shipment_event', ['shipment_id'], unique=False)
+    op.create_index(op.f('ix_shipment_seller_id'), 'shipment', ['seller_id'], unique=False)
+    op.create_index(op.f('ix_shipment_delivery_partner_id'), 'shipment', ['delivery_partner_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_shipment_delivery_partner_id'), table_name='shipment')
+    op.drop_index(op.f('ix_shipment_seller_id'), table_name='shipment')
+    op.drop_index(op.f('ix_shipment_event_shipment_id'), table_name='shipment_event')
+    op.drop_index(op.f('ix_shipment_event_seq'), table_name='shipment_event')
+    op.drop_column('shipment_event', 'seq')
+    op.execute(sa.schema.DropSequence(sa.Sequence('shipment_event_seq')))